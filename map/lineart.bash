@@ -20,6 +20,6 @@ vpype read $1 \
     write --page-size ${dim}x$dim $outsvg
 
 echo gcode rendering
-vpype --config ../qtdraw.toml \
-    read $outsvg \
-    gwrite -p qtdraw $outgcode
+../mesh/qtdraw_gwrite.py --config ../qtdraw.toml --gwrite_profile qtdraw \
+    --input_svg_filename $outsvg \
+    --output_gcode_filename $outgcode
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""The mesh tools as subcommands of one qtdraw command. The module of a
+subcommand is only imported when the subcommand runs, so qtdraw --help and
+the light subcommands don't pay for scipy, pandas or matplotlib."""
+
+import importlib
+
+import click
+
+# subcommand: (module, command, qt_mesh work mode or None, short help)
+SUBCOMMANDS = {
+    'probe-gcode': ('qtdraw_mesh', 'qt_mesh', 'gcode', 'Generate gcode that probes a grid.'),
+    'probe': ('qtdraw_mesh', 'qt_mesh', 'probe', 'Probe a grid on the controller and write the mesh as it goes.'),
+    'parse': ('qtdraw_mesh', 'qt_mesh', 'parse', 'Parse the PRB reports of a probe log into a mesh.'),
+    'refine': ('qtdraw_mesh', 'qt_mesh', 'refine', 'Generate gcode that probes a coarse mesh again where it is off.'),
+    'merge': ('qtdraw_mesh', 'qt_mesh', 'merge', 'Merge a coarse mesh and its refine pass.'),
+    'simulate': ('qtdraw_mesh', 'qt_mesh', 'simulate', 'Try adaptive probing on a synthetic bed.'),
+    'remap': ('qtdraw_remap_gcode', 'qtdraw_remap_gcode', None, 'Remap the Z of gcode files onto a mesh.'),
+    'watch': ('qtdraw_remap_watch', 'qtdraw_remap_watch', None, 'Remap gcode files as they show up in a directory.'),
+    'surface': ('qtdraw_surface', 'qtdraw_surface', None, 'Report how well each surface model fits a mesh.'),
+    'plot': ('qtdraw_mesh_plot', 'qtdraw_mesh_plot', None, 'Plot a mesh, optionally with remapped points.'),
+    'diff': ('qtdraw_mesh_diff', 'qtdraw_mesh_diff', None, 'Plot the difference of two meshes.'),
+    'history': ('qtdraw_mesh_history', 'qtdraw_mesh_history', None, 'Track drift and repeatability over a history of meshes.'),
+    'report': ('qtdraw_mesh_report', 'qtdraw_mesh_report', None, 'Render heatmaps of many meshes or their differences to pngs.'),
+    'gwrite': ('qtdraw_gwrite', 'qtdraw_gwrite', None, 'Write an svg as gcode with a vpype gwrite profile.'),
+    'probe-sim': ('qtdraw_probe', 'qtdraw_probe', None, 'Serve a simulated FluidNC that probes a synthetic bed.'),
+    'bench': ('qtdraw_remap_bench', 'qtdraw_remap_bench', None, 'Benchmark the remapper on synthetic meshes and gcode.'),
+    'startup-bench': ('qtdraw_startup_bench', 'qtdraw_startup_bench', None, 'Benchmark the start up time of qtdraw subcommands.'),
+}
+
+
+class LazyGroup(click.Group):
+    """A group that imports the module of a subcommand when it is looked up
+    and lists the subcommands from SUBCOMMANDS without importing any."""
+
+    def list_commands(self, ctx: click.Context) -> list:
+        return list(SUBCOMMANDS)
+
+    def get_command(self, ctx: click.Context, name: str) -> click.Command:
+        if name not in SUBCOMMANDS:
+            return None
+        module_name, command_name, work_mode, help = SUBCOMMANDS[name]
+        module = importlib.import_module(module_name)
+        if work_mode is not None:
+            return module.work_mode_command(module.WorkMode[work_mode], name, help)
+        return getattr(module, command_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        with formatter.section('Commands'):
+            formatter.write_dl([(name, entry[3]) for name, entry in SUBCOMMANDS.items()])
+
+
+@click.group(cls=LazyGroup)
+def qtdraw():
+    """Probe bed meshes on the qtdraw and remap gcode onto them."""
+
+
+if __name__ == '__main__':
+    qtdraw()
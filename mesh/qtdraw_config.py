@@ -0,0 +1,27 @@
+"""Read the machine settings the mesh tools need from a FluidNC config.yaml."""
+
+
+def machine_config_read(input_filename: str) -> dict:
+    # only the tools given a config need yaml
+    import yaml
+    with open(input_filename, 'r') as input:
+        config = yaml.safe_load(input)
+    print(f"read machine config '{config.get('name', '')}' from '{input_filename}'")
+    return config
+
+
+def axis_setting(config: dict, setting: str) -> dict:
+    """A per axis setting such as steps_per_mm, keyed by the upper case axis
+    letter, for the axes that have it."""
+    axes = config.get('axes') or {}
+    return {axis.upper(): float(axes[axis][setting]) for axis in axes \
+            if isinstance(axes[axis], dict) and setting in axes[axis]}
+
+
+def steps_per_mm(config: dict) -> dict:
+    return axis_setting(config, 'steps_per_mm')
+
+
+def quantize(value: float, steps: float) -> float:
+    """Round a coordinate to the nearest whole motor step."""
+    return round(value * steps) / steps
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+"""Write polylines as gcode through a gwrite profile, like vpype gwrite -p
+does, without formatting every vertex through its templates one at a time.
+The segment templates are turned into % formats and the coordinates of a
+whole chunk of lines are formatted by one % of a format string repeated per
+vertex, so the formatting runs in C. Profiles with fields a % format can't
+reproduce exactly are written a vertex at a time as vpype-gcode does."""
+
+import collections
+import os
+import re
+import string
+import sys
+import typing
+
+import click
+import numpy as np
+
+import qtdraw_profile
+
+# px per unit, vpype's internal unit is the css px
+GWRITE_UNITS = { \
+    'px': 1.0, \
+    'in': 96.0, \
+    'inch': 96.0, \
+    'ft': 12.0 * 96.0, \
+    'yd': 36.0 * 96.0, \
+    'mm': 96.0 / 25.4, \
+    'cm': 96.0 / 2.54, \
+    'm': 100.0 * 96.0 / 2.54, \
+    'pc': 16.0, \
+    'pt': 96.0 / 72.0, \
+}
+TEMPLATES = ('document_start', 'document_end', 'layer_start', 'layer_end', 'layer_join', \
+        'line_start', 'line_end', 'line_join', 'segment_first', 'segment', 'segment_last')
+# the segment fields the fast path computes for every vertex at once
+SEGMENT_FIELDS = ('x', 'y', 'dx', 'dy', '_x', '_y', '_dx', '_dy', \
+        'index', 'index1', 'segment_index', 'segment_index1')
+# the whole step fields depend on the rounding of every vertex before
+STEP_FIELDS = ('ix', 'iy', 'idx', 'idy')
+# format specs that mean the same to str.format and to %
+PERCENT_SPEC_RE = re.compile(r'[+ ]?#?0?[0-9]*(?:\.[0-9]+)?[eEfFgGd]')
+CHUNK_LINES = 10000
+
+
+def gwrite_config_read(config_filename: str, profile: str) -> dict:
+    """The [gwrite.<profile>] table of a vpype config toml."""
+    try:
+        import tomllib
+    except ImportError:
+        # before python 3.11 the same parser is the tomli package
+        import tomli as tomllib
+    with open(config_filename, 'rb') as input:
+        config = tomllib.load(input)
+    profiles = config.get('gwrite', {})
+    if profile not in profiles:
+        raise ValueError(f"no gwrite profile '{profile}' in '{config_filename}', " \
+                f"found {', '.join(p for p in profiles if p != 'default_profile') or 'none'}")
+    return profiles[profile]
+
+
+def template_fields(template: str) -> set:
+    if template is None:
+        return set()
+    return {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+
+
+def percent_format(template: str) -> (str, list):
+    """A segment template as a % format and the SEGMENT_FIELDS it takes in
+    order, or None if the template needs anything else or a format spec that
+    % would render differently."""
+    if template is None:
+        return '', []
+    parts = []
+    fields = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        parts.append(literal.replace('%', '%%'))
+        if field is None:
+            continue
+        integer = field.startswith('index') or field.startswith('segment_index')
+        if field not in SEGMENT_FIELDS or conversion is not None:
+            return None
+        if spec == '':
+            # str() of a float is its repr
+            parts.append('%d' if integer else '%r')
+        elif PERCENT_SPEC_RE.fullmatch(spec) and (integer or not spec.endswith('d')):
+            parts.append('%' + spec)
+        else:
+            return None
+        fields.append(field)
+    return ''.join(parts), fields
+
+
+def gwrite_transform(layers: dict, profile: dict, page_size: (float, float) = None) -> dict:
+    """The lines of each layer, complex arrays in px, as the vertices of all
+    lines of the layer in one array and the length of each line, scaled to
+    the profile unit, offset and inverted about the middle of the whole
+    drawing as gwrite does. The operations are the ones gwrite makes on each
+    line in the same order, so the coordinates come out to the same bits."""
+    unit_scale = GWRITE_UNITS[profile.get('unit', 'mm')]
+    scale_x = profile.get('scale_x', 1.0) / unit_scale
+    scale_y = profile.get('scale_y', 1.0) / unit_scale
+    offset = complex(profile.get('offset_x', 0.0), profile.get('offset_y', 0.0))
+    layers = {layer_id: (np.concatenate([np.asarray(line, dtype=complex).reshape(-1) for line in lines] \
+            or [np.empty(0, dtype=complex)]), np.array([len(line) for line in lines], dtype=int)) \
+            for layer_id, lines in layers.items()}
+    for xy, _ in layers.values():
+        xy.real *= scale_x
+        xy.imag *= scale_y
+        xy += offset
+
+    def invert(invert_x: bool, invert_y: bool, bounds: (float, float, float, float)):
+        origin = complex(0.5 * (bounds[0] + bounds[2]), 0.5 * (bounds[1] + bounds[3]))
+        for xy, _ in layers.values():
+            xy -= origin
+            xy.real *= -1 if invert_x else 1
+            xy.imag *= -1 if invert_y else 1
+            xy += origin
+
+    # about the middle of the drawing
+    if profile.get('invert_x', False) or profile.get('invert_y', False):
+        points = [xy for xy, _ in layers.values() if len(xy) > 0]
+        if len(points) > 0:
+            bounds = (min(float(xy.real.min()) for xy in points), min(float(xy.imag.min()) for xy in points), \
+                    max(float(xy.real.max()) for xy in points), max(float(xy.imag.max()) for xy in points))
+            invert(profile.get('invert_x', False), profile.get('invert_y', False), bounds)
+    # about the middle of the page
+    if profile.get('horizontal_flip', False) or profile.get('vertical_flip', False):
+        if page_size is None:
+            raise ValueError("the profile flips about the page but the drawing has no page size")
+        invert(profile.get('horizontal_flip', False), profile.get('vertical_flip', False), \
+                (0.0, 0.0, page_size[0] / unit_scale, page_size[1] / unit_scale))
+    return layers
+
+
+class TemplateWriter:
+    """Expands the templates of a profile the way gwrite does, the context
+    first, then the metadata of the layer and the default values."""
+
+    def __init__(self, output: typing.TextIO, profile: dict, layer_metadata: dict = None):
+        self.output = output
+        self.profile = profile
+        self.layer_metadata = layer_metadata or {}
+        self.metadata = {}
+
+    def text(self, name: str, **context) -> str:
+        template = self.profile.get(name)
+        if template is None:
+            return ''
+        try:
+            return template.format_map(collections.ChainMap(context, self.metadata, \
+                    self.profile.get('default_values', {})))
+        except KeyError as e:
+            raise ValueError(f"key {e.args[0]!r} of the {name} template isn't a gwrite field or a property")
+
+    def write(self, name: str, **context):
+        self.output.write(self.text(name, **context))
+
+
+def gwrite_vertices(writer: TemplateWriter, layers: dict, filename: str):
+    """Write layers a vertex at a time, a port of the vpype-gcode loop for
+    profiles the fast path can't do."""
+    profile = writer.profile
+    last_x = last_y = 0
+    xx = yy = 0
+    for layer_index, (layer_id, (xy, lengths)) in enumerate(layers.items()):
+        layer_context = {'layer_index': layer_index, 'layer_index1': layer_index + 1, \
+                'layer_id': layer_id, 'filename': filename}
+        writer.metadata = writer.layer_metadata.get(layer_id, {})
+        writer.write('layer_start', x=last_x, y=last_y, ix=xx, iy=yy, \
+                index=layer_index, index1=layer_index + 1, **layer_context)
+        lines = np.split(xy, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+        for lines_index, line in enumerate(lines):
+            line_context = {'lines_index': lines_index, 'lines_index1': lines_index + 1, **layer_context}
+            writer.write('line_start', x=last_x, y=last_y, ix=xx, iy=yy, \
+                    index=lines_index, index1=lines_index + 1, **line_context)
+            for segment_index, (x, y) in enumerate(zip(line.real.tolist(), line.imag.tolist())):
+                dx = x - last_x
+                dy = y - last_y
+                idx = int(round(x - xx))
+                idy = int(round(y - yy))
+                xx += idx
+                yy += idy
+                if profile.get('segment_first') is not None and segment_index == 0:
+                    name = 'segment_first'
+                elif profile.get('segment_last') is not None and segment_index == len(line) - 1:
+                    name = 'segment_last'
+                else:
+                    name = 'segment'
+                writer.write(name, x=x, y=y, dx=dx, dy=dy, _x=-x, _y=-y, _dx=-dx, _dy=-dy, \
+                        ix=xx, iy=yy, idx=idx, idy=idy, index=segment_index, index1=segment_index + 1, \
+                        segment_index=segment_index, segment_index1=segment_index + 1, **line_context)
+                last_x = x
+                last_y = y
+            writer.write('line_end', x=last_x, y=last_y, ix=xx, iy=yy, \
+                    index=lines_index, index1=lines_index + 1, **line_context)
+            if lines_index != len(lines) - 1:
+                writer.write('line_join', x=last_x, y=last_y, ix=xx, iy=yy, \
+                        index=lines_index, index1=lines_index + 1, **line_context)
+        writer.write('layer_end', x=last_x, y=last_y, ix=xx, iy=yy, \
+                index=layer_index, index1=layer_index + 1, **layer_context)
+        if layer_index != len(layers) - 1:
+            writer.write('layer_join', x=last_x, y=last_y, ix=xx, iy=yy, \
+                    index=layer_index, index1=layer_index + 1, **layer_context)
+
+
+def segment_values(xy: np.ndarray, lengths: np.ndarray, last_xy: (float, float), formats: dict, \
+        first: str, last: str) -> (np.ndarray, np.ndarray):
+    """The values the segment formats take for every vertex of a layer, in
+    the order they are written, and where the values of each line end."""
+    segment_index = np.arange(len(xy)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    x, y = xy.real, xy.imag
+    # the deltas run on across lines and layers
+    dx = np.diff(x, prepend=last_xy[0])
+    dy = np.diff(y, prepend=last_xy[1])
+    columns = {'x': x, 'y': y, 'dx': dx, 'dy': dy, '_x': -x, '_y': -y, '_dx': -dx, '_dy': -dy, \
+            'index': segment_index, 'index1': segment_index + 1, \
+            'segment_index': segment_index, 'segment_index1': segment_index + 1}
+    # which of the segment formats each vertex takes, the first wins over the last
+    names = ['segment', last, first]
+    template = np.zeros(len(xy), dtype=int)
+    template[segment_index == lengths.repeat(lengths) - 1] = 1
+    if first != 'segment':
+        template[segment_index == 0] = 2
+    n_values = np.array([len(formats[name][1]) for name in names])[template]
+    ends = np.cumsum(n_values)
+    values = np.empty(ends[-1] if len(ends) > 0 else 0)
+    for t, name in enumerate(names):
+        vertices = np.flatnonzero(template == t)
+        for i, field in enumerate(formats[name][1]):
+            values[ends[vertices] - n_values[vertices] + i] = columns[field][vertices]
+    return values, np.concatenate(([0], ends))[np.cumsum(lengths)]
+
+
+def gwrite_bulk(writer: TemplateWriter, layers: dict, filename: str, formats: dict, chunk_lines: int):
+    """Write layers with the segment templates as % formats, every vertex of
+    a chunk of lines formatted by a single %."""
+    profile = writer.profile
+    # the line templates are constant unless they take a field
+    constant = {name: writer.text(name).replace('%', '%%') for name in ('line_start', 'line_end', 'line_join') \
+            if len(template_fields(profile.get(name))) == 0}
+    first = 'segment_first' if profile.get('segment_first') is not None else 'segment'
+    last = 'segment_last' if profile.get('segment_last') is not None else 'segment'
+
+    def segments_format(n: int) -> str:
+        if n == 0:
+            return ''
+        if n == 1:
+            return formats[first if first != 'segment' else last][0]
+        return formats[first][0] + formats['segment'][0] * (n - 2) + formats[last][0]
+
+    # with constant line templates, the format of a line only depends on its length
+    line_formats = {}
+    # 0 until the first vertex, as in gwrite
+    last_x = last_y = 0
+    for layer_index, (layer_id, (xy, lengths)) in enumerate(layers.items()):
+        layer_context = {'layer_index': layer_index, 'layer_index1': layer_index + 1, \
+                'layer_id': layer_id, 'filename': filename}
+        writer.metadata = writer.layer_metadata.get(layer_id, {})
+        writer.write('layer_start', x=last_x, y=last_y, \
+                index=layer_index, index1=layer_index + 1, **layer_context)
+        values, value_ends = segment_values(xy, lengths, (last_x, last_y), formats, first, last)
+        line_ends = np.cumsum(lengths)
+        for start in range(0, len(lengths), chunk_lines):
+            stop = min(start + chunk_lines, len(lengths))
+            if len(constant) == 3:
+                for n in set(lengths[start:stop].tolist()) - set(line_formats):
+                    line_formats[n] = constant['line_start'] + segments_format(n) + \
+                            constant['line_end'] + constant['line_join']
+                chunk = [line_formats[n] for n in lengths[start:stop].tolist()]
+                if stop == len(lengths):
+                    # no join after the last line of the layer
+                    chunk[-1] = chunk[-1][:len(chunk[-1]) - len(constant['line_join'])]
+            else:
+                chunk = []
+                for lines_index in range(start, stop):
+                    line_context = {'lines_index': lines_index, 'lines_index1': lines_index + 1, **layer_context}
+                    for name in ('line_start', None, 'line_end', 'line_join'):
+                        if name is None:
+                            chunk.append(segments_format(lengths[lines_index]))
+                            if lengths[lines_index] > 0:
+                                last_x, last_y = xy[line_ends[lines_index] - 1].real.item(), \
+                                        xy[line_ends[lines_index] - 1].imag.item()
+                        elif name == 'line_join' and lines_index == len(lengths) - 1:
+                            pass
+                        elif name in constant:
+                            chunk.append(constant[name])
+                        else:
+                            chunk.append(writer.text(name, x=last_x, y=last_y, \
+                                    index=lines_index, index1=lines_index + 1, **line_context).replace('%', '%%'))
+            first_value = value_ends[start - 1] if start > 0 else 0
+            writer.output.write(''.join(chunk) % tuple(values[first_value:value_ends[stop - 1]].tolist()))
+        if len(xy) > 0:
+            last_x, last_y = xy[-1].real.item(), xy[-1].imag.item()
+        writer.write('layer_end', x=last_x, y=last_y, \
+                index=layer_index, index1=layer_index + 1, **layer_context)
+        if layer_index != len(layers) - 1:
+            writer.write('layer_join', x=last_x, y=last_y, \
+                    index=layer_index, index1=layer_index + 1, **layer_context)
+
+
+def gwrite(output: typing.TextIO, layers: dict, profile: dict, filename: str = '', \
+        layer_metadata: dict = None, page_size: (float, float) = None, chunk_lines: int = CHUNK_LINES) -> bool:
+    """Write layers, a list of polylines as complex arrays in px for each
+    layer id, as gcode through a gwrite profile. Returns whether the fast
+    path wrote it."""
+    layers = gwrite_transform(layers, profile, page_size)
+    writer = TemplateWriter(output, profile, layer_metadata)
+    formats = {name: percent_format(profile.get(name)) for name in ('segment_first', 'segment', 'segment_last')}
+    line_fields = set().union(*(template_fields(profile.get(name)) for name in TEMPLATES))
+    fast = all(f is not None for f in formats.values()) and len(line_fields & set(STEP_FIELDS)) == 0
+    writer.write('document_start', filename=filename)
+    if fast:
+        gwrite_bulk(writer, layers, filename, formats, chunk_lines)
+    else:
+        gwrite_vertices(writer, layers, filename)
+    writer.metadata = {}
+    writer.write('document_end', filename=filename)
+    if profile.get('info'):
+        print(profile['info'], file=sys.stderr)
+    return fast
+
+
+def svg_layers(input_svg_filename: str, quantization: float) -> (dict, dict, (float, float)):
+    """The polylines of each layer of an svg as vpype read gives them, with
+    the properties of each layer and the page size."""
+    # reading svg is left to vpype, only this tool needs it
+    import vpype
+    document = vpype.read_multilayer_svg(input_svg_filename, quantization)
+    layers = {layer_id: list(layer) for layer_id, layer in document.layers.items()}
+    metadata = {layer_id: {**layer.metadata, **document.metadata} for layer_id, layer in document.layers.items()}
+    return layers, metadata, document.page_size
+
+
+@click.command()
+@click.option('--input_svg_filename', type=str, required=True, help='svg to write as gcode, as written by vpype write')
+@click.option('--output_gcode_filename', type=str, default=None, help='gcode output, the svg name with .gcode if not given')
+@click.option('--config', type=str, default='qtdraw.toml', help='vpype config toml with the gwrite profile')
+@click.option('--gwrite_profile', type=str, default='qtdraw', help='gwrite profile in the config')
+@click.option('--quantization', type=float, default=0.1, help='max length in mm of the segments approximating curves in the svg')
+@click.option('--chunk_lines', type=int, default=CHUNK_LINES, help='lines formatted per write')
+@qtdraw_profile.profiled('qtdraw_gwrite')
+def qtdraw_gwrite(input_svg_filename: str, output_gcode_filename: str, config: str, gwrite_profile: str, \
+        quantization: float, chunk_lines: int, profiler: qtdraw_profile.Profile):
+    """Write an svg as gcode with a gwrite profile, like vpype --config
+    qtdraw.toml read in.svg gwrite -p qtdraw out.gcode."""
+    if output_gcode_filename is None:
+        output_gcode_filename = os.path.splitext(input_svg_filename)[0] + '.gcode'
+    profile = gwrite_config_read(config, gwrite_profile)
+    with profiler.stage('read'):
+        layers, metadata, page_size = svg_layers(input_svg_filename, quantization * GWRITE_UNITS['mm'])
+    profiler.counts['lines'] += sum(len(lines) for lines in layers.values())
+    profiler.counts['vertices'] += sum(len(line) for lines in layers.values() for line in lines)
+    print(f"writing {profiler.counts['lines']} lines with {profiler.counts['vertices']} vertices " \
+            f"to '{output_gcode_filename}' with the {gwrite_profile} profile")
+    with profiler.stage('write'), profiler.hot(), open(output_gcode_filename, 'w', buffering=1 << 20) as output:
+        if not gwrite(output, layers, profile, output_gcode_filename, metadata, page_size, chunk_lines):
+            print("the profile has fields the fast path can't format, wrote it a vertex at a time")
+
+
+if __name__ == '__main__':
+    qtdraw_gwrite()
@@ -1,17 +1,295 @@
 #!/usr/bin/env python
 
 import enum
+import functools
+import os
 import sys
 import threading
 import typing
 
 import click
 import numpy as np
-import pandas as pd
+
+import qtdraw_config
+import qtdraw_meshfile
+import qtdraw_profile
 
 class WorkMode(enum.Enum):
     gcode = enum.auto()
+    probe = enum.auto()
     parse = enum.auto()
+    refine = enum.auto()
+    merge = enum.auto()
+    simulate = enum.auto()
+
+
+def zig_zag(xv: np.ndarray, yv: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """The x, y of a grid, or of the nodes in mask, traversed X major with
+    every other column reversed."""
+    pts = []
+    for i, x in enumerate(xv):
+        js = range(len(yv)) if i % 2 == 0 else reversed(range(len(yv)))
+        pts.extend((x, yv[j]) for j in js if mask is None or mask[i, j])
+    return np.array(pts).reshape(-1, 2)
+
+
+def two_opt(path: np.ndarray) -> np.ndarray:
+    """The order of a path of points after reversing stretches of it for as
+    long as that makes it shorter, the first point stays first."""
+    index = np.arange(len(path))
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(path) - 1):
+            p = path[index]
+            edge = np.hypot(*np.diff(p, axis=0).T)
+            j = np.arange(i + 1, len(p))
+            last = j == len(p) - 1
+            # reversing i..j swaps the edges into i and out of j for i-1 to j and i to j+1
+            after = p[np.minimum(j + 1, len(p) - 1)]
+            gain = edge[i - 1] + np.where(last, 0, edge[np.minimum(j, len(edge) - 1)]) \
+                    - np.hypot(*(p[j] - p[i - 1]).T) - np.where(last, 0, np.hypot(*(after - p[i]).T))
+            best = gain.argmax()
+            if gain[best] > 1e-9:
+                index[i:j[best] + 1] = index[i:j[best] + 1][::-1].copy()
+                improved = True
+    return index
+
+
+def probe_route(pts: np.ndarray, start: (float, float) = (0, 0)) -> np.ndarray:
+    """An order to probe pts in from start with little travel, nearest
+    neighbour first and then improved by 2-opt."""
+    left = np.ones(len(pts), dtype=bool)
+    order = []
+    here = np.asarray(start, dtype=float)
+    for _ in range(len(pts)):
+        distance = np.where(left, np.hypot(*(pts - here).T), np.inf)
+        k = int(distance.argmin())
+        order.append(k)
+        left[k] = False
+        here = pts[k]
+    order = np.array(order, dtype=int)
+    return order[two_opt(np.vstack((start, pts[order])))[1:] - 1]
+
+
+def move_time(distance: np.ndarray, rate: float, acceleration: float) -> np.ndarray:
+    """Seconds for moves of distance mm from standstill to standstill at a
+    rate in mm/min with a trapezoid or, when too short to get to the rate,
+    triangle speed profile."""
+    rate = rate / 60
+    distance = np.asarray(distance, dtype=float)
+    if acceleration is None or acceleration <= 0:
+        return distance / rate
+    return np.where(distance >= rate * rate / acceleration, distance / rate + rate / acceleration, \
+            2 * np.sqrt(distance / acceleration))
+
+
+def probe_time(pts: np.ndarray, feed: int, seek: int, travel_height: int, safe_height: int, \
+        config: dict = None, start: (float, float) = (0, 0), probe_cycle: dict = None, \
+        adaptive: bool = False) -> (float, float):
+    """Estimated seconds to run the probe gcode of write_probe_gcode and the
+    mm of xy travel, assuming the bed is about Z0. G0 moves go at the max
+    rate of the machine config, or at seek without one, and every move is
+    limited by the config acceleration of its axes. adaptive has every probe
+    but the first rapid down to the probe_cycle clearance first."""
+    probe_cycle = probe_cycle or {}
+    rates = qtdraw_config.axis_setting(config, 'max_rate_mm_per_min') if config else {}
+    accelerations = qtdraw_config.axis_setting(config, 'acceleration_mm_per_sec2') if config else {}
+    xy_rate = min(feed, rates.get('X', feed), rates.get('Y', feed))
+    xy_acceleration = min(accelerations.get('X', np.inf), accelerations.get('Y', np.inf))
+    z_acceleration = accelerations.get('Z', np.inf)
+    travel = np.hypot(*np.diff(np.vstack((start, pts)), axis=0).T)
+    seconds = move_time(travel, xy_rate, xy_acceleration).sum()
+
+    def z_move(distance: float, rate: float = np.inf) -> float:
+        return move_time(distance, min(rate, rates.get('Z', seek)), z_acceleration)
+
+    slow_feed = probe_cycle.get('slow_feed') or seek / 2
+    fast_feed = probe_cycle.get('fast_feed') or 0
+    if fast_feed > 0:
+        # fast down, back off the retract and slow down the retract again
+        retract = probe_cycle.get('retract', 0.5)
+        seconds += len(pts) * (z_move(retract) + z_move(retract, slow_feed))
+        clearance = min(probe_cycle.get('clearance', 0.5), travel_height)
+        n_adaptive = max(len(pts) - 1, 0) if adaptive and clearance < travel_height else 0
+        seconds += n_adaptive * (z_move(travel_height - clearance) + z_move(clearance, fast_feed))
+        seconds += (len(pts) - n_adaptive) * z_move(travel_height, fast_feed)
+    else:
+        # probe down from the travel height at the fine seek
+        seconds += len(pts) * z_move(travel_height, slow_feed)
+    # and lift back up at the rapid rate
+    seconds += len(pts) * z_move(travel_height)
+    seconds += 2 * z_move(abs(safe_height - travel_height))
+    return float(seconds), float(travel.sum())
+
+
+def order_probes(pts: np.ndarray, probe_order: str, feed: int, seek: int, travel_height: int, \
+        safe_height: int, config: dict = None, probe_cycle: dict = None, adaptive: bool = False) -> np.ndarray:
+    """Put zig zag ordered pts in the probe_order and print the estimated
+    probing time, and what the route and the probe cycle save."""
+    zig_zag_seconds, _ = probe_time(pts, feed, seek, travel_height, safe_height, config, \
+            probe_cycle=probe_cycle, adaptive=adaptive)
+    if probe_order == 'route':
+        pts = pts[probe_route(pts)]
+    seconds, travel = probe_time(pts, feed, seek, travel_height, safe_height, config, \
+            probe_cycle=probe_cycle, adaptive=adaptive)
+    print(f"estimated probing time {seconds / 60:.1f} min for {len(pts)} probes with {travel:.0f} mm of travel" \
+            + (f", {(zig_zag_seconds - seconds) / 60:.1f} min less than the zig zag" if probe_order == 'route' else ''))
+    if probe_cycle is not None and (probe_cycle.get('fast_feed') or 0) > 0:
+        single_seconds, _ = probe_time(pts, feed, seek, travel_height, safe_height, config)
+        print(f"the fast then slow probe cycle saves {(single_seconds - seconds) / 60:.1f} min " \
+                f"over probing all the way down at F{seek / 2}")
+    return pts
+
+
+def approach_height(x: float, y: float, probed: list, travel_height: int, clearance: float, k: int = 3) -> float:
+    """Z to rapid down to before probing at x, y, clearance above the
+    highest of the k nearest probes already made, or None to probe from the
+    travel height."""
+    if probed is None or len(probed) == 0:
+        return None
+    probed = np.asarray(probed, dtype=float)
+    nearest = np.argsort(np.hypot(probed[:, 0] - x, probed[:, 1] - y))[:k]
+    z = probed[nearest, 2].max() + clearance
+    return z if z < travel_height else None
+
+
+def probe_gcode(pts: np.ndarray, feed: int, seek: int, probe_depth: int, travel_height: int, \
+        safe_height: int, probe_cycle: dict = None, probed: list = None) -> typing.Iterator[str]:
+    """The lines of gcode that probe at each x, y of pts in turn. With a
+    probe_cycle fast_feed each point is probed fast, backed off by the
+    retract and probed again at the slow_feed, after a rapid down to the
+    approach_height over the x, y, z in probed. probed is read as the lines
+    are generated, so a live session can append to it as probes come in."""
+    probe_cycle = probe_cycle or {}
+    # preamble
+    # we do this in machine coordinates
+    yield "G90 G21 G17"
+    fine_seek = probe_cycle.get('slow_feed') or seek / 2
+    fast_seek = probe_cycle.get('fast_feed') or 0
+    # travel to safe height
+    yield f"G0 Z{safe_height} F{seek}"
+
+    for x, y in pts:
+        yield f"G1 X{x:0.4f} Y{y:0.4f} F{feed}"
+        if fast_seek > 0:
+            z = approach_height(x, y, probed, travel_height, probe_cycle.get('clearance', 0.5))
+            if z is not None:
+                yield f"G0 Z{z:0.3f} F{seek}"
+            yield f"G38.2 Z{probe_depth} F{fast_seek}"
+            yield f"G91 G0 Z{probe_cycle.get('retract', 0.5)} F{seek}"
+            yield f"G90 G38.2 Z{probe_depth} F{fine_seek}"
+        else:
+            yield f"G38.2 Z{probe_depth} F{fine_seek}"
+        yield f"G0 Z{travel_height} F{seek}"
+
+    yield f"G0 Z{safe_height} F{seek}"
+
+
+def write_probe_gcode(output_gcode_filename: str, pts: np.ndarray, \
+        feed: int, seek: int, probe_depth: int, travel_height: int, safe_height: int, \
+        probe_cycle: dict = None, probed: list = None):
+    """Write gcode that probes at each x, y of pts in turn."""
+    with open(output_gcode_filename, 'w') as gcode:
+        for line in probe_gcode(pts, feed, seek, probe_depth, travel_height, safe_height, probe_cycle, probed):
+            gcode.write(line + "\n")
+
+
+def probe_grid(lim: (int, int), div: (int, int), config: dict = None) -> (np.ndarray, np.ndarray):
+    """The x and y axes of the probe grid over lim."""
+    xv = np.linspace(0, lim[0], div[0])
+    yv = np.linspace(0, lim[1], div[1])
+    if config is not None:
+        # probe where the motors can actually stop so the mesh has the
+        # same coordinates as the gcode asked for
+        steps = qtdraw_config.steps_per_mm(config)
+        xv = np.round(xv * steps['X']) / steps['X']
+        yv = np.round(yv * steps['Y']) / steps['Y']
+    return xv, yv
+
+
+def mesh_probes(mesh_filename: str, offset: (float, float)) -> list:
+    """The machine x, y, z of the probes in a mesh tsv written by the probe
+    mode, with the probe offset taken off again, none if there is no tsv."""
+    if not os.path.exists(mesh_filename) or os.path.getsize(mesh_filename) == 0:
+        return []
+    return list(qtdraw_meshfile.tsv_read(mesh_filename) - (offset[0], offset[1], 0))
+
+
+def probed_points(pts: np.ndarray, probed: list, tolerance: float = 0.01) -> np.ndarray:
+    """Which of pts already have a probe in probed, so an interrupted run
+    can resume."""
+    if len(probed) == 0:
+        return np.zeros(len(pts), dtype=bool)
+    import scipy.spatial
+    xy = np.asarray(probed)[:, :2]
+    return scipy.spatial.KDTree(xy).query(pts, distance_upper_bound=tolerance)[0] < np.inf
+
+
+def fine_axis(v: np.ndarray, factor: int) -> np.ndarray:
+    """An axis with factor - 1 evenly spaced nodes added in every interval,
+    the coarse nodes are at every factor-th index."""
+    t = np.arange(factor) / factor
+    return np.append((v[:-1, None] + t * np.diff(v)[:, None]).ravel(), v[-1])
+
+
+def cell_max(nodes: np.ndarray, factor: int) -> np.ndarray:
+    """The max over the fine nodes of each coarse cell, edges included."""
+    nx, ny = (nodes.shape[0] - 1) // factor, (nodes.shape[1] - 1) // factor
+    cells = np.full((nx, ny), -np.inf)
+    for a in range(factor + 1):
+        for b in range(factor + 1):
+            cells = np.maximum(cells, nodes[a:a + nx * factor:factor, b:b + ny * factor:factor])
+    return cells
+
+
+def refine_plan(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, factor: int, threshold: float) \
+        -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """Pick the coarse cells worth probing at factor times the density. The
+    error of a cell is estimated as the largest difference between the
+    linear interpolation the remapper does and a cubic spline through the
+    coarse probes, over the fine nodes of the cell. Returns the fine axes,
+    the estimate per cell and a mask of the fine nodes to probe, which are
+    all the nodes of the cells above threshold but the coarse ones."""
+    import scipy.interpolate
+    fxv, fyv = fine_axis(xv, factor), fine_axis(yv, factor)
+    fx, fy = np.meshgrid(fxv, fyv, indexing='ij')
+    linear = scipy.interpolate.RegularGridInterpolator((xv, yv), z)(np.column_stack((fx.ravel(), fy.ravel())))
+    k = min(3, len(xv) - 1, len(yv) - 1)
+    cubic = scipy.interpolate.RectBivariateSpline(xv, yv, z, kx=k, ky=k).ev(fx.ravel(), fy.ravel())
+    estimate = cell_max(np.abs(cubic - linear).reshape(fx.shape), factor)
+
+    probe = np.zeros(fx.shape, dtype=bool)
+    nx, ny = estimate.shape
+    for a in range(factor + 1):
+        for b in range(factor + 1):
+            probe[a:a + nx * factor:factor, b:b + ny * factor:factor] |= estimate > threshold
+    probe[::factor, ::factor] = False
+    return fxv, fyv, estimate, probe
+
+
+def merge_refined(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, refined: np.ndarray, factor: int) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+    """Put the coarse mesh and the refine pass x, y, z probes on the fine
+    grid. Fine nodes that weren't probed are in cells judged flat enough
+    and get the linear interpolation of the coarse mesh."""
+    import scipy.interpolate
+    fxv, fyv = fine_axis(xv, factor), fine_axis(yv, factor)
+    fx, fy = np.meshgrid(fxv, fyv, indexing='ij')
+    fz = scipy.interpolate.RegularGridInterpolator((xv, yv), z)(np.column_stack((fx.ravel(), fy.ravel()))) \
+            .reshape(fx.shape)
+    fz[::factor, ::factor] = z
+    # snap the probes to the nearest fine node
+    i = np.abs(refined[:, 0, None] - fxv).argmin(axis=1)
+    j = np.abs(refined[:, 1, None] - fyv).argmin(axis=1)
+    step = min(np.diff(fxv).min(), np.diff(fyv).min())
+    off_grid = np.hypot(refined[:, 0] - fxv[i], refined[:, 1] - fyv[j]) > step / 2
+    if off_grid.any():
+        raise ValueError(f"{off_grid.sum()} refine probes are off the fine grid, first at {refined[off_grid][0, :2]}, " \
+                "check --refine_factor matches the refine pass")
+    fz[i, j] = refined[:, 2]
+    return fxv, fyv, fz
+
 
 @click.command()
 @click.option('--work-mode', default=WorkMode.gcode, \
@@ -29,92 +307,263 @@ class WorkMode(enum.Enum):
         help='Max probe depth from 0')
 @click.option('--travel_height', type=int, default=2, \
         help='Travel height for Z from sample to sample')
+@click.option('--probe_order', type=click.Choice(['route', 'zigzag']), default='route', \
+        help='Probe in a route optimized for short travel or in an X major zig zag')
+@click.option('--probe_fast_feed', type=float, default=0, \
+        help='Z feed of a fast first probe, backed off and probed again at the slow feed, 0 probes once')
+@click.option('--probe_slow_feed', type=float, default=None, \
+        help='Z feed of the probe that is measured, half the seek rate if not given')
+@click.option('--probe_retract', type=float, default=0.5, \
+        help='How far to back off after the fast probe in mm')
+@click.option('--probe_clearance', type=float, default=0.5, \
+        help='With a fast feed, rapid down to this far above the highest nearby probe already made before probing')
 @click.option('--safe_height', type=int, default=15, \
         help='Safe height after meshing')
-@click.option('--output_mesh_filename', type=str, default='qtdraw_mesh.tsv')
+@click.option('--output_mesh_filename', type=str, default='qtdraw_mesh.npz', \
+        help='Mesh to write, an .npz or a .tsv to export')
 @click.option('--input_log_filename', type=str, default='qtdraw_mesh.log')
 @click.option('--output_gcode_filename', type=str, default='qtdraw_mesh.gcode')
 @click.option('--probe_x_offset', type=int, default=22)
 @click.option('--probe_y_offset', type=int, default=27)
+@click.option('--machine_config', type=str, default=None, \
+        help='FluidNC config.yaml, probe points are rounded to whole motor steps of its axes')
+@click.option('--port', type=str, default='qtdraw.local:23', \
+        help='Controller to probe with, host:port of its telnet server or a serial port')
+@click.option('--baudrate', type=int, default=115200, \
+        help='Baud rate of a serial port')
+@click.option('--probe_timeout', type=float, default=120, \
+        help='Seconds to wait for the controller to acknowledge a line')
+@click.option('--resume/--no-resume', default=True, \
+        help='Skip the points already in the output mesh of an interrupted probe run')
+@click.option('--simulate/--no-simulate', default=False, \
+        help='Probe a synthetic bed on a simulated controller instead of the port')
+@click.option('--input_mesh_filename', type=str, default='qtdraw_mesh.coarse.npz', \
+        help='Coarse mesh to refine or merge with the refine pass')
+@click.option('--input_refine_filename', type=str, default='qtdraw_mesh.refine.npz', \
+        help='Parsed probes of the refine pass to merge')
+@click.option('--refine_factor', type=int, default=2, \
+        help='Times the coarse density the refined cells are probed at')
+@click.option('--refine_threshold', type=float, default=0.02, \
+        help='Estimated interpolation error in mm above which a cell is refined')
 #@click.option('', type=int, default=)
+@qtdraw_profile.profiled('qtdraw_mesh')
 def qt_mesh(lim, div, \
-        feed, seek, probe_depth, travel_height, safe_height, \
+        feed, seek, probe_depth, travel_height, probe_order, \
+        probe_fast_feed, probe_slow_feed, probe_retract, probe_clearance, safe_height, \
         output_mesh_filename, input_log_filename, output_gcode_filename, \
-        probe_x_offset, probe_y_offset, work_mode: WorkMode):
+        probe_x_offset, probe_y_offset, machine_config, \
+        port, baudrate, probe_timeout, resume, simulate, \
+        input_mesh_filename, input_refine_filename, refine_factor, refine_threshold, \
+        work_mode: WorkMode, profiler: qtdraw_profile.Profile):
     """Do one of several different tasks related to mapping a bed
     and remapping G-code (gcode, GCODE, whatever) in the Z axis.
 
     gcode mode:
     Generate G-code for fluidnc. Should work with a lot of grbl.
+    The probes are put in a short travel route unless probe_order is
+    zigzag, and the probing time is estimated from the feeds and the
+    machine config accelerations. With a probe_fast_feed each point is
+    probed fast, backed off and probed again slowly; in the probe and
+    refine modes the fast probe starts just above the nearby probes
+    already made.
+
+    probe:
+    Probe the grid of the gcode mode on the controller at port, sending
+    a line when the last one is acknowledged, and write the mesh as the
+    PRB reports come in. A run that stops is resumed by running it
+    again. simulate probes a synthetic bed offline instead.
 
     parse:
-    Parse the output to a mesh file from std in or a file. Assumes
+    Parse the output to a mesh file from std in, input_log_filename -,
+    or a file. Only the PRB reports are used, failed probes are
+    rejected and other lines are skipped. Assumes
     global position in PRB as the custom from fluidnc. Outputs a 
     table that can be used for down stream operations or in spread
     sheet stuff or whatever.
 
+    refine:
+    Generate G-code for a second probing pass over a coarse mesh, only
+    probing the cells where linear interpolation is estimated to be off
+    by more than the threshold, at refine_factor times the density.
+
+    merge:
+    Merge the coarse mesh and the parsed refine pass into one mesh on
+    the fine grid, for the remap and plot tools.
+
+    simulate:
+    Run the coarse and refine passes against a synthetic bed offline
+    and compare the remap error and probe count with a uniform mesh.
+
     remap:
     Take a map from a tsv and a gcode file and remap the z axis
     onto the bed mesh using a very simple approach that only uses
-    lines. NO ARCS.  Yet, but that is a goal.
+    lines. Arcs (G2/G3) are linearized into chords within a tolerance
+    before they are remapped.
     """
 
+    # scipy, asyncio and the like are imported by the work modes that use
+    # them, so the light ones start fast
+    probe_cycle = { \
+        'fast_feed': probe_fast_feed, \
+        'slow_feed': probe_slow_feed, \
+        'retract': probe_retract, \
+        'clearance': probe_clearance, \
+    }
+
     if (work_mode == WorkMode.gcode):
-        xv = np.linspace(0, lim[0], div[0])
-        yv = np.linspace(0, lim[1], div[1])
+        config = None
+        if machine_config is not None:
+            config = qtdraw_config.machine_config_read(machine_config)
+        xv, yv = probe_grid(lim, div, config)
 
         print(f"generating {div[0] * div[1]} points on a grid from ({xv[0]},{yv[0]}) to ({xv[-1]},{yv[-1]}) and saving to '{output_gcode_filename}'")
 
-        with open(output_gcode_filename, 'w') as gcode:
-            # preamble
-            # we do this in machine coordinates
-            gcode.write(f"G90 G21 G17\n")
-            fine_seek = seek / 2
-            # travel to safe height
-            gcode.write(f"G0 Z{safe_height} F{seek}\n")
-
-
-            def write_probe_at_xy(x, y):
-                gcode.write(f"G1 X{x:0.4f} Y{y:0.4f} F{feed}\n")
-                gcode.write(f"G38.2 Z{probe_depth} F{fine_seek}\n")
-                gcode.write(f"G0 Z2 F{seek}\n")
-
-            # traverse the matrix but zig zag
-            for i, x in enumerate(xv):
-                if i % 2 == 0:
-                    for y in yv:
-                        write_probe_at_xy(x, y)
-                else:
-                    for y in reversed(yv):
-                        write_probe_at_xy(x, y)
-
-            gcode.write(f"G0 Z{safe_height} F{seek}\n")
+        with profiler.stage('generate'), profiler.hot():
+            pts = order_probes(zig_zag(xv, yv), probe_order, feed, seek, travel_height, safe_height, config, probe_cycle)
+            write_probe_gcode(output_gcode_filename, pts, feed, seek, probe_depth, travel_height, safe_height, probe_cycle)
+        profiler.counts['points'] += len(xv) * len(yv)
+    elif (work_mode == WorkMode.probe):
+        import asyncio
+        import qtdraw_probe
+        config = None
+        if machine_config is not None:
+            config = qtdraw_config.machine_config_read(machine_config)
+        xv, yv = probe_grid(lim, div, config)
+        # the approach heights come from the probes as they come in
+        pts = order_probes(zig_zag(xv, yv), probe_order, feed, seek, travel_height, safe_height, config, \
+                probe_cycle, adaptive=True)
+        # probes go to a tsv as they come in, an npz mesh is written from it at the end
+        probing_filename = output_mesh_filename if not qtdraw_meshfile.is_npz(output_mesh_filename) \
+                else os.path.splitext(output_mesh_filename)[0] + '.probing.tsv'
+        probed = mesh_probes(probing_filename, (probe_x_offset, probe_y_offset)) if resume else []
+        done = probed_points(pts, probed)
+        if done.any():
+            print(f"resuming, {done.sum()} of {len(pts)} points are already in '{probing_filename}'")
+        pts = pts[~done]
+
+        print(f"probing {len(pts)} points on {'a simulated controller' if simulate else port}, " \
+                f"writing the probes to '{probing_filename}' as they come in")
+        with open(probing_filename, 'a' if done.any() else 'w') as mesh:
+            if not done.any():
+                mesh.write("x\ty\tz\n")
+
+            # the fast probe of a two stage cycle is followed by the one that counts
+            stages = 2 if probe_cycle['fast_feed'] > 0 else 1
+            reports = [0]
+
+            def on_probe(xyz: (float, float, float)):
+                reports[0] += 1
+                if reports[0] % stages != 0:
+                    return
+                probed.append(xyz)
+                # flushed so a run that stops halfway can resume
+                mesh.write(f"{xyz[0] + probe_x_offset}\t{xyz[1] + probe_y_offset}\t{xyz[2]}\n")
+                mesh.flush()
+                profiler.counts['points'] += 1
+
+            simulated = qtdraw_probe.SimulatedController(lim) if simulate else None
+            if len(pts) == 0:
+                print(f"all points are already in '{probing_filename}'")
+            lines = probe_gcode(pts, feed, seek, probe_depth, travel_height, safe_height, probe_cycle, probed)
+            try:
+                with profiler.stage('probe'):
+                    session = asyncio.run(qtdraw_probe.probe_session(port, lines, on_probe, baudrate, \
+                            probe_timeout, simulated)) if len(pts) > 0 else None
+            except (OSError, RuntimeError) as e:
+                raise click.ClickException(f"probing stopped: {e}, run again to resume '{probing_filename}'")
+        if session is not None:
+            print(f"probed {session.probes // stages} points with {session.lines} lines of gcode")
+            if session.failed > 0:
+                print(f"rejected {session.failed} probes that didn't touch the bed")
+        if probing_filename != output_mesh_filename:
+            print(f"writing mesh to '{output_mesh_filename}'")
+            qtdraw_meshfile.mesh_write(output_mesh_filename, qtdraw_meshfile.tsv_read(probing_filename), \
+                    qtdraw_meshfile.mesh_metadata((probe_x_offset, probe_y_offset), machine_config, source=port))
+            os.remove(probing_filename)
     elif (work_mode == WorkMode.parse):
+        import qtdraw_probe
         print(f"parsing mesh data from log in '{input_log_filename}'")
-        mesh_data = []
-        with open(input_log_filename, 'r') as log:
-          for line in log.readlines():
-            line = line.strip()
-            #print(line)
-            if not line.startswith("[PRB:"):
-                #raise ValueError(f"unable to find probe prefix '[PRB:' at start of data: {line}")
-                print(f"ignoring line that doesn't look like a PRB line: {line}")
-            colon_fields = line.split(":")
-            if len(colon_fields) != 3:
-                raise ValueError(f"expected 3 fields in probe data after split on ':', found {len(colon_fields)}, in data: {line}")
-            xyz = colon_fields[1].split(",")
-            if len(xyz) != 3:
-                raise ValueError(f"expected 3 fields (x, y, z) in second : split field when splitting on ',', found {len(xyz)} in data: {line}")
-            if colon_fields[2] != "1]":
-                raise ValueError(f"expected to find true (1) value at probe success field in data, found: {colon_fields[2]} in data: {line}")
-            #print(f"x = {xyz[0]}, y = {xyz[1]}, z = {xyz[2]}")
-            mesh_data.append(xyz)
-
-        df = pd.DataFrame(mesh_data, columns=("x", "y", "z"), dtype=float)
-        print(f"writing mesh x,y,z data to '{output_mesh_filename}")
-        df["x"] = df["x"] + probe_x_offset
-        df["y"] = df["y"] + probe_y_offset
-        df.to_csv(output_mesh_filename, sep='\t', header=True, index=False)
+        with profiler.stage('parse'), profiler.hot():
+            if input_log_filename == '-':
+                xyz, skipped, failed = qtdraw_probe.prb_read(sys.stdin.buffer)
+            else:
+                with open(input_log_filename, 'rb') as log:
+                    xyz, skipped, failed = qtdraw_probe.prb_read(log)
+        print(f"found {len(xyz)} probes, skipped {skipped} lines that aren't PRB reports")
+        if failed > 0:
+            print(f"rejected {failed} probes that didn't touch the bed")
+
+        print(f"writing mesh x,y,z data to '{output_mesh_filename}'")
+        with profiler.stage('write'):
+            qtdraw_meshfile.mesh_write(output_mesh_filename, xyz + (probe_x_offset, probe_y_offset, 0), \
+                    qtdraw_meshfile.mesh_metadata((probe_x_offset, probe_y_offset), machine_config, \
+                    source=input_log_filename))
+        profiler.counts['points'] += len(xyz)
+        profiler.counts['lines'] += len(xyz) + failed + skipped
+    elif (work_mode == WorkMode.refine):
+        xv, yv, z = qtdraw_meshfile.mesh_read(input_mesh_filename)
+        with profiler.stage('refine'):
+            fxv, fyv, estimate, probe = refine_plan(xv, yv, z, refine_factor, refine_threshold)
+        print(f"{(estimate > refine_threshold).sum()} of {estimate.size} cells have an estimated interpolation error " \
+                f"over {refine_threshold} mm, the largest is {estimate.max():.4f} mm")
+        # the mesh has the probe offsets added, the gcode moves the machine
+        pts = zig_zag(fxv, fyv, probe) - (probe_x_offset, probe_y_offset)
+        config = None
+        if machine_config is not None:
+            config = qtdraw_config.machine_config_read(machine_config)
+            steps = qtdraw_config.steps_per_mm(config)
+            pts = np.round(pts * (steps['X'], steps['Y'])) / (steps['X'], steps['Y'])
+        print(f"generating {len(pts)} refine points and saving to '{output_gcode_filename}'")
+        # approach from just above the coarse mesh around each refine point
+        coarse = list(qtdraw_meshfile.grid_probes(xv, yv, z) - (probe_x_offset, probe_y_offset, 0))
+        with profiler.stage('generate'):
+            pts = order_probes(pts, probe_order, feed, seek, travel_height, safe_height, config, \
+                    probe_cycle, adaptive=True)
+            write_probe_gcode(output_gcode_filename, pts, feed, seek, probe_depth, travel_height, safe_height, \
+                    probe_cycle, coarse)
+        profiler.counts['points'] += len(pts)
+    elif (work_mode == WorkMode.merge):
+        xv, yv, z = qtdraw_meshfile.mesh_read(input_mesh_filename)
+        refined, metadata = qtdraw_meshfile.probes_read(input_refine_filename)
+        with profiler.stage('merge'):
+            fxv, fyv, fz = merge_refined(xv, yv, z, refined, refine_factor)
+        print(f"merged {len(refined)} refine probes from '{input_refine_filename}' with {z.size} coarse probes " \
+                f"onto a {len(fxv)} x {len(fyv)} mesh")
+        print(f"writing mesh x,y,z data to '{output_mesh_filename}'")
+        with profiler.stage('write'):
+            qtdraw_meshfile.mesh_write(output_mesh_filename, qtdraw_meshfile.grid_probes(fxv, fyv, fz), \
+                    {**metadata, 'merged': [input_mesh_filename, input_refine_filename]})
+        profiler.counts['points'] += fz.size
+    elif (work_mode == WorkMode.simulate):
+        import scipy.interpolate
+        import qtdraw_synthetic
+        def bed(x, y):
+            return qtdraw_synthetic.synthetic_surface(x, y, lim)
+        xv = np.linspace(0, lim[0], div[0])
+        yv = np.linspace(0, lim[1], div[1])
+        z = bed(*np.meshgrid(xv, yv, indexing='ij'))
+        fxv, fyv, estimate, probe = refine_plan(xv, yv, z, refine_factor, refine_threshold)
+        fx, fy = np.meshgrid(fxv, fyv, indexing='ij')
+        refined = np.column_stack((fx[probe], fy[probe], bed(fx[probe], fy[probe])))
+        _, _, fz = merge_refined(xv, yv, z, refined, refine_factor)
+        print(f"refining {(estimate > refine_threshold).sum()} of {estimate.size} cells of a synthetic bed " \
+                f"over {refine_threshold} mm estimated error")
+
+        # how far off the remap would be between the probes
+        pts = np.random.default_rng(0).uniform((0, 0), lim, (100000, 2))
+        bed_z = bed(pts[:, 0], pts[:, 1])
+        for name, mesh, probes in (('coarse', (xv, yv, z), z.size), \
+                ('adaptive', (fxv, fyv, fz), z.size + len(refined)), \
+                ('fine', (fxv, fyv, bed(fx, fy)), fx.size)):
+            error = scipy.interpolate.RegularGridInterpolator(mesh[:2], mesh[2])(pts) - bed_z
+            print(f"{name:>9} mesh {probes:>5} probes, remap error rms {np.sqrt(np.mean(error ** 2)):.4f} " \
+                    f"max {np.abs(error).max():.4f} mm")
+
+
+def work_mode_command(work_mode: WorkMode, name: str, help: str) -> click.Command:
+    """qt_mesh with the work mode fixed, as a subcommand of qtdraw."""
+    return click.Command(name, params=[param for param in qt_mesh.params if param.name != 'work_mode'], \
+            callback=functools.partial(qt_mesh.callback, work_mode=work_mode), help=help)
 
 
 if __name__ == '__main__':
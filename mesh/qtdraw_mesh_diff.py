@@ -3,71 +3,89 @@
 import math
 
 import click
-import pandas as pd
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
-import matplotlib.pyplot as plt
+import numpy as np
 
-def mesh_read(input_filename: str) -> pd.DataFrame:
-    df = pd.read_csv(input_filename, sep='\t', usecols=('x','y','z'))
-    print(f"found a mesh in '{input_filename}' of size {df.size} with {df.shape[0]} rows and {df.shape[1]} cols")
-    return df
+import qtdraw_mesh_plot
+import qtdraw_meshfile
+import qtdraw_profile
 
 
 @click.command()
 @click.option('--output_filename', type=str, default='qtdraw_mesh.diff.png')
-@click.option('--input_a_filename', type=str, default='qtdraw_mesh.tsv')
-@click.option('--input_b_filename', type=str, default='qtdraw_mesh.previous.tsv')
-def qtdraw_mesh_diff(output_filename: str, input_a_filename: str, input_b_filename: str):
+@click.option('--input_a_filename', type=str, default='qtdraw_mesh.npz', help='probed mesh, .npz or .tsv')
+@click.option('--input_b_filename', type=str, default='qtdraw_mesh.previous.npz', help='probed mesh, .npz or .tsv')
+@click.option('--style', type=click.Choice(['3d', 'heatmap']), default='3d', help='3D surfaces, or a quick 2D heatmap of the difference')
+@click.option('--show/--no-show', default=True, help='open a window with the plot after saving it, --no-show for batch jobs')
+@qtdraw_profile.profiled('qtdraw_mesh_diff')
+def qtdraw_mesh_diff(output_filename: str, input_a_filename: str, input_b_filename: str, \
+        style: str, show: bool, profiler: qtdraw_profile.Profile):
     """Read two mesh files and output a new mesh file with the difference of A - B."""
-    mesh_A = mesh_read(input_a_filename)
-    mesh_A = mesh_A.sort_values(by=['x', 'y'])
-    mesh_B = mesh_read(input_b_filename)
-    mesh_B = mesh_B.sort_values(by=['x', 'y'])
-    mesh = mesh_A.sub(mesh_B)
-    if max(mesh['x'])-min(mesh['x']) > .001:
+    # matplotlib is imported when plotting so --help stays quick
+    import matplotlib
+    if not show:
+        # nothing to show, so don't ask for a display
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    with profiler.stage('read'):
+        xv, yv, z_A = qtdraw_meshfile.mesh_read(input_a_filename)
+        xv_B, yv_B, z_B = qtdraw_meshfile.mesh_read(input_b_filename)
+    profiler.counts['mesh_points'] += z_A.size + z_B.size
+    if z_A.shape != z_B.shape:
+        raise ValueError(f"meshes are {z_A.shape[0]} x {z_A.shape[1]} and {z_B.shape[0]} x {z_B.shape[1]}")
+    if np.abs(xv - xv_B).max() > .001:
         raise ValueError("too much misalignment between x coordinates in meshes")
-    if max(mesh['y'])-min(mesh['y']) > .001:
+    if np.abs(yv - yv_B).max() > .001:
         raise ValueError("too much misalignment between y coordinates in meshes")
-    # move over the actual x y coords
-    mesh['x'] = mesh_A['x']
-    mesh['y'] = mesh_A['y']
-    print(f"range of z difference is {(max(mesh['z'])-min(mesh['z'])):0.4f} mm")
+    z = z_A - z_B
+    print(f"range of z difference is {(z.max()-z.min()):0.4f} mm")
 
-    xv = mesh['x'].unique()
-    yv = mesh['y'].unique()
-    shape = (len(xv), len(yv))
-    x = mesh['x'].to_numpy().reshape(shape)
-    y = mesh['y'].to_numpy().reshape(shape)
-    z = mesh['z'].to_numpy().reshape(shape)
+    if style == 'heatmap':
+        with profiler.stage('plot'):
+            fig = plt.figure(figsize=(6, 5))
+            qtdraw_mesh_plot.heatmap_draw(fig, xv, yv, z, \
+                    f"{input_a_filename} - {input_b_filename}, range {np.ptp(z):.3f} mm", 'Z difference (mm)')
+        print(f"saving to '{output_filename}'")
+        with profiler.stage('render'), profiler.hot():
+            plt.savefig(output_filename)
+        if show:
+            plt.show()
+        return
 
-    fig = plt.figure(figsize=plt.figaspect(0.5))
+    from mpl_toolkits.mplot3d import Axes3D
+    from matplotlib import cm
+    from matplotlib.ticker import LinearLocator, FormatStrFormatter
+    # on the actual x y coords of A
+    x, y = np.meshgrid(xv, yv, indexing='ij')
 
-    ax = fig.add_subplot(1, 2, 1, projection='3d')
-    surf = ax.plot_surface(x, y, z, \
-        cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
-    ax.set_zlim(z.min()-2, z.max()+2)
-    ax.zaxis.set_major_locator(LinearLocator(11))
-    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    ax.invert_xaxis()
-    fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
+    with profiler.stage('plot'):
+        fig = plt.figure(figsize=plt.figaspect(0.5))
 
-    ax = fig.add_subplot(1, 2, 2, projection='3d')
-    surf = ax.plot_surface(x, y, z, \
-        cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
-    ax.zaxis.set_major_locator(LinearLocator(11))
-    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    ax.invert_xaxis()
-    fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
+        ax = fig.add_subplot(1, 2, 1, projection='3d')
+        surf = ax.plot_surface(x, y, z, \
+            cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
+        ax.set_zlim(z.min()-2, z.max()+2)
+        ax.zaxis.set_major_locator(LinearLocator(11))
+        ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
+        plt.xlabel("X")
+        plt.ylabel("Y")
+        ax.invert_xaxis()
+        fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
+
+        ax = fig.add_subplot(1, 2, 2, projection='3d')
+        surf = ax.plot_surface(x, y, z, \
+            cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
+        ax.zaxis.set_major_locator(LinearLocator(11))
+        ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
+        plt.xlabel("X")
+        plt.ylabel("Y")
+        ax.invert_xaxis()
+        fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
 
     print(f"saving to '{output_filename}'")
-    plt.savefig(output_filename)
-    plt.show()
+    with profiler.stage('render'), profiler.hot():
+        plt.savefig(output_filename)
+    if show:
+        plt.show()
 
 if __name__ == '__main__':
     qtdraw_mesh_diff()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""A history of probed bed meshes for tracking drift and repeatability. Each
+mesh is resampled onto the grid of the first one and appended to a raw
+float64 file of Z grids, with its timestamp appended to another, so the
+whole history is memory mapped as an (n, nx, ny) array and the statistics
+over any window of runs are numpy reductions along its first axis."""
+
+import datetime
+import enum
+import glob
+import os
+
+import click
+import numpy as np
+
+import qtdraw_meshfile
+import qtdraw_profile
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class WorkMode(enum.Enum):
+    append = enum.auto()
+    stats = enum.auto()
+    reference = enum.auto()
+
+
+class MeshHistory:
+    """The history in a directory: grid.npz with the x and y axes of the
+    common grid, z.f64 with one Z grid per run, t.f64 with the seconds since
+    the epoch of each run and runs.tsv naming where each run came from.
+    Grids and times are only ever appended, a run counts once both are
+    complete so an interrupted append is written over by the next."""
+
+    def __init__(self, history_dir: str):
+        self.history_dir = history_dir
+        self.xv = self.yv = None
+        self.probe_offset = (0, 0)
+        if os.path.exists(self.path('grid.npz')):
+            with np.load(self.path('grid.npz')) as grid:
+                self.xv, self.yv, self.probe_offset = grid['xv'], grid['yv'], tuple(grid['probe_offset'])
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.history_dir, name)
+
+    def __len__(self) -> int:
+        if self.xv is None:
+            return 0
+        grids = os.path.getsize(self.path('z.f64')) // (8 * len(self.xv) * len(self.yv))
+        return min(grids, os.path.getsize(self.path('t.f64')) // 8)
+
+    def z(self) -> np.ndarray:
+        """The Z grids of all runs, memory mapped."""
+        if len(self) == 0:
+            return np.empty((0, 0, 0))
+        return np.memmap(self.path('z.f64'), dtype='<f8', mode='r', shape=(len(self), len(self.xv), len(self.yv)))
+
+    def t(self) -> np.ndarray:
+        """The seconds since the epoch of all runs, memory mapped."""
+        if len(self) == 0:
+            return np.empty(0)
+        return np.memmap(self.path('t.f64'), dtype='<f8', mode='r', shape=(len(self),))
+
+    def append(self, xv: np.ndarray, yv: np.ndarray, z: np.ndarray, timestamp: float, source: str, \
+            probe_offset: (float, float) = (0, 0)) -> int:
+        """Add a run, resampled onto the common grid, which the first run
+        sets along with the probe offset of the history. Grid points outside
+        a run's mesh are NaN. Returns the index of the run."""
+        if self.xv is None:
+            os.makedirs(self.history_dir, exist_ok=True)
+            np.savez(self.path('grid.npz'), xv=xv, yv=yv, probe_offset=np.asarray(probe_offset, dtype=float))
+            self.probe_offset = tuple(probe_offset)
+            for name in ('z.f64', 't.f64'):
+                open(self.path(name), 'wb').close()
+            with open(self.path('runs.tsv'), 'w') as output:
+                output.write("run\ttimestamp\tsource\n")
+            self.xv, self.yv = np.asarray(xv, dtype=float), np.asarray(yv, dtype=float)
+        z = mesh_resample(xv, yv, z, self.xv, self.yv)
+        n = len(self)
+        # drop what an interrupted append left past the last complete run
+        with open(self.path('z.f64'), 'r+b') as output:
+            output.truncate(8 * n * z.size)
+            output.seek(0, os.SEEK_END)
+            output.write(z.astype('<f8').tobytes())
+        with open(self.path('t.f64'), 'r+b') as output:
+            output.truncate(8 * n)
+            output.seek(0, os.SEEK_END)
+            output.write(np.array([timestamp], dtype='<f8').tobytes())
+        with open(self.path('runs.tsv'), 'a') as output:
+            when = datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+            output.write(f"{n}\t{when}\t{source}\n")
+        return n
+
+
+def mesh_resample(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, to_xv: np.ndarray, to_yv: np.ndarray) -> np.ndarray:
+    """z over xv, yv linearly interpolated onto the to_xv, to_yv grid, NaN
+    outside the mesh."""
+    if len(xv) == len(to_xv) and len(yv) == len(to_yv) and \
+            np.abs(xv - to_xv).max() <= .001 and np.abs(yv - to_yv).max() <= .001:
+        return np.asarray(z, dtype=float)
+    # only a mesh off the common grid needs scipy
+    import scipy.interpolate
+    interpolator = scipy.interpolate.RegularGridInterpolator((xv, yv), z, bounds_error=False, fill_value=np.nan)
+    x, y = np.meshgrid(to_xv, to_yv, indexing='ij')
+    return interpolator((x, y))
+
+
+def mesh_timestamp(filename: str, metadata: dict) -> float:
+    """When a mesh was made, from its metadata or else the file time."""
+    if metadata.get('timestamp'):
+        return datetime.datetime.fromisoformat(metadata['timestamp']).timestamp()
+    return os.path.getmtime(filename)
+
+
+def window_runs(t: np.ndarray, since: datetime.datetime, until: datetime.datetime, last: int) -> np.ndarray:
+    """Indices of the runs between since and until, in time order, and of
+    those only the last ones if last is given."""
+    mask = np.ones(len(t), dtype=bool)
+    if since is not None:
+        mask &= t >= since.timestamp()
+    if until is not None:
+        mask &= t <= until.timestamp()
+    runs = np.flatnonzero(mask)
+    runs = runs[np.argsort(t[runs], kind='stable')]
+    return runs[-last:] if last else runs
+
+
+def history_stats(z: np.ndarray, t: np.ndarray) -> dict:
+    """Per grid point count, mean, standard deviation, min, max and the
+    least squares trend in mm/day of the runs z taken at times t, ignoring
+    the NaN of points a run didn't cover."""
+    valid = ~np.isnan(z)
+    count = valid.sum(axis=0)
+    # nan reductions warn on points no run covered, those come out NaN anyway
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(z, axis=0) / count
+        days = np.where(valid, (t / SECONDS_PER_DAY)[:, None, None], np.nan)
+        days = days - np.nansum(days, axis=0) / count
+        residual = np.where(valid, z - mean, 0)
+        days = np.where(valid, days, 0)
+        std = np.sqrt((residual ** 2).sum(axis=0) / count)
+        trend = (days * residual).sum(axis=0) / (days ** 2).sum(axis=0)
+    return { \
+        'count': count, \
+        'mean': mean, \
+        'std': std, \
+        'min': np.where(count > 0, np.fmin.reduce(z, axis=0), np.nan), \
+        'max': np.where(count > 0, np.fmax.reduce(z, axis=0), np.nan), \
+        'trend': np.where(count > 1, trend, np.nan), \
+    }
+
+
+def closest_run(z: np.ndarray) -> (int, float):
+    """Index into z of the run closest in RMS to the per point median of
+    all of them, the most typical run, and that RMS. Runs that cover the
+    whole grid go first."""
+    with np.errstate(invalid='ignore'):
+        median = np.nanmedian(z, axis=0)
+        rms = np.sqrt(np.nanmean(((z - median) ** 2).reshape((len(z), -1)), axis=1))
+    partial = np.isnan(z).reshape((len(z), -1)).any(axis=1)
+    if not partial.all():
+        rms[partial] = np.inf
+    best = int(np.nanargmin(rms))
+    return best, float(rms[best])
+
+
+@click.command()
+@click.option('--work-mode', default=WorkMode.stats, \
+              type=click.Choice(WorkMode, case_sensitive=False),
+              help='append meshes to the history, report statistics over a window of it or write a reference mesh')
+@click.option('--history_dir', type=str, default='qtdraw_mesh_history', help='directory of the mesh history')
+@click.option('--input_mesh_filename', type=str, multiple=True, default=['qtdraw_mesh.npz'], help='mesh file or glob to append, .npz or .tsv, can be given several times')
+@click.option('--since', type=click.DateTime(), default=None, help='only runs from this time on')
+@click.option('--until', type=click.DateTime(), default=None, help='only runs up to this time')
+@click.option('--last', type=int, default=0, help='only the last this many runs of the window, 0 for all')
+@click.option('--remove_offset/--no-remove_offset', default=True, help='subtract the mean Z of each run first, so a different touch off doesn\'t count as drift')
+@click.option('--output_stats_filename', type=str, default='qtdraw_mesh_history.stats.npz', help='per grid point count, mean, std, min, max and trend of the window')
+@click.option('--reference', type=click.Choice(['closest', 'mean']), default='closest', help='the run closest to the median of the window, or the mean of the window')
+@click.option('--output_mesh_filename', type=str, default='qtdraw_mesh.reference.npz', help='reference mesh to remap with, .npz or .tsv')
+@qtdraw_profile.profiled('qtdraw_mesh_history')
+def qtdraw_mesh_history(work_mode: WorkMode, history_dir: str, input_mesh_filename: (str, ...), \
+        since: datetime.datetime, until: datetime.datetime, last: int, remove_offset: bool, \
+        output_stats_filename: str, reference: str, output_mesh_filename: str, \
+        profiler: qtdraw_profile.Profile):
+    """Keep a history of probed meshes and report how the bed drifts and how
+    repeatable the probing is."""
+    history = MeshHistory(history_dir)
+
+    if (work_mode == WorkMode.append):
+        input_mesh_filenames = []
+        for pattern in input_mesh_filename:
+            matches = sorted(glob.glob(pattern))
+            input_mesh_filenames.extend(matches if len(matches) > 0 else [pattern])
+        with profiler.stage('append'):
+            for filename in input_mesh_filenames:
+                xyz, metadata = qtdraw_meshfile.probes_read(filename)
+                xv, yv, z = qtdraw_meshfile.mesh_grid(xyz)
+                run = history.append(xv, yv, z, mesh_timestamp(filename, metadata), filename, \
+                        metadata.get('probe_offset', (0, 0)))
+                print(f"appended '{filename}' as run {run} of '{history_dir}'")
+        profiler.counts['meshes'] += len(input_mesh_filenames)
+        return
+
+    if len(history) == 0:
+        raise click.ClickException(f"no runs in '{history_dir}', add some with --work-mode append")
+    with profiler.stage('read'):
+        t = np.asarray(history.t())
+        runs = window_runs(t, since, until, last)
+        if len(runs) == 0:
+            raise click.ClickException(f"none of the {len(t)} runs in '{history_dir}' are in the window")
+        z = history.z()[runs]
+        t = t[runs]
+        if remove_offset:
+            z = z - np.nanmean(z.reshape((len(z), -1)), axis=1)[:, None, None]
+    profiler.counts['runs'] += len(runs)
+    first, last_run = (datetime.datetime.fromtimestamp(t[i]).isoformat(timespec='seconds') for i in (0, -1))
+    print(f"{len(runs)} runs of a {len(history.xv)} x {len(history.yv)} grid from {first} to {last_run}")
+
+    if (work_mode == WorkMode.stats):
+        with profiler.stage('stats'), profiler.hot():
+            stats = history_stats(z, t)
+        for name in ('std', 'trend'):
+            i, j = np.unravel_index(np.nanargmax(np.abs(stats[name])), stats[name].shape)
+            print(f"{name}: median {np.nanmedian(stats[name]):.4f} max {stats[name][i, j]:.4f} " \
+                    f"at x {history.xv[i]:.1f} y {history.yv[j]:.1f}" + (" mm/day" if name == 'trend' else " mm"))
+        print(f"range of the mean: {np.nanmax(stats['mean']) - np.nanmin(stats['mean']):.4f} mm")
+        print(f"saving statistics to '{output_stats_filename}'")
+        np.savez(output_stats_filename, xv=history.xv, yv=history.yv, t=t, runs=runs, **stats)
+
+    elif (work_mode == WorkMode.reference):
+        with profiler.stage('reference'), profiler.hot():
+            if reference == 'closest':
+                best, rms = closest_run(z)
+                print(f"run {runs[best]} is the closest to the median of the window, {rms:.4f} mm rms")
+                z_reference = z[best]
+                more = {'history_run': int(runs[best])}
+            else:
+                z_reference = history_stats(z, t)['mean']
+                more = {'history_runs': len(runs)}
+        if np.isnan(z_reference).any():
+            raise click.ClickException("the reference mesh doesn't cover the whole grid, narrow the window")
+        print(f"writing reference mesh to '{output_mesh_filename}'")
+        qtdraw_meshfile.mesh_write(output_mesh_filename, \
+                qtdraw_meshfile.grid_probes(history.xv, history.yv, z_reference), \
+                qtdraw_meshfile.mesh_metadata(history.probe_offset, history_dir=history_dir, reference=reference, **more))
+
+
+if __name__ == '__main__':
+    qtdraw_mesh_history()
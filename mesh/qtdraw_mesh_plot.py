@@ -1,67 +1,138 @@
 #!/usr/bin/env python
 
 import math
+import os
 
 import click
-import pandas as pd
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-from matplotlib.ticker import LinearLocator, FormatStrFormatter
-import matplotlib.pyplot as plt
-
-def mesh_read(input_filename: str) -> pd.DataFrame:
-    df = pd.read_csv(input_filename, sep='\t', usecols=('x','y','z'))
-    print(f"found a mesh in '{input_filename}' of size {df.size} with {df.shape[0]} rows and {df.shape[1]} cols")
+import numpy as np
+
+import qtdraw_meshfile
+import qtdraw_profile
+
+
+def pts_read(input_filename: str) -> 'pd.DataFrame':
+    """Read remapped points from qtdraw_remap_gcode.py in any of its formats."""
+    import pandas as pd
+    extension = os.path.splitext(input_filename)[1].lower()
+    if extension == '.npy':
+        df = pd.DataFrame(np.load(input_filename, mmap_mode='r'), columns=('x', 'y', 'z'))
+    elif extension == '.npz':
+        with np.load(input_filename) as pts:
+            df = pd.DataFrame(pts['pts'], columns=('x', 'y', 'z'))
+    elif extension == '.parquet':
+        df = pd.read_parquet(input_filename, columns=('x', 'y', 'z'))
+    else:
+        df = pd.read_csv(input_filename, sep='\t', usecols=('x', 'y', 'z'))
+    print(f"found {df.shape[0]} points in '{input_filename}'")
     return df
 
 
+def heatmap_draw(fig: 'matplotlib.figure.Figure', xv: np.ndarray, yv: np.ndarray, z: np.ndarray, \
+        title: str, label: str, pts: np.ndarray = None):
+    """Draw z over the xv, yv grid as a 2D heatmap with contour lines and the
+    probe points, on a colour scale symmetric about zero so deviations
+    either way stand out."""
+    ax = fig.add_subplot()
+    limit = max(float(np.abs(z).max()), 1e-3)
+    heatmap = ax.pcolormesh(xv, yv, z.T, cmap='RdBu_r', vmin=-limit, vmax=limit, shading='gouraud')
+    if z.shape[0] > 1 and z.shape[1] > 1 and np.ptp(z) > 0:
+        contours = ax.contour(xv, yv, z.T, levels=8, colors='black', linewidths=0.5)
+        ax.clabel(contours, fontsize=6, fmt='%.2f')
+    ax.scatter(*np.meshgrid(xv, yv, indexing='ij'), color='black', s=2)
+    if pts is not None:
+        ax.scatter(pts[:, 0], pts[:, 1], color='grey', s=0.1)
+    ax.set_aspect('equal')
+    ax.set_xlabel("X")
+    ax.set_ylabel("Y")
+    ax.set_title(title, fontsize=9)
+    fig.colorbar(heatmap, ax=ax, label=label)
+
+
+def heatmap_write(output_filename: str, xv: np.ndarray, yv: np.ndarray, z: np.ndarray, \
+        title: str, label: str, pts: np.ndarray = None, dpi: int = 100):
+    """Save the heatmap_draw of z to a png on an Agg canvas without pyplot,
+    so it needs no display and can run in worker processes side by side."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(6, 5))
+    FigureCanvasAgg(fig)
+    heatmap_draw(fig, xv, yv, z, title, label, pts)
+    fig.savefig(output_filename, dpi=dpi)
+
+
 @click.command()
 @click.option('--output_filename', type=str, default='qtdraw_mesh.png')
-@click.option('--input_filename', type=str, default='qtdraw_mesh.tsv')
+@click.option('--input_filename', type=str, default='qtdraw_mesh.npz', help='probed mesh, .npz or .tsv')
 @click.option('--input_pts_filename', type=str, default=None)
-def qtdraw_mesh_plot(output_filename: str, input_filename: str, input_pts_filename: str):
-    mesh = mesh_read(input_filename)
-    mesh = mesh.sort_values(by=['x', 'y'])
-    print(mesh)
-
-    xv = mesh['x'].unique()
-    yv = mesh['y'].unique()
-    shape = (len(xv), len(yv))
-    x = mesh['x'].to_numpy().reshape(shape)
-    y = mesh['y'].to_numpy().reshape(shape)
-    z = mesh['z'].to_numpy().reshape(shape)
-
-    fig = plt.figure(figsize=plt.figaspect(0.5))
-
-    ax = fig.add_subplot(1, 2, 1, projection='3d')
-    surf = ax.plot_wireframe(x, y, z, \
-        cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
-    if input_pts_filename is not None:
-        pts = mesh_read(input_pts_filename)
-        pts = pts.sort_values(by=['x', 'y'])
-        ax.scatter(pts['x'], pts['y'], pts['z'], color='black', s=1)
-        print(pts)
-    ax.set_zlim(z.min()-2, z.max()+2)
-    ax.zaxis.set_major_locator(LinearLocator(11))
-    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
-
-    ax = fig.add_subplot(1, 2, 2, projection='3d')
-    surf = ax.plot_wireframe(x, y, z, \
-        cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
-    if input_pts_filename is not None:
-        ax.scatter(pts['x'], pts['y'], pts['z'], color='black', s=1)
-    ax.zaxis.set_major_locator(LinearLocator(11))
-    ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
-    plt.xlabel("X")
-    plt.ylabel("Y")
-    fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
+@click.option('--style', type=click.Choice(['3d', 'heatmap']), default='3d', help='3D wireframes, or a quick 2D heatmap of the deviation from the mean Z')
+@click.option('--show/--no-show', default=True, help='open a window with the plot after saving it, --no-show for batch jobs')
+@qtdraw_profile.profiled('qtdraw_mesh_plot')
+def qtdraw_mesh_plot(output_filename: str, input_filename: str, input_pts_filename: str, \
+        style: str, show: bool, profiler: qtdraw_profile.Profile):
+    # matplotlib is imported when plotting so --help stays quick
+    import matplotlib
+    if not show:
+        # nothing to show, so don't ask for a display
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    with profiler.stage('read'):
+        xv, yv, z = qtdraw_meshfile.mesh_read(input_filename)
+        if input_pts_filename is not None:
+            pts = pts_read(input_pts_filename)
+            pts = pts.sort_values(by=['x', 'y'])
+            print(pts)
+            profiler.counts['points'] += len(pts)
+    profiler.counts['mesh_points'] += z.size
+
+    if style == 'heatmap':
+        with profiler.stage('plot'):
+            fig = plt.figure(figsize=(6, 5))
+            heatmap_draw(fig, xv, yv, z - z.mean(), f"{input_filename}, Z range {np.ptp(z):.3f} mm", \
+                    'deviation from the mean Z (mm)', \
+                    None if input_pts_filename is None else pts[['x', 'y']].to_numpy())
+        print(f"saving to '{output_filename}'")
+        with profiler.stage('render'), profiler.hot():
+            plt.savefig(output_filename)
+        if show:
+            plt.show()
+        return
+
+    from mpl_toolkits.mplot3d import Axes3D
+    from matplotlib import cm
+    from matplotlib.ticker import LinearLocator, FormatStrFormatter
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+
+    with profiler.stage('plot'):
+        fig = plt.figure(figsize=plt.figaspect(0.5))
+
+        ax = fig.add_subplot(1, 2, 1, projection='3d')
+        surf = ax.plot_wireframe(x, y, z, \
+            cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
+        if input_pts_filename is not None:
+            ax.scatter(pts['x'], pts['y'], pts['z'], color='black', s=1)
+        ax.set_zlim(z.min()-2, z.max()+2)
+        ax.zaxis.set_major_locator(LinearLocator(11))
+        ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
+        plt.xlabel("X")
+        plt.ylabel("Y")
+        fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
+
+        ax = fig.add_subplot(1, 2, 2, projection='3d')
+        surf = ax.plot_wireframe(x, y, z, \
+            cmap=cm.jet, linewidth=1, rstride=1, cstride=1)
+        if input_pts_filename is not None:
+            ax.scatter(pts['x'], pts['y'], pts['z'], color='black', s=1)
+        ax.zaxis.set_major_locator(LinearLocator(11))
+        ax.zaxis.set_major_formatter(FormatStrFormatter('%.02f'))
+        plt.xlabel("X")
+        plt.ylabel("Y")
+        fig.colorbar(surf, shrink=0.3, aspect=5, pad=0.18)
 
     print(f"saving to '{output_filename}'")
-    plt.savefig(output_filename)
-    plt.show()
+    with profiler.stage('render'), profiler.hot():
+        plt.savefig(output_filename)
+    if show:
+        plt.show()
 
 if __name__ == '__main__':
     qtdraw_mesh_plot()
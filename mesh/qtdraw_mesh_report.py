@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import contextlib
+import glob
+import html
+import io
+import os
+import zipfile
+
+import click
+import numpy as np
+
+import qtdraw_mesh_plot
+import qtdraw_meshfile
+import qtdraw_profile
+
+# files the mesh tools derive from probe runs, which globs leave out: the
+# remapper's compiled cache, the refine inputs, the history reference and
+# stats, simulated runs and remapped points
+DERIVED_SUFFIXES = ('.compiled', '.coarse', '.refine', '.reference', '.sim', '.stats', '.remap')
+
+
+def is_derived(filename: str) -> bool:
+    return os.path.splitext(os.path.basename(filename))[0].endswith(DERIVED_SUFFIXES)
+
+
+def report_mesh(input_filename: str, reference_filename: str, output_filename: str, dpi: int) -> dict:
+    """Render the heatmap of one mesh, or of its difference from the
+    reference mesh, to a png and return its stats, or the error that kept
+    it out of the report."""
+    try:
+        # the mesh reader talks, keep the report output to a line per mesh
+        with contextlib.redirect_stdout(io.StringIO()):
+            xv, yv, z = qtdraw_meshfile.mesh_read(input_filename)
+            if reference_filename is None:
+                deviation = z - z.mean()
+                title = f"{os.path.basename(input_filename)}, Z range {np.ptp(z):.3f} mm"
+                label = 'deviation from the mean Z (mm)'
+            else:
+                xv_B, yv_B, z_B = qtdraw_meshfile.mesh_read(reference_filename)
+                if z.shape != z_B.shape or np.abs(xv - xv_B).max() > .001 or np.abs(yv - yv_B).max() > .001:
+                    raise ValueError(f"mesh doesn't line up with '{reference_filename}'")
+                deviation = z - z_B
+                title = f"{os.path.basename(input_filename)} - {os.path.basename(reference_filename)}, " \
+                        f"range {np.ptp(deviation):.3f} mm"
+                label = 'Z difference (mm)'
+            qtdraw_mesh_plot.heatmap_write(output_filename, xv, yv, deviation, title, label, dpi=dpi)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        return {'input': input_filename, 'error': str(e)}
+    return { \
+        'input': input_filename, \
+        'reference': reference_filename, \
+        'png': output_filename, \
+        'shape': z.shape, \
+        'range': float(np.ptp(deviation)), \
+        'rms': float(np.sqrt(np.mean(deviation ** 2))), \
+    }
+
+
+def index_write(output_dir: str, results: list):
+    """A page of the rendered pngs in order, with their stats."""
+    with open(os.path.join(output_dir, 'index.html'), 'w') as output:
+        output.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>qtdraw mesh report</title></head><body>\n")
+        for result in results:
+            if 'error' in result:
+                continue
+            caption = f"{result['input']}" + (f" - {result['reference']}" if result['reference'] else '') + \
+                    f": {result['shape'][0]} x {result['shape'][1]}, range {result['range']:.3f} mm, rms {result['rms']:.3f} mm"
+            output.write(f"<figure style=\"display:inline-block\"><img src=\"{html.escape(os.path.basename(result['png']))}\">" \
+                    f"<figcaption>{html.escape(caption)}</figcaption></figure>\n")
+        output.write("</body></html>\n")
+
+
+@click.command()
+@click.option('--input_filename', type=str, multiple=True, default=['qtdraw_mesh*.npz'], help='mesh file or glob to report on, .npz or .tsv, can be given several times, globs leave out derived meshes like .compiled.npz')
+@click.option('--output_dir', type=str, default='qtdraw_mesh_report', help='where the pngs and index.html go')
+@click.option('--diff', type=click.Choice(['none', 'previous', 'first']), default='none', help='plot each mesh as is, or its difference from the mesh before it or from the first mesh')
+@click.option('--jobs', type=int, default=0, help='worker processes rendering pngs, 0 uses all cores')
+@click.option('--dpi', type=int, default=100, help='resolution of the pngs')
+@qtdraw_profile.profiled('qtdraw_mesh_report')
+def qtdraw_mesh_report(input_filename: (str, ...), output_dir: str, diff: str, jobs: int, dpi: int, \
+        profiler: qtdraw_profile.Profile):
+    """Render heatmaps of many meshes, or of their differences, to pngs and
+    an index.html without opening a window. Meshes are taken in the order
+    given, the matches of a glob sorted by name."""
+    input_filenames = []
+    for pattern in input_filename:
+        matches = sorted(glob.glob(pattern))
+        derived = [filename for filename in matches if is_derived(filename)]
+        if len(derived) > 0:
+            print(f"left out {len(derived)} derived meshes matching '{pattern}'")
+        matches = [filename for filename in matches if not is_derived(filename)]
+        input_filenames.extend(matches if len(matches) > 0 else [pattern])
+    if diff == 'previous':
+        cases = list(zip(input_filenames[1:], input_filenames[:-1]))
+    elif diff == 'first':
+        cases = [(filename, input_filenames[0]) for filename in input_filenames[1:]]
+    else:
+        cases = [(filename, None) for filename in input_filenames]
+    os.makedirs(output_dir, exist_ok=True)
+    cases = [(filename, reference, os.path.join(output_dir, \
+            os.path.splitext(os.path.basename(filename))[0] + ('.png' if reference is None else '.diff.png')), dpi) \
+            for filename, reference in cases]
+    if len(set(case[2] for case in cases)) != len(cases):
+        raise click.ClickException("several meshes have the same name, their pngs would overwrite each other")
+
+    jobs = min(jobs if jobs > 0 else os.cpu_count(), max(len(cases), 1))
+    print(f"rendering {len(cases)} heatmaps to '{output_dir}' with {jobs} processes")
+    with profiler.stage('render'), profiler.hot():
+        if jobs == 1:
+            results = [report_mesh(*case) for case in cases]
+        else:
+            # forked workers start with matplotlib already imported
+            import matplotlib.backends.backend_agg
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(report_mesh, *zip(*cases)))
+    for result in results:
+        if 'error' in result:
+            print(f"skipped '{result['input']}': {result['error']}")
+        else:
+            print(f"{result['png']}: range {result['range']:.3f} mm rms {result['rms']:.3f} mm")
+    index_write(output_dir, results)
+    profiler.counts['meshes'] += sum('error' not in result for result in results)
+    print(f"wrote {profiler.counts['meshes']} heatmaps and '{os.path.join(output_dir, 'index.html')}'")
+
+
+if __name__ == '__main__':
+    qtdraw_mesh_report()
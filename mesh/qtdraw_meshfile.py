@@ -0,0 +1,142 @@
+"""Reading and writing bed meshes for all the mesh tools. The canonical
+format is an uncompressed .npz with the x axis, y axis and Z grid of a full
+mesh, or the x, y, z rows of a partial one like a refine pass, and a JSON
+metadata string. Its arrays can be memory mapped straight out of the file.
+A .tsv with x, y, z columns, as the tools used to write, is read and
+written too."""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+
+def is_npz(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() == '.npz'
+
+
+def npz_arrays(filename: str, mmap: bool = True) -> dict:
+    """The arrays in an npz, memory mapped where they are stored
+    uncompressed, as np.load ignores mmap_mode for npz."""
+    # zipfile and hashlib are left to the readers and writers, generating
+    # probe gcode doesn't touch a mesh file
+    import zipfile
+    arrays = {}
+    with zipfile.ZipFile(filename) as npz, open(filename, 'rb') as input:
+        for info in npz.infolist():
+            name = info.filename[:-len('.npy')]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with npz.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # skip the local file header to the .npy inside
+            input.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(input.read(4), dtype='<u2')
+            input.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(input)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(input)
+            if dtype.hasobject or len(shape) == 0 or np.prod(shape) == 0:
+                with npz.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='r', offset=input.tell(), \
+                    shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+
+def tsv_read(filename: str) -> np.ndarray:
+    """The x, y, z columns of a mesh tsv as an (n, 3) array."""
+    with open(filename, 'r') as input:
+        header = input.readline().rstrip('\n').split('\t')
+        try:
+            columns = [header.index(column) for column in ('x', 'y', 'z')]
+        except ValueError:
+            raise ValueError(f"expected x, y and z columns in '{filename}', found {', '.join(header)}")
+        if input.tell() == os.fstat(input.fileno()).st_size:
+            return np.empty((0, 3))
+        return np.loadtxt(input, delimiter='\t', usecols=columns, ndmin=2)
+
+
+def mesh_grid(xyz: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """The sorted x and y axes and the Z grid over them of probes that cover
+    a full grid, in any order."""
+    xv, xi = np.unique(xyz[:, 0], return_inverse=True)
+    yv, yi = np.unique(xyz[:, 1], return_inverse=True)
+    if len(xyz) != len(xv) * len(yv):
+        raise ValueError(f"{len(xyz)} probes don't make a full grid of {len(xv)} x {len(yv)}")
+    z = np.full((len(xv), len(yv)), np.nan)
+    z[xi, yi] = xyz[:, 2]
+    if np.isnan(z).any():
+        raise ValueError(f"probes repeat grid points of the {len(xv)} x {len(yv)} grid and leave others out")
+    return xv, yv, z
+
+
+def grid_probes(xv: np.ndarray, yv: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """The x, y, z rows of a grid, x major."""
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    return np.column_stack((x.ravel(), y.ravel(), np.ravel(z)))
+
+
+def probes_read(filename: str, mmap: bool = True) -> (np.ndarray, dict):
+    """The x, y, z rows of a full or partial mesh in an npz or tsv, and its
+    metadata."""
+    if not is_npz(filename):
+        return tsv_read(filename), {}
+    arrays = npz_arrays(filename, mmap)
+    metadata = json.loads(str(arrays['metadata'])) if 'metadata' in arrays else {}
+    if 'xyz' in arrays:
+        return arrays['xyz'], metadata
+    return grid_probes(arrays['xv'], arrays['yv'], arrays['z']), metadata
+
+
+def mesh_read(filename: str, mmap: bool = True) -> (np.ndarray, np.ndarray, np.ndarray):
+    """The sorted x and y axes and the Z grid over them of a mesh npz or tsv."""
+    if is_npz(filename):
+        arrays = npz_arrays(filename, mmap)
+        if 'xyz' in arrays:
+            xv, yv, z = mesh_grid(arrays['xyz'])
+        else:
+            xv, yv, z = arrays['xv'], arrays['yv'], arrays['z']
+    else:
+        xv, yv, z = mesh_grid(tsv_read(filename))
+    print(f"found a {len(xv)} x {len(yv)} mesh in '{filename}'")
+    return xv, yv, z
+
+
+def mesh_metadata(probe_offset: (float, float), machine_config: str = None, **more) -> dict:
+    """Where a mesh came from: the probe offset added to its x, y, when it
+    was made and the sha256 of the machine config it was probed with."""
+    import hashlib
+    config_sha256 = None
+    if machine_config is not None:
+        with open(machine_config, 'rb') as input:
+            config_sha256 = hashlib.sha256(input.read()).hexdigest()
+    return { \
+        'probe_offset': [float(offset) for offset in probe_offset], \
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), \
+        'machine_config_sha256': config_sha256, \
+        **more, \
+    }
+
+
+def mesh_write(filename: str, xyz: np.ndarray, metadata: dict = None):
+    """Write probes to an npz, as a grid if they make a full one, or as a tsv
+    of x, y, z rows in the order given."""
+    xyz = np.asarray(xyz, dtype=float).reshape((-1, 3))
+    if not is_npz(filename):
+        with open(filename, 'w') as output:
+            output.write("x\ty\tz\n")
+            output.writelines(f"{x}\t{y}\t{z}\n" for x, y, z in xyz.tolist())
+        return
+    try:
+        xv, yv, z = mesh_grid(xyz)
+        arrays = {'xv': xv, 'yv': yv, 'z': z}
+    except ValueError:
+        arrays = {'xyz': xyz}
+    # write then rename so a tool reading the mesh never sees half a file
+    with open(filename + '.tmp', 'wb') as output:
+        np.savez(output, metadata=np.array(json.dumps(metadata or {})), **arrays)
+    os.replace(filename + '.tmp', filename)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""Talking to the controller while probing: the PRB reports in FluidNC logs,
+a live probing session over TCP or serial, and a simulated controller to run
+a session against without the plotter. asyncio is imported by the session
+code, parsing a log doesn't need it."""
+
+import contextlib
+import re
+import typing
+
+import click
+import numpy as np
+
+import qtdraw_synthetic
+
+# a FluidNC probe report, x, y, z and any more axes then the success flag,
+# status reports and other chatter around it are skipped. starting at the
+# literal lets the regex engine scan for it instead of trying every line
+PRB_RE = re.compile(rb'\[PRB:([-+.0-9]+),([-+.0-9]+),([-+.0-9]+)(?:,[-+.0-9]+)*:([01])\]')
+PRB_CHUNK_BYTES = 1 << 22
+DIGIT_POWER = 10. ** np.arange(16)
+
+
+def prb_scan(chunk: bytes) -> (np.ndarray, np.ndarray):
+    """The x, y, z of the successful PRB reports in chunk and whether each
+    report succeeded, found and read with array operations over the whole
+    chunk. Returns None where PRB_RE has to read the chunk: reports of more
+    than three axes and numbers other than a sign, digits and a dot."""
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    # the shortest report is [PRB:0,0,0:1]
+    start = np.flatnonzero(buf[:-12] == ord('['))
+    for k, byte in enumerate(b'PRB:', 1):
+        start = start[buf[start + k] == byte]
+    first = start + len(b'[PRB:')
+    colons = np.append(np.flatnonzero(buf[:-2] == ord(':')), len(buf))
+    commas = np.append(np.flatnonzero(buf == ord(',')), [len(buf)] * 3)
+    # a report has x, y, z before the next : and a 0 or 1 then ] after it
+    colon = colons[np.searchsorted(colons, first)]
+    flag = buf.take(colon + 1, mode='clip')
+    k = np.searchsorted(commas, first)
+    match = (colon < len(buf)) & ((flag == ord('0')) | (flag == ord('1'))) \
+            & (buf.take(colon + 2, mode='clip') == ord(']')) & (commas[k + 1] < colon)
+    colon, flag, k = colon[match], flag[match], k[match]
+    if (commas[k + 2] < colon).any():
+        return None
+    number_start = np.stack((first[match], commas[k] + 1, commas[k + 1] + 1), axis=1).ravel()
+    number_end = np.stack((commas[k], commas[k + 1], colon), axis=1).ravel()
+    number_len = number_end - number_start
+    width = int(number_len.max(initial=0))
+    if width > 24:
+        return None
+
+    # the digits a column at a time from the right of every number, each
+    # weighed by the digits right of it and the dot giving the decimals
+    mantissa = np.zeros(len(number_start))
+    power = np.ones(len(number_start))
+    n_digits = np.zeros(len(number_start), dtype=np.uint8)
+    n_dots = np.zeros(len(number_start), dtype=np.uint8)
+    decimals = np.zeros(len(number_start), dtype=np.uint8)
+    index = number_end.copy()
+    for column in range(width):
+        index -= 1
+        byte = buf.take(index, mode='clip')
+        in_number = column < number_len
+        digit = byte - np.uint8(ord('0'))
+        is_digit = in_number & (digit <= 9)
+        weight = power * is_digit
+        mantissa += digit * weight
+        power += 9 * weight
+        is_dot = in_number & (byte == ord('.'))
+        decimals[is_dot] = n_digits[is_dot]
+        n_dots += is_dot
+        n_digits += is_digit
+    sign = buf[number_start]
+    is_sign = (sign == ord('-')) | (sign == ord('+'))
+    # up to 15 digits make an integer that a power of ten scales to exactly
+    # the float float() reads
+    if (n_digits + n_dots + is_sign != number_len).any() or (n_dots > 1).any() \
+            or (n_digits == 0).any() or (n_digits > 15).any():
+        return None
+    value = mantissa / DIGIT_POWER[decimals]
+    value = np.where(sign == ord('-'), -value, value)
+    ok = flag == ord('1')
+    return value.reshape((-1, 3))[ok], ok
+
+
+def prb_findall(chunk: bytes) -> (np.ndarray, np.ndarray):
+    """prb_scan with PRB_RE, for any chunk."""
+    matches = np.array(PRB_RE.findall(chunk), dtype=bytes).reshape((-1, 4))
+    ok = matches[:, 3] == b'1'
+    return matches[ok, :3].astype(float), ok
+
+
+def prb_read(log: typing.BinaryIO, chunk_bytes: int = PRB_CHUNK_BYTES) -> (np.ndarray, int, int):
+    """The x, y, z of the successful probes in a log as an (n, 3) array, the
+    number of lines that aren't probe reports and the number of failed
+    probes. Of probes in a row at the same x, y, like the fast then slow
+    probe cycle, only the last is kept. The log is read in chunks so it can
+    be a pipe."""
+    xyz = []
+    skipped = 0
+    failed = 0
+    tail = b''
+    while True:
+        data = log.read(chunk_bytes)
+        chunk = tail + data
+        if len(data) > 0:
+            # a line cut at the end of the chunk goes with the next one
+            end = chunk.rfind(b'\n') + 1
+            chunk, tail = chunk[:end], chunk[end:]
+        if len(chunk) > 0:
+            found = prb_scan(chunk)
+            chunk_xyz, ok = found if found is not None else prb_findall(chunk)
+            xyz.append(chunk_xyz)
+            failed += len(ok) - ok.sum()
+            lines = chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+            skipped += lines - len(ok)
+        if len(data) == 0:
+            break
+    xyz = np.concatenate(xyz) if len(xyz) > 0 else np.empty((0, 3))
+    if len(xyz) == 0:
+        return xyz, skipped, int(failed)
+    last = np.append(np.any(xyz[1:, :2] != xyz[:-1, :2], axis=1), True)
+    return xyz[last], skipped, int(failed)
+
+
+async def controller_connect(port: str, baudrate: int = 115200) \
+        -> ('asyncio.StreamReader', 'asyncio.StreamWriter'):
+    """Connect to host:port, say the telnet port of FluidNC, or else to a
+    serial port."""
+    import asyncio
+    if not port.startswith('/dev/') and ':' in port:
+        host, tcp_port = port.rsplit(':', 1)
+        return await asyncio.open_connection(host, int(tcp_port))
+    # only serial ports need pyserial-asyncio
+    import serial_asyncio
+    return await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+
+
+class ProbeSession:
+    """Stream gcode to a controller a line at a time, sending the next line
+    once the last one is acknowledged with ok, and hand the x, y, z of every
+    successful PRB report to on_probe as it arrives. An error or alarm
+    stops the session."""
+
+    def __init__(self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter', timeout: float = 120):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.lines = 0
+        self.probes = 0
+        self.failed = 0
+
+    async def send(self, line: str, on_probe):
+        import asyncio
+        self.writer.write(line.encode() + b'\n')
+        await self.writer.drain()
+        while True:
+            response = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if len(response) == 0:
+                raise ConnectionError(f"controller closed the connection after '{line}'")
+            response = response.strip()
+            match = PRB_RE.search(response)
+            if match is not None:
+                if match[4] == b'1':
+                    on_probe(tuple(float(v) for v in match.groups()[:3]))
+                    self.probes += 1
+                else:
+                    self.failed += 1
+            elif response == b'ok':
+                self.lines += 1
+                return
+            elif response.startswith(b'error') or response.startswith(b'ALARM'):
+                raise RuntimeError(f"controller answered '{response.decode()}' to '{line}'")
+
+    async def run(self, lines: typing.Iterable[str], on_probe):
+        for line in lines:
+            await self.send(line, on_probe)
+
+
+class SimulatedController:
+    """A stand-in for FluidNC that acknowledges every line and answers G38.2
+    with a PRB report from a synthetic bed, or a probe fail alarm when the
+    bed is below the probe depth. Only tracks X, Y, Z in G90 and G91. The
+    synthetic bed is scaled by amplitude and lowered by z_offset to land in
+    the range the qtdraw probe finds."""
+
+    def __init__(self, lim: (float, float) = (200, 240), noise: float = 0.0, seed: int = 0, \
+            amplitude: float = 0.5, z_offset: float = -0.2):
+        self.lim = lim
+        self.noise = noise
+        self.amplitude = amplitude
+        self.z_offset = z_offset
+        self.rng = np.random.default_rng(seed)
+        self.position = {'X': 0.0, 'Y': 0.0, 'Z': 0.0}
+        self.alarm = False
+        self.relative = False
+        self.connections = set()
+
+    def bed(self, x: float, y: float) -> float:
+        z = float(qtdraw_synthetic.synthetic_surface(x, y, self.lim, self.amplitude)) + self.z_offset
+        return z + self.rng.normal(0, self.noise) if self.noise > 0 else z
+
+    def execute(self, line: str) -> list:
+        """The responses to a line of gcode."""
+        words = line.upper().split()
+        if words == ['$X']:
+            self.alarm = False
+            return ['ok']
+        if self.alarm:
+            # locked until the alarm is cleared, like the real thing
+            return ['error:9']
+        if 'G90' in words or 'G91' in words:
+            self.relative = 'G91' in words
+        target = {word[0]: float(word[1:]) for word in words if word[0] in self.position}
+        if self.relative:
+            target = {axis: self.position[axis] + value for axis, value in target.items()}
+        if 'G38.2' not in words:
+            self.position.update(target)
+            return ['ok']
+        x, y = self.position['X'], self.position['Y']
+        bed = self.bed(x, y)
+        if bed < target.get('Z', self.position['Z']):
+            self.position['Z'] = target['Z']
+            self.alarm = True
+            return ['ALARM:5']
+        self.position['Z'] = bed
+        return [f"[PRB:{x:.3f},{y:.3f},{bed:.3f}:1]", 'ok']
+
+    async def handle(self, reader: 'asyncio.StreamReader', writer: 'asyncio.StreamWriter'):
+        import asyncio
+        self.connections.add(asyncio.current_task())
+        try:
+            writer.write(b"Grbl 3.7 [FluidNC simulated, '$' for help]\r\n")
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                for response in self.execute(line.decode().strip()):
+                    writer.write(response.encode() + b'\r\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 0) -> 'asyncio.Server':
+        import asyncio
+        return await asyncio.start_server(self.handle, host, port)
+
+
+async def probe_session(port: str, lines: typing.Iterable[str], on_probe, baudrate: int = 115200, \
+        timeout: float = 120, simulated: SimulatedController = None) -> ProbeSession:
+    """Run lines on the controller at port, or on the simulated controller
+    over a local TCP port if given, and return the finished session."""
+    import asyncio
+    server = None
+    if simulated is not None:
+        server = await simulated.serve()
+        port = f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    reader, writer = await controller_connect(port, baudrate)
+    try:
+        session = ProbeSession(reader, writer, timeout)
+        await session.run(lines, on_probe)
+    finally:
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+        if server is not None:
+            server.close()
+            # let the simulated controller see the connection close
+            await asyncio.gather(*simulated.connections)
+    return session
+
+
+@click.command()
+@click.option('--host', type=str, default='127.0.0.1', help='address to listen on')
+@click.option('--port', type=int, default=2323, help='TCP port to listen on')
+@click.option('--lim', nargs=2, type=int, default=(200, 240), help='Size of the synthetic bed in mm')
+@click.option('--noise', type=float, default=0, help='standard deviation in mm of the probe noise')
+def qtdraw_probe(host: str, port: int, lim: (int, int), noise: float):
+    """Serve a simulated FluidNC probing a synthetic bed, for trying
+    qtdraw_mesh.py --work-mode probe --port host:port without the plotter."""
+    import asyncio
+    async def serve():
+        server = await SimulatedController(lim, noise).serve(host, port)
+        print(f"simulated controller listening on {host}:{port}, ctrl-c to stop")
+        async with server:
+            await server.serve_forever()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("stopped the simulated controller")
+
+
+if __name__ == '__main__':
+    qtdraw_probe()
@@ -0,0 +1,148 @@
+"""Stage timing and the --profile metrics shared by the mesh tools."""
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import resource
+import sys
+import time
+
+import click
+
+
+def seconds_since_start() -> float:
+    """Wall time since the process started, so the interpreter start and the
+    imports are counted. Linux only, elsewhere the CPU time so far."""
+    try:
+        with open('/proc/self/stat', 'r') as stat:
+            start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as uptime:
+            return float(uptime.read().split()[0]) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.process_time()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process or of its largest worker."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class StageTimer:
+    """Wall time spent in named stages, summed over every time a stage runs,
+    and counts of what went through them."""
+
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.counts = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def timed(self, name: str, func):
+        """Wrap func so the time spent calling it is counted as a stage."""
+        def timed_func(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed_func
+
+    def merge(self, other: 'StageTimer'):
+        """Add the times and counts of another timer, say of a worker process."""
+        for name, seconds in other.times.items():
+            self.times[name] += seconds
+        self.counts.update(other.counts)
+
+
+class Profile(StageTimer):
+    """The StageTimer of a whole tool run. With enabled, the stage times,
+    counts, counts per second of the hot loop and peak memory are appended as
+    a JSON line to output_filename when the run ends, '-' prints them. With a
+    cprofile_filename the hot loop, see hot, is run under cProfile."""
+
+    def __init__(self, tool: str, enabled: bool = False, output_filename: str = 'qtdraw_profile.jsonl', \
+            cprofile_filename: str = None):
+        super().__init__()
+        self.tool = tool
+        self.enabled = enabled
+        self.output_filename = output_filename
+        self.cprofile_filename = cprofile_filename
+        self.times['import'] = seconds_since_start()
+        self.start = time.perf_counter()
+        self.hot_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.emit()
+
+    @contextlib.contextmanager
+    def hot(self):
+        """Time the hot loop of the tool, under cProfile with a
+        cprofile_filename. The rates are over the summed time of these."""
+        start = time.perf_counter()
+        profiler = None
+        if self.cprofile_filename is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield
+        finally:
+            self.hot_seconds += time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                print(f"saving cProfile stats of the {self.tool} hot loop to '{self.cprofile_filename}'")
+                profiler.dump_stats(self.cprofile_filename)
+
+    def metrics(self) -> dict:
+        seconds = time.perf_counter() - self.start
+        # imports, mesh loads and fits don't grow with the input, so the
+        # rates are of the hot loop, or of the whole run if it has none
+        rate_seconds = self.hot_seconds if self.hot_seconds > 0 else seconds
+        return { \
+            'tool': self.tool, \
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), \
+            'argv': sys.argv[1:], \
+            'wall_seconds': self.times['import'] + seconds, \
+            'hot_seconds': self.hot_seconds, \
+            'stages': dict(self.times), \
+            'counts': dict(self.counts), \
+            'rates': {f"{name}_per_sec": n / rate_seconds for name, n in self.counts.items() if rate_seconds > 0}, \
+            'peak_rss_mb': peak_rss_mb(), \
+        }
+
+    def emit(self):
+        if not self.enabled:
+            return
+        line = json.dumps(self.metrics()) + '\n'
+        if self.output_filename == '-':
+            sys.stdout.write(line)
+            return
+        print(f"appending profile of {self.tool} to '{self.output_filename}'")
+        with open(self.output_filename, 'a') as output:
+            output.write(line)
+
+
+def profiled(tool: str):
+    """Decorate a click command, under its options, with the --profile,
+    --profile_output and --cprofile_output options. The command is passed
+    the Profile of the run as profiler."""
+    def decorate(command):
+        @click.option('--profile/--no-profile', default=False, help='append stage times, counts and peak memory of the run as a JSON line')
+        @click.option('--profile_output', type=str, default='qtdraw_profile.jsonl', help='JSON lines file the --profile metrics go to, - for stdout')
+        @click.option('--cprofile_output', type=str, default=None, help='save cProfile stats of the hot loop to this file')
+        @functools.wraps(command)
+        def profiled_command(profile: bool, profile_output: str, cprofile_output: str, **kwargs):
+            with Profile(tool, profile, profile_output, cprofile_output) as profiler:
+                return command(profiler=profiler, **kwargs)
+        return profiled_command
+    return decorate
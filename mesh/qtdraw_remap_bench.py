@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import click
+import numpy as np
+import scipy
+import scipy.interpolate
+
+import qtdraw_profile
+import qtdraw_remap_gcode
+import qtdraw_synthetic
+
+# what each benchmark mode changes in the remap options
+MODES = {
+    'fast': {},
+    'gcodeparser': {'fast_path': False},
+    'subdivide': {'subdivide': True},
+    'minimize': {'minimize': True},
+    'parallel': {'jobs': 0},
+}
+
+
+def bench_case(work_dir: str, div: (int, int), n_lines: int, mode: str, chunk_lines: int) -> dict:
+    """Remap one synthetic file and measure it, meant to run in a process of
+    its own so the peak RSS is the one of this case."""
+    mesh_filename = os.path.join(work_dir, f"mesh_{div[0]}x{div[1]}.tsv")
+    gcode_filename = os.path.join(work_dir, f"lines_{n_lines}.gcode")
+    remap_options = { \
+        'remap_x_offset': 30., \
+        'remap_y_offset': 30., \
+        'subdivide': False, \
+        'subdivide_tolerance': 0, \
+        'arc_tolerance': 0.01, \
+        'chunk_lines': chunk_lines, \
+    }
+    remap_options.update(MODES[mode])
+    timer = qtdraw_profile.StageTimer()
+    # the remapper talks a lot, keep the benchmark output to the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        with timer.stage('mesh load'):
+            xv, yv, z = qtdraw_remap_gcode.mesh_load(mesh_filename, 0, 0, (0, 0))
+            remap_func = scipy.interpolate.RegularGridInterpolator((xv, yv), z)
+        # the mesh load is left out of the lines/sec, which is of the remap alone
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            jobs = remap_options.pop('jobs', 1) or os.cpu_count()
+            if jobs > 1:
+                remap_options['jobs'] = jobs
+                remap_options['executor'] = stack.enter_context(concurrent.futures.ProcessPoolExecutor( \
+                        max_workers=jobs, initializer=qtdraw_remap_gcode.remap_worker_init, initargs=(xv, yv, z)))
+            lines = qtdraw_remap_gcode.remap_gcode_file(gcode_filename, \
+                    os.path.join(work_dir, f"remapped_{os.getpid()}.gcode"), \
+                    os.path.join(work_dir, f"remapped_{os.getpid()}.npy"), \
+                    remap_func, (xv, yv), timer=timer, **remap_options)
+    seconds = time.perf_counter() - start
+    return { \
+        'mesh': list(div), \
+        'lines': lines, \
+        'mode': mode, \
+        'seconds': seconds, \
+        'lines_per_sec': lines / seconds, \
+        'peak_rss_mb': qtdraw_profile.peak_rss_mb(), \
+        'stages': dict(timer.times), \
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, \
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_results(results: list, baseline: dict, max_slowdown: float) -> list:
+    """The cases that got slower than the baseline by more than max_slowdown."""
+    before = {(tuple(r['mesh']), r['lines'], r['mode']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (tuple(result['mesh']), result['lines'], result['mode'])
+        if key not in before:
+            continue
+        ratio = result['lines_per_sec'] / before[key]['lines_per_sec']
+        print(f"{result['mode']:>12} mesh {key[0][0]}x{key[0][1]} {key[1]:>9} lines: " \
+                f"{ratio:.2f}x the lines/sec of {baseline.get('commit') or 'the baseline'}")
+        if ratio < 1 - max_slowdown:
+            regressions.append(result)
+    return regressions
+
+
+@click.command()
+@click.option('--mesh_div', nargs=2, type=int, multiple=True, default=[(10, 11), (30, 30), (100, 100)], \
+        help='mesh sizes to benchmark, can be given several times')
+@click.option('--gcode_lines', type=int, multiple=True, default=[10000, 100000, 1000000], \
+        help='synthetic gcode file sizes in lines, can be given several times')
+@click.option('--mode', type=click.Choice(list(MODES)), multiple=True, default=['fast'], \
+        help='remap modes to benchmark, can be given several times')
+@click.option('--chunk_lines', type=int, default=10000, help='lines per remap chunk')
+@click.option('--work_dir', type=str, default=None, help='where to put the synthetic files, a temporary directory if not given')
+@click.option('--output_json', type=str, default='qtdraw_remap_bench.json', help='results to compare later runs against')
+@click.option('--baseline_json', type=str, default=None, help='results of an earlier run to check for throughput regressions')
+@click.option('--max_slowdown', type=float, default=0.2, help='fraction of the baseline lines/sec a case may lose before failing')
+def qtdraw_remap_bench(mesh_div, gcode_lines, mode, chunk_lines, work_dir, \
+        output_json, baseline_json, max_slowdown):
+    """Benchmark qtdraw_remap_gcode.py on synthetic meshes and gcode."""
+    keep_work_dir = work_dir is not None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='qtdraw_remap_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    for div in mesh_div:
+        qtdraw_synthetic.synthetic_mesh(div).to_csv(os.path.join(work_dir, f"mesh_{div[0]}x{div[1]}.tsv"), \
+                sep='\t', header=True, index=False)
+    for n_lines in gcode_lines:
+        gcode_filename = os.path.join(work_dir, f"lines_{n_lines}.gcode")
+        if not os.path.exists(gcode_filename):
+            print(f"generating {n_lines} lines of synthetic gcode in '{gcode_filename}'")
+            with open(gcode_filename, 'w') as output:
+                qtdraw_synthetic.synthetic_gcode(output, n_lines)
+
+    results = []
+    for div in mesh_div:
+        for n_lines in gcode_lines:
+            for case_mode in mode:
+                # a fresh process per case so peak RSS doesn't carry over
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, \
+                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(bench_case, work_dir, div, n_lines, case_mode, chunk_lines).result()
+                stages = ' '.join(f"{stage} {seconds:.2f}s" for stage, seconds in result['stages'].items())
+                print(f"{case_mode:>12} mesh {div[0]}x{div[1]} {result['lines']:>9} lines: " \
+                        f"{result['seconds']:.2f}s {result['lines_per_sec']:.0f} lines/sec " \
+                        f"{result['peak_rss_mb']:.0f} MB peak, {stages}")
+                results.append(result)
+
+    if not keep_work_dir:
+        shutil.rmtree(work_dir)
+
+    run = { \
+        'commit': git_commit(), \
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), \
+        'python': platform.python_version(), \
+        'numpy': np.__version__, \
+        'scipy': scipy.__version__, \
+        'machine': platform.machine(), \
+        'cpus': os.cpu_count(), \
+        'results': results, \
+    }
+    print(f"saving results to '{output_json}'")
+    with open(output_json, 'w') as output:
+        json.dump(run, output, indent=1)
+
+    if baseline_json is not None:
+        with open(baseline_json, 'r') as input:
+            baseline = json.load(input)
+        regressions = compare_results(results, baseline, max_slowdown)
+        if len(regressions) > 0:
+            raise click.ClickException(f"{len(regressions)} cases lost more than {max_slowdown:.0%} of their baseline lines/sec")
+
+
+if __name__ == '__main__':
+    qtdraw_remap_bench()
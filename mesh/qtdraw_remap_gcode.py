@@ -1,68 +1,172 @@
 #!/usr/bin/env python
 
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import decimal
+import fnmatch
+import functools
+import glob
+import hashlib
+import io
+import itertools
 import math
+import mmap
+import os
+import re
+import struct
 
 import click
-import gcodeparser
-import pandas as pd
 import numpy as np
-import scipy
 
-def mesh_read(input_filename: str) -> pd.DataFrame:
-    df = pd.read_csv(input_filename, sep='\t', usecols=('x','y','z'))
-    print(f"found a mesh in '{input_filename}' of size {df.size} with {df.shape[0]} rows and {df.shape[1]} cols")
-    return df
+import qtdraw_config
+import qtdraw_meshfile
+import qtdraw_profile
+import qtdraw_surface
 
+def mesh_cell_splits(start: np.ndarray, end: np.ndarray, xv: np.ndarray, yv: np.ndarray) \
+        -> (np.ndarray, np.ndarray):
+    """Find where each straight move from start to end crosses the mesh grid
+    lines. Returns the move index and the fraction along the move of every
+    crossing, sorted by move and then by distance along the move."""
+    move_i = []
+    move_t = []
+    for axis, grid in ((0, xv), (1, yv)):
+        a0 = start[:, axis]
+        a1 = end[:, axis]
+        lo = np.searchsorted(grid, np.minimum(a0, a1), side='right')
+        hi = np.searchsorted(grid, np.maximum(a0, a1), side='left')
+        count = np.maximum(hi - lo, 0)
+        i = np.repeat(np.arange(len(start)), count)
+        k = lo[i] + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        move_i.append(i)
+        move_t.append((grid[k] - a0[i]) / (a1[i] - a0[i]))
+    move_i = np.concatenate(move_i)
+    move_t = np.concatenate(move_t)
+    order = np.lexsort((move_t, move_i))
+    move_i = move_i[order]
+    move_t = move_t[order]
+    # a move through a grid corner crosses both axes at the same point
+    keep = np.ones(len(move_t), dtype=bool)
+    keep[1:] = (move_i[1:] != move_i[:-1]) | (np.diff(move_t) > 1e-9)
+    return move_i[keep], move_t[keep]
 
-@click.command()
-@click.option('--output_gcode_filename', type=str, default='input.qtdraw_remapped.gcode')
-@click.option('--input_gcode_filename', type=str, default='input.gcode')
-@click.option('--input_mesh_filename', type=str, default='qtdraw_mesh.tsv')
-@click.option('--remap_x_offset', type=float, default=30, help='an offset applied to the x coords')
-@click.option('--remap_y_offset', type=float, default=30, help='an offset applied to the y coords')
-@click.option('--machine_x_offset', type=float, default=0, help='an offset applied to the mesh x coords')
-@click.option('--machine_y_offset', type=float, default=0, help='an offset applied to the mesh y coords')
-@click.option('--remap_out_filename', type=str, default='qtdraw_mesh.remap.tsv', help='tsv of remapped points in gcode')
-@click.option('--remap_reference_xi_yj', nargs=2, type=int, default=(0, 0), help='index of probe measure point to use as tool touch off reference')
-@click.option('--swap_mesh_axis', type=bool, default=True, help='swap the x and y axis for the mesh loading')
-def qtdraw_remap_gcode(output_gcode_filename: str, input_gcode_filename: str, \
-        input_mesh_filename: str, \
-        remap_x_offset: float, remap_y_offset: float, \
-        machine_x_offset: float, machine_y_offset: float, \
-        swap_mesh_axis: bool, \
-        remap_out_filename: str, remap_reference_xi_yj: (int, int)):
-    """Read two mesh files and output a new mesh file with the difference of A - B."""
-    mesh = mesh_read(input_mesh_filename)
-    mesh = mesh.sort_values(by=['x', 'y'])
-    mesh['x'] = mesh['x'] + machine_x_offset
-    mesh['y'] = mesh['y'] + machine_y_offset
-    print(f"read {mesh.size} elements from mesh in {mesh.shape} from '{input_mesh_filename}")
-
-    # process the mesh into a meshgrid for sampling for gcode remapping
-    xv = mesh['x'].unique()
-    yv = mesh['y'].unique()
-    shape = (len(xv), len(yv))
-    x = mesh['x'].to_numpy().reshape(shape)
-    y = mesh['y'].to_numpy().reshape(shape)
-    z = mesh['z'].to_numpy().reshape(shape)
-    z = z - z[remap_reference_xi_yj[0]][remap_reference_xi_yj[1]];
-    #print(x)
-    #print(y)
-    #print(z)
 
-    gcode_in = ""
-    with open(input_gcode_filename, 'r') as input:
-        gcode_in += input.read()
+def fewest_splits(t: list, z: list, tolerance: float) -> list:
+    """Pick the fewest interior points of the piecewise linear z(t) so that
+    the chords between them stay within tolerance of every dropped point.
+    t and z include the move start and end, the returned indices do not."""
+    keep = []
+    i = 0
+    n = len(t)
+    while i < n - 1:
+        j = n - 1
+        while j > i + 1:
+            slope = (z[j] - z[i]) / (t[j] - t[i])
+            if all(abs(z[i] + slope * (t[k] - t[i]) - z[k]) <= tolerance for k in range(i + 1, j)):
+                break
+            j -= 1
+        if j < n - 1:
+            keep.append(j)
+        i = j
+    return keep
 
-    remap_pts = []
-    gcode = gcodeparser.GcodeParser(gcode_in, include_comments=True)
-    print(f"read {len(gcode.lines)} lines of gcode from '{input_gcode_filename}'")
-    #print(xv)
-    #print(yv)
-    remap_func = scipy.interpolate.RegularGridInterpolator((xv, yv), z)
-    last_X = None
-    last_Y = None
-    for line in gcode.lines:
+
+def arc_chords(start: (float, float), end: (float, float), center: (float, float), \
+        clockwise: bool, tolerance: float) -> np.ndarray:
+    """Linearize an arc in the xy plane into the fewest chords that stay within
+    tolerance of it. Returns the chord end points, the last one being end."""
+    radius = math.hypot(start[0] - center[0], start[1] - center[1])
+    a0 = math.atan2(start[1] - center[1], start[0] - center[0])
+    a1 = math.atan2(end[1] - center[1], end[0] - center[0])
+    sweep = a1 - a0
+    # start == end is a full circle
+    if clockwise and sweep >= 0:
+        sweep -= 2 * math.pi
+    elif not clockwise and sweep <= 0:
+        sweep += 2 * math.pi
+    if tolerance < radius:
+        max_angle = 2 * math.acos(1 - tolerance / radius)
+    else:
+        max_angle = math.pi
+    n = max(1, math.ceil(abs(sweep) / max_angle))
+    angle = a0 + sweep * np.arange(1, n + 1) / n
+    chords = np.column_stack((center[0] + radius * np.cos(angle), center[1] + radius * np.sin(angle)))
+    chords[-1] = end
+    return chords
+
+
+def linearize_arcs(lines: list, last_xyz: (float, float, float), arc_tolerance: float) -> list:
+    """Replace G2/G3 lines with G1 chords within arc_tolerance of the arc. The
+    chords carry a Z word when the Z is known so each one gets remapped, a
+    helical move has its Z spread along the chords. Coordinates are the ones
+    in the gcode, before any remap offsets."""
+    last_X, last_Y, last_Z = last_xyz
+    out_lines = []
+    for line in lines:
+        X = line.get_param('X', default=last_X)
+        Y = line.get_param('Y', default=last_Y)
+        Z = line.get_param('Z', default=last_Z)
+        if line.command in (('G', 2), ('G', 3)) and last_X is not None and last_Y is not None:
+            clockwise = line.command == ('G', 2)
+            R = line.get_param('R')
+            if R is not None:
+                # center from the radius format, as grbl does it
+                dx = X - last_X
+                dy = Y - last_Y
+                h = -math.sqrt(max(4 * R * R - dx * dx - dy * dy, 0)) / math.hypot(dx, dy)
+                if not clockwise:
+                    h = -h
+                if R < 0:
+                    h = -h
+                I = (dx - dy * h) / 2
+                J = (dy + dx * h) / 2
+            else:
+                I = line.get_param('I', default=0)
+                J = line.get_param('J', default=0)
+            chords = arc_chords((last_X, last_Y), (X, Y), (last_X + I, last_Y + J), \
+                    clockwise, arc_tolerance)
+            n = len(chords)
+            for k, (chord_X, chord_Y) in enumerate(chords.tolist()):
+                chord = copy.copy(line)
+                chord.command = ('G', 1)
+                chord.params = {'X': chord_X, 'Y': chord_Y}
+                if Z is not None:
+                    chord.params['Z'] = Z if last_Z is None else last_Z + (k + 1) * (Z - last_Z) / n
+                if k == 0 and line.get_param('F') is not None:
+                    chord.params['F'] = line.get_param('F')
+                chord.comment = line.comment if k == n - 1 else ''
+                out_lines.append(chord)
+        else:
+            out_lines.append(line)
+        last_X, last_Y, last_Z = X, Y, Z
+    return out_lines
+
+
+def remap_lines(lines: list, remap_func, remap_x_offset: float, remap_y_offset: float, \
+        last_xyz: (float, float, float), mesh_axes: (np.ndarray, np.ndarray) = None, \
+        subdivide_tolerance: float = 0, arc_tolerance: float = 0.01) \
+        -> (list, list, (float, float, float)):
+    """Remap parsed gcode lines, carrying the modal xyz from the previous call
+    in and out. If the mesh axes are given, G1 moves are split where they
+    cross the mesh grid lines so Z follows the surface, keeping only the
+    splits needed to stay within subdivide_tolerance. Arcs are linearized
+    first, see linearize_arcs. Returns the output lines, the remapped points
+    and the new xyz."""
+    last_X, last_Y, last_Z = last_xyz
+    if any(line.command in (('G', 2), ('G', 3)) for line in lines):
+        lines = linearize_arcs(lines, ( \
+                None if last_X is None else last_X - remap_x_offset, \
+                None if last_Y is None else last_Y - remap_y_offset, last_Z), arc_tolerance)
+    # collect the xy of every line with a Z word so the interpolator is only
+    # called once per batch of lines instead of once per line
+    z_lines = []
+    z_xy = []
+    # moves to subdivide as (index in z_lines, start x, start y, start Z)
+    moves = []
+    for line in lines:
+        start_X, start_Y = last_X, last_Y
         X = line.get_param('X')
         if X is not None:
             line.update_param('X', round(X+remap_x_offset, 3))
@@ -74,30 +178,1008 @@ def qtdraw_remap_gcode(output_gcode_filename: str, input_gcode_filename: str, \
         Z = line.get_param('Z')
         if Z is not None:
             if last_X is not None and last_Y is not None:
-                #print(f"{([last_X], [last_Y])}")
-                Z_adjust = remap_func(([last_X, last_Y]))[0]
-                # not a type y and x are reversed below
-                #Z_adjust = remap_func(([last_Y, last_X]))[0]
-                #print(f"Zadjust: {Z_adjust}")
-                # add the current Z so we can do the travel heights correctly
-                # could also skip g0? 
-                newZ = float(Z) + int(Z_adjust * 100000)/100000.
-                remap_pts.append([last_X, last_Y, newZ])
-                line.update_param('Z', newZ)
-    
-    print(f"saving modified lines to '{output_gcode_filename}")
-    with open(output_gcode_filename, 'w') as output:
-        for line in gcode.lines:
-            output.write(line.gcode_str + '\n')
+                if mesh_axes is not None and line.command == ('G', 1) \
+                        and start_X is not None and start_Y is not None \
+                        and (start_X, start_Y) != (last_X, last_Y):
+                    moves.append((len(z_lines), start_X, start_Y, \
+                            float(Z) if last_Z is None else last_Z))
+                z_lines.append(line)
+                z_xy.append((last_X, last_Y))
+            last_Z = float(Z)
+
+    remap_pts = []
+    if len(z_xy) == 0:
+        return lines, np.empty((0, 3)), (last_X, last_Y, last_Z)
+
+    pts = np.array(z_xy)
+    if len(moves) > 0:
+        moves = np.array(moves)
+        move_line = moves[:, 0].astype(int).tolist()
+        move_start = moves[:, 1:3]
+        move_end = pts[moves[:, 0].astype(int)]
+        move_i, move_t = mesh_cell_splits(move_start, move_end, *mesh_axes)
+        split_xy = move_start[move_i] + move_t[:, None] * (move_end[move_i] - move_start[move_i])
+        # the surface at the move starts is needed to measure chord deviation
+        pts = np.concatenate((pts, split_xy, move_start))
+    # not a type y and x are reversed below
+    #Z_adjust = remap_func(pts[:, ::-1])
+    Z_adjust = (np.trunc(remap_func(pts) * 100000) / 100000.).tolist()
+
+    # split points to insert ahead of a line, keyed by the index in z_lines
+    splits = {}
+    if len(moves) > 0:
+        split_adjust = Z_adjust[len(z_xy):len(z_xy) + len(move_i)]
+        start_adjust = Z_adjust[len(z_xy) + len(move_i):]
+        bounds = np.searchsorted(move_i, np.arange(len(moves) + 1))
+        for m in np.flatnonzero(np.diff(bounds)):
+            first, last = bounds[m], bounds[m + 1]
+            t = move_t[first:last].tolist()
+            adjust = split_adjust[first:last]
+            k = move_line[m]
+            if subdivide_tolerance > 0:
+                keep = fewest_splits([0.] + t + [1.], \
+                        [start_adjust[m]] + adjust + [Z_adjust[k]], subdivide_tolerance)
+                chosen = [first + j - 1 for j in keep]
+            else:
+                chosen = range(first, last)
+            start_Z = moves[m, 3].item()
+            end_Z = float(z_lines[k].get_param('Z'))
+            splits[k] = [(*split_xy[j].tolist(), \
+                    start_Z + move_t[j].item() * (end_Z - start_Z) + split_adjust[j]) for j in chosen]
+
+    out_lines = []
+    k = 0
+    for line in lines:
+        if k < len(z_lines) and line is z_lines[k]:
+            for X, Y, newZ in splits.get(k, []):
+                split_line = copy.copy(line)
+                split_line.params = dict(line.params)
+                split_line.comment = ''
+                split_line.update_param('X', round(X, 3))
+                split_line.update_param('Y', round(Y, 3))
+                split_line.update_param('Z', newZ)
+                remap_pts.append([X, Y, newZ])
+                out_lines.append(split_line)
+            X, Y = z_xy[k]
+            # add the current Z so we can do the travel heights correctly
+            # could also skip g0? 
+            newZ = float(line.get_param('Z')) + Z_adjust[k]
+            remap_pts.append([X, Y, newZ])
+            line.update_param('Z', newZ)
+            k += 1
+        out_lines.append(line)
+    return out_lines, np.array(remap_pts), (last_X, last_Y, last_Z)
+
+
+# bytes that can make up the command lines of the [gwrite.qtdraw] vpype
+# profile, a chunk with anything else goes through gcodeparser instead
+GWRITE_LETTER = np.zeros(256, dtype=bool)
+GWRITE_LETTER[list(b'GMXYZF')] = True
+GWRITE_DIGIT = np.zeros(256, dtype=bool)
+GWRITE_DIGIT[list(b'0123456789')] = True
+GWRITE_BYTE = GWRITE_LETTER | GWRITE_DIGIT
+GWRITE_BYTE[list(b'.- \n')] = True
+DIGIT_POWER = 10 ** np.arange(16, dtype=np.int64)
+
+
+def round3(values: np.ndarray) -> np.ndarray:
+    """Python's round(value, 3) over an array. np.round can differ from it
+    within an ulp of a tie, so those few are rounded by Python."""
+    rounded = np.round(values, 3)
+    scaled = values * 1000
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    if near_tie.any():
+        rounded[near_tie] = [round(value, 3) for value in values[near_tie].tolist()]
+    return rounded
+
+
+def decimal_format(letter: str, values: np.ndarray, decimals: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    """The % formats and numbers that spell each value as a word the way
+    repr does. A value that is the float of a decimal of up to decimals
+    places is spelled from ints, its whole part and its fraction without
+    trailing zeros, as % formats ints several times faster than it does
+    floats with %r, which the others keep. Returns the formats, the numbers
+    of each in an (n, 2) object array and how many numbers each takes."""
+    scale = 10 ** decimals
+    magnitude = np.abs(values)
+    # repr switches to exponents below 1e-4, and below 1e9 the floats are
+    # much closer together than the decimals so no shorter one reads the same
+    plain = (magnitude < 1e9) & ((magnitude >= 1e-4) | (magnitude == 0))
+    whole, fraction = np.divmod(np.rint(np.where(plain, magnitude, 0) * scale).astype(np.int64), scale)
+    exact = plain & ((whole * scale + fraction) / scale == magnitude)
+    zeros = sum((fraction % 10 ** k == 0).astype(np.int64) for k in range(1, decimals))
+    table = np.array([f" {letter}{sign}%d.%0{decimals - z}d" for sign in ('', '-') for z in range(decimals)] + \
+            [f" {letter}%r"], dtype=object)
+    formats = table[np.where(exact, np.signbit(values) * decimals + zeros, 2 * decimals)]
+    numbers = np.empty((len(values), 2), dtype=object)
+    numbers[exact, 0] = whole[exact]
+    numbers[exact, 1] = (fraction // 10 ** zeros)[exact]
+    numbers[~exact, 0] = values[~exact]
+    return formats, numbers, np.where(exact, 2, 1)
+
+
+def remap_gwrite_text(gcode_in: str, remap_func, remap_x_offset: float, remap_y_offset: float, \
+        last_xyz: (float, float, float), timer: qtdraw_profile.StageTimer = None) \
+        -> (str, np.ndarray, (float, float, float), int):
+    """Remap a chunk of gcode in the vpype gwrite dialect straight from its
+    bytes with array operations, giving the same output as remap_lines and
+    gcode_str on the gcodeparser lines. The dialect is lines of G/M words
+    with X, Y, Z and F parameters, ( ) comments and blank lines.
+    Returns None if the chunk is not in the dialect, otherwise the remapped
+    text, the remapped points, the new xyz and the number of gcode lines.
+    The time spent writing the text is added to the serialize stage of timer."""
+    if timer is None:
+        timer = qtdraw_profile.StageTimer()
+    try:
+        buf = np.frombuffer(gcode_in.encode('ascii'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        return None
+    if len(buf) == 0 or buf[-1] != ord('\n'):
+        buf = np.append(buf, np.uint8(ord('\n')))
+    newline = buf == ord('\n')
+    line_end = np.flatnonzero(newline)
+    line_start = np.concatenate(([0], line_end[:-1] + 1))
+    line_of = np.cumsum(newline) - newline
+
+    # blank lines and ( ) comments are dropped, as gcodeparser drops them
+    first = buf[line_start]
+    comment = first == ord('(')
+    paren = (buf == ord('(')) | (buf == ord(')'))
+    n_paren = np.bincount(line_of[paren], minlength=len(line_start))
+    if (comment & ((n_paren != 2) | (buf[line_end - 1] != ord(')')))).any():
+        return None
+    command_line = ~comment & (first != ord('\n'))
+    in_command = command_line[line_of]
+    if (in_command & ~GWRITE_BYTE[buf]).any():
+        return None
+    if not GWRITE_LETTER[first[command_line]].all():
+        return None
+
+    # every line is words of a letter and a number -?d+(.d+)? split by a space
+    prev = np.concatenate(([ord('\n')], buf[:-1]))
+    next = np.concatenate((buf[1:], [ord('\n')]))
+    letter = in_command & GWRITE_LETTER[buf]
+    space = in_command & (buf == ord(' '))
+    minus = in_command & (buf == ord('-'))
+    dot = in_command & (buf == ord('.'))
+    if (letter & ~((prev == ord(' ')) | (prev == ord('\n')))).any() \
+            or (letter & ~(GWRITE_DIGIT[next] | (next == ord('-')))).any() \
+            or (space & ~GWRITE_LETTER[next]).any() \
+            or (minus & ~(GWRITE_LETTER[prev] & GWRITE_DIGIT[next])).any() \
+            or (dot & ~(GWRITE_DIGIT[prev] & GWRITE_DIGIT[next])).any():
+        return None
+    word_start = np.flatnonzero(letter)
+    word_of = np.cumsum(letter) - 1
+    word_dot = np.bincount(word_of[dot], minlength=len(word_start)) > 0
+    if (np.bincount(word_of[dot], minlength=len(word_start)) > 1).any():
+        return None
+    delimiter = np.flatnonzero(space | newline)
+    word_end = delimiter[np.searchsorted(delimiter, word_start)]
+    word_len = word_end - word_start - 1
+    width = int(word_len.max(initial=1))
+    if width > 24:
+        return None
+    column = np.arange(width)
+    window = np.lib.stride_tricks.sliding_window_view(np.append(buf, np.zeros(width, dtype=np.uint8)), width)
+    digits = np.where(column < word_len[:, None], window[word_start + 1], 0)
+    word_letter = buf[word_start]
+    # up to 15 digits make an integer that a power of ten scales to exactly
+    # the float float() reads, without going through the text of each number
+    is_digit = GWRITE_DIGIT[digits]
+    if (is_digit.sum(axis=1) > 15).any():
+        return None
+    mantissa = np.zeros(len(word_start), dtype=np.int64)
+    for c in range(width):
+        mantissa = np.where(is_digit[:, c], mantissa * 10 + digits[:, c] - ord('0'), mantissa)
+    dot_column = np.where(word_dot, np.argmax(digits == ord('.'), axis=1), word_len - 1)
+    word_value = mantissa / DIGIT_POWER[word_len - 1 - dot_column]
+    word_negative = digits[:, 0] == ord('-')
+    word_value[word_negative] *= -1
+
+    # G and M words start a command, the other words are its parameters, one
+    # command per output line like gcodeparser
+    is_command = (word_letter == ord('G')) | (word_letter == ord('M'))
+    if not is_command[np.searchsorted(word_start, line_start[command_line])].all():
+        return None
+    command_of = np.cumsum(is_command) - 1
+    n_commands = int(is_command.sum())
+    command_letter = word_letter[is_command]
+    command_value = word_value[is_command]
+    if word_dot[is_command].any() or \
+            ((command_letter == ord('G')) & np.isin(command_value, (2, 3))).any():
+        return None
+    for axis in b'XYZF':
+        if (np.bincount(command_of[word_letter == axis], minlength=1) > 1).any():
+            return None
+
+    # gcodeparser skips negative command numbers, -0 too, leave them to it
+    if word_negative[is_command].any() or (command_value >= 1000).any():
+        return None
+
+    # the modal xy after each command, carried in from the previous chunk
+    def modal(axis: int, offset: float, last: float) -> (np.ndarray, np.ndarray):
+        is_axis = word_letter == axis
+        value = word_value[is_axis] + offset
+        at_command = np.full(n_commands, np.nan)
+        at_command[command_of[is_axis]] = value
+        index = np.where(np.isnan(at_command), -1, np.arange(n_commands))
+        index = np.maximum.accumulate(index) if n_commands > 0 else index
+        carried = np.nan if last is None else last
+        return np.where(index >= 0, at_command[index], carried), value
+    last_X, last_Y, last_Z = last_xyz
+    command_X, X = modal(ord('X'), remap_x_offset, last_X)
+    command_Y, Y = modal(ord('Y'), remap_y_offset, last_Y)
+    if len(X) > 0:
+        last_X = X[-1].item()
+    if len(Y) > 0:
+        last_Y = Y[-1].item()
+
+    is_Z = word_letter == ord('Z')
+    Z_command = command_of[is_Z]
+    remapped = ~np.isnan(command_X[Z_command]) & ~np.isnan(command_Y[Z_command])
+    if is_Z.any():
+        last_Z = word_value[is_Z][-1].item()
+    Z_word = np.flatnonzero(is_Z)[remapped]
+
+    remap_pts = np.empty((0, 3))
+    if remapped.any():
+        z_xy = np.column_stack((command_X[Z_command[remapped]], command_Y[Z_command[remapped]]))
+        Z_adjust = np.trunc(remap_func(z_xy) * 100000) / 100000.
+        newZ = word_value[Z_word] + Z_adjust
+        remap_pts = np.column_stack((z_xy, newZ))
+    if n_commands == 0:
+        return '', remap_pts, (last_X, last_Y, last_Z), 0
+
+    with timer.stage('serialize'):
+        # the output is a % format of every word, filled with the numbers of
+        # the parameters at once, %r spells a float as repr does and %d an int
+        formats = np.empty(len(word_start), dtype=object)
+        numbers = np.empty((len(word_start), 2), dtype=object)
+        n_numbers = np.where(is_command, 0, 1)
+        command_code = (command_letter == ord('M')) * 1000 + command_value.astype(np.int64)
+        names = np.empty(2000, dtype=object)
+        for code in np.flatnonzero(np.bincount(command_code, minlength=2000)).tolist():
+            names[code] = f"\n{'GM'[code // 1000]}{code % 1000}"
+        formats[is_command] = names[command_code]
+        for axis, value in ((ord('X'), X), (ord('Y'), Y)):
+            is_axis = word_letter == axis
+            formats[is_axis], numbers[is_axis], n_numbers[is_axis] = decimal_format(chr(axis), round3(value), 3)
+
+        # the rest keep their value, as an int or float like gcodeparser reads it
+        kept = ~is_command & (word_letter != ord('X')) & (word_letter != ord('Y'))
+        kept[Z_word] = False
+        for axis in b'ZF':
+            kept_float = kept & word_dot & (word_letter == axis)
+            formats[kept_float] = f" {chr(axis)}%r"
+            numbers[kept_float, 0] = word_value[kept_float]
+            kept_int = kept & ~word_dot & (word_letter == axis)
+            formats[kept_int] = f" {chr(axis)}%d"
+            numbers[kept_int, 0] = word_value[kept_int].astype(np.int64)
+        if remapped.any():
+            formats[Z_word], numbers[Z_word], n_numbers[Z_word] = decimal_format('Z', newZ, 5)
+        gcode_out = ''.join(formats.tolist()) % tuple(numbers[np.arange(2) < n_numbers[:, None]].tolist())
+    return gcode_out[1:] + '\n', remap_pts, (last_X, last_Y, last_Z), n_commands
+
+
+def shortest_number(value: str) -> str:
+    """The shortest gcode spelling of a number, 35.0 is 35 and -0.50 is -.5."""
+    if 'e' in value or 'E' in value:
+        # grbl style controllers don't read exponents
+        value = format(decimal.Decimal(value), 'f')
+    if '.' in value:
+        value = value.rstrip('0').rstrip('.')
+    sign = '-' if value.startswith('-') else ''
+    value = value.lstrip('-')
+    if value.startswith('0.'):
+        value = value[1:]
+    if value in ('', '0'):
+        return '0'
+    return sign + value
+
+
+class GcodeMinimizer:
+    """Drop repeated modal words and moves that go nowhere from gcode lines
+    as they are written, keeping the modal state from one chunk to the
+    next. Counts the bytes in and out so the saving can be reported.
+    With steps_per_mm the G0/G1 axis words are first rounded to whole motor
+    steps, so a Z that moves by less than a step is dropped too. With
+    quantize_only they are only rounded and the lines otherwise kept."""
+    axes = 'XYZ'
+
+    def __init__(self, steps_per_mm: dict = None, quantize_only: bool = False):
+        self.steps_per_mm = steps_per_mm or {}
+        self.quantize_only = quantize_only
+        self.motion = None
+        self.feed = None
+        self.relative = False
+        self.position = dict.fromkeys(self.axes)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def forget(self, axes: str = axes):
+        for axis in axes:
+            self.position[axis] = None
+
+    def other_command(self, command: str, params: list) -> str:
+        # anything but a G0/G1 is kept as is, only its effect on the state is tracked
+        letters = ''.join(param[0] for param in params)
+        if command == 'G90':
+            self.relative = False
+        elif command in ('G91', 'G20', 'G21', 'G92', 'G28', 'G30', 'G10') or command.startswith('G38'):
+            self.relative = self.relative or command == 'G91'
+            self.forget()
+        elif command == 'G53':
+            # a move in machine coordinates leaves those work coordinates unknown
+            self.forget(''.join(axis for axis in self.axes if axis in letters))
+        elif command in ('G2', 'G3'):
+            self.motion = command
+            self.forget(''.join(axis for axis in self.axes if axis not in letters))
+            for param in params:
+                if param[0] in self.axes:
+                    self.position[param[0]] = float(param[1:])
+        elif command == 'G80':
+            self.motion = None
+        elif any(axis in letters for axis in self.axes):
+            self.forget()
+        for param in params:
+            if param[0] == 'F':
+                self.feed = float(param[1:])
+        return ' '.join([command] + [param[0] + shortest_number(param[1:]) for param in params])
+
+    def keep_line(self, line: str) -> str:
+        """Keep a line with comments as it is, tracking the effect on the
+        modal state of the words outside its comments."""
+        words = re.sub(r'\([^)]*\)', ' ', line.split(';', 1)[0]).split()
+        try:
+            if any(len(word) < 2 or '(' in word for word in words):
+                raise ValueError(line)
+            command = None
+            if len(words) > 0 and words[0][0] in 'GM':
+                command = words[0]
+                words = words[1:]
+            if command is not None and command not in ('G0', 'G1'):
+                self.other_command(command, words)
+                return line
+            for word in words:
+                value = float(word[1:])
+                if word[0] in self.axes and not self.relative:
+                    self.position[word[0]] = value
+                elif word[0] == 'F':
+                    self.feed = value
+            if command is not None:
+                self.motion = command
+        except ValueError:
+            # nothing is known after a line that can't be read
+            self.motion = None
+            self.feed = None
+            self.forget()
+        return line
+
+    def minimize_line(self, line: str) -> str:
+        """Returns the minimized line, or None if it does nothing."""
+        if line.startswith(';'):
+            return line
+        words = line.split()
+        if ';' in line or '(' in line or any(len(word) < 2 for word in words):
+            return self.keep_line(line)
+        command = None
+        if words[0][0] in 'GM':
+            command = words[0]
+            words = words[1:]
+        if command is not None and command not in ('G0', 'G1'):
+            return self.other_command(command, words)
+
+        changed = []
+        for word in words:
+            letter = word[0]
+            number = word[1:]
+            value = float(number)
+            if letter in self.steps_per_mm:
+                value = qtdraw_config.quantize(value, self.steps_per_mm[letter])
+                number = repr(value)
+            if letter in self.axes and not self.relative:
+                if self.position[letter] == value:
+                    continue
+                self.position[letter] = value
+            elif letter == 'F':
+                if self.feed == value:
+                    continue
+                self.feed = value
+            changed.append(letter + shortest_number(number))
+        if command is not None and command != self.motion:
+            self.motion = command
+            return ' '.join([command] + changed)
+        if len(changed) == 0:
+            return None
+        return ' '.join(changed)
+
+    def quantize_line(self, line: str) -> str:
+        """Returns the line with the axis words of a G0/G1 rounded to whole
+        steps, the words that are already on a step spelled as they were."""
+        words = line.split()
+        if ';' in line or '(' in line or len(words) == 0 or any(len(word) < 2 for word in words) \
+                or (words[0][0] in 'GM' and words[0] not in ('G0', 'G1')):
+            return line
+        changed = False
+        for i, word in enumerate(words):
+            if word[0] in self.steps_per_mm:
+                try:
+                    value = float(word[1:])
+                except ValueError:
+                    return line
+                quantized = qtdraw_config.quantize(value, self.steps_per_mm[word[0]])
+                if quantized != value:
+                    words[i] = word[0] + repr(quantized)
+                    changed = True
+        return ' '.join(words) if changed else line
+
+    def minimize(self, gcode: str) -> str:
+        out = []
+        for line in gcode.split('\n'):
+            if line != '':
+                line = self.quantize_line(line) if self.quantize_only else self.minimize_line(line)
+                if line is not None:
+                    out.append(line)
+        gcode_out = '\n'.join(out) + '\n' if len(out) > 0 else ''
+        self.bytes_in += len(gcode)
+        self.bytes_out += len(gcode_out)
+        return gcode_out
+
+
+class PointWriter:
+    """Write remapped points in chunks as they are made, the format comes
+    from the filename extension, see point_writer."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class NpyPointWriter(PointWriter):
+    """Stream points to a .npy of float64 (n, 3), the header is sized up
+    front and rewritten with the final point count on close."""
+    header_len = 128
+
+    def __init__(self, filename: str):
+        self.output = open(filename, 'wb')
+        self.n = 0
+        self.output.write(self.header())
+
+    def header(self) -> bytes:
+        header = f"{{'descr': '<f8', 'fortran_order': False, 'shape': ({self.n}, 3), }}"
+        preamble = np.lib.format.magic(1, 0) + struct.pack('<H', self.header_len - 10)
+        return preamble + header.ljust(self.header_len - len(preamble) - 1).encode('latin1') + b'\n'
+
+    def write(self, pts: np.ndarray):
+        self.output.write(np.ascontiguousarray(pts, dtype='<f8').tobytes())
+        self.n += len(pts)
+
+    def close(self):
+        self.output.seek(0)
+        self.output.write(self.header())
+        self.output.close()
+
+
+class NpzPointWriter(PointWriter):
+    """Collect the chunks and save them as the 'pts' array of a .npz."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.chunks = []
+
+    def write(self, pts: np.ndarray):
+        self.chunks.append(np.asarray(pts, dtype=float).reshape(-1, 3))
+
+    def close(self):
+        with open(self.filename, 'wb') as output:
+            np.savez(output, pts=np.concatenate(self.chunks) if self.chunks else np.empty((0, 3)))
+
 
+class ParquetPointWriter(PointWriter):
+    """Stream points to parquet with one row group per chunk, needs pyarrow."""
+
+    def __init__(self, filename: str):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(c, pyarrow.float64()) for c in ('x', 'y', 'z')])
+        self.output = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def write(self, pts: np.ndarray):
+        if len(pts) > 0:
+            self.output.write_table(self.pyarrow.Table.from_arrays( \
+                    [pts[:, 0], pts[:, 1], pts[:, 2]], schema=self.schema))
+
+    def close(self):
+        self.output.close()
+
+
+class TsvPointWriter(PointWriter):
+    """Append points to a tab separated table with an x, y, z header."""
+
+    def __init__(self, filename: str):
+        import pandas
+        self.pandas = pandas
+        self.output = open(filename, 'w')
+        self.output.write('x\ty\tz\n')
+
+    def write(self, pts: np.ndarray):
+        self.pandas.DataFrame(pts, columns=['x', 'y', 'z']) \
+                .to_csv(self.output, sep='\t', header=False, index=False)
+
+    def close(self):
+        self.output.close()
+
+
+def point_writer(filename: str) -> PointWriter:
+    extension = os.path.splitext(filename)[1].lower()
+    writers = { \
+        '.npy': NpyPointWriter, \
+        '.npz': NpzPointWriter, \
+        '.parquet': ParquetPointWriter, \
+        '.tsv': TsvPointWriter, \
+    }
+    if extension not in writers:
+        raise ValueError(f"unknown remapped point format '{extension}' in '{filename}', expected one of {', '.join(writers)}")
+    return writers[extension](filename)
+
+
+def mesh_load(input_mesh_filename: str, machine_x_offset: float, machine_y_offset: float, \
+        remap_reference_xi_yj: (int, int)) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Read a mesh npz or tsv into sorted x and y axes and a Z grid zeroed at
+    the reference probe point."""
+    xv, yv, z = qtdraw_meshfile.mesh_read(input_mesh_filename)
+    xv = xv + machine_x_offset
+    yv = yv + machine_y_offset
+    z = z - z[remap_reference_xi_yj[0]][remap_reference_xi_yj[1]];
+    return xv, yv, z
+
+
+def mesh_load_cached(input_mesh_filename: str, machine_x_offset: float, machine_y_offset: float, \
+        remap_reference_xi_yj: (int, int)) -> (np.ndarray, np.ndarray, np.ndarray):
+    """mesh_load, but the result is kept in a .compiled.npz next to the tsv
+    and reused for as long as the tsv content and the options are the same.
+    An npz mesh loads as fast as the compiled one and isn't cached."""
+    if qtdraw_meshfile.is_npz(input_mesh_filename):
+        return mesh_load(input_mesh_filename, machine_x_offset, machine_y_offset, remap_reference_xi_yj)
+    with open(input_mesh_filename, 'rb') as input:
+        key = hashlib.sha256(input.read())
+    key.update(repr((machine_x_offset, machine_y_offset, tuple(remap_reference_xi_yj))).encode())
+    key = key.hexdigest()
+
+    cache_filename = os.path.splitext(input_mesh_filename)[0] + '.compiled.npz'
+    if os.path.exists(cache_filename):
+        with np.load(cache_filename) as cache:
+            if str(cache['key']) == key:
+                print(f"read compiled mesh from '{cache_filename}'")
+                return cache['xv'], cache['yv'], cache['z']
+        print(f"compiled mesh in '{cache_filename}' is out of date")
+
+    xv, yv, z = mesh_load(input_mesh_filename, machine_x_offset, machine_y_offset, remap_reference_xi_yj)
+    print(f"saving compiled mesh to '{cache_filename}'")
+    # write then rename so a concurrent run never sees half a file
+    try:
+        with open(cache_filename + '.tmp', 'wb') as cache:
+            np.savez(cache, key=key, xv=xv, yv=yv, z=z)
+        os.replace(cache_filename + '.tmp', cache_filename)
+    except OSError as e:
+        # a mesh in a read only or shared directory is remapped uncached
+        print(f"could not save compiled mesh, remapping without it: {e}")
+        with contextlib.suppress(OSError):
+            os.remove(cache_filename + '.tmp')
+    return xv, yv, z
+
+
+def remap_chunk(gcode_in: str, remap_func, mesh_axes: (np.ndarray, np.ndarray), \
+        remap_x_offset: float, remap_y_offset: float, last_xyz: (float, float, float), \
+        subdivide: bool, subdivide_tolerance: float, arc_tolerance: float, fast_path: bool, \
+        timer: qtdraw_profile.StageTimer = None) -> (str, np.ndarray, (float, float, float), int):
+    """Remap a chunk of gcode text with remap_gwrite_text, or remap_lines on
+    the gcodeparser lines when it isn't in the gwrite dialect. Returns the
+    remapped text, the remapped points, the new xyz and the number of lines.
+    The time spent writing the text is added to the serialize stage of timer."""
+    if timer is None:
+        timer = qtdraw_profile.StageTimer()
+    if fast_path and not subdivide:
+        fast = remap_gwrite_text(gcode_in, remap_func, remap_x_offset, remap_y_offset, last_xyz, timer)
+        if fast is not None:
+            return fast
+    # only chunks off the fast path need gcodeparser
+    import gcodeparser
+    gcode = gcodeparser.GcodeParser(gcode_in, include_comments=True)
+    lines, remap_pts, last_xyz = remap_lines(gcode.lines, remap_func, \
+            remap_x_offset, remap_y_offset, last_xyz, \
+            mesh_axes if subdivide else None, subdivide_tolerance, arc_tolerance)
+    with timer.stage('serialize'):
+        gcode_out = ''.join(line.gcode_str + '\n' for line in lines)
+    return gcode_out, remap_pts, last_xyz, len(gcode.lines)
+
+
+def remap_chunks(input_gcode_filename: str, remap_func, mesh_axes: (np.ndarray, np.ndarray), \
+        remap_x_offset: float, remap_y_offset: float, \
+        subdivide: bool, subdivide_tolerance: float, arc_tolerance: float, chunk_lines: int, \
+        fast_path: bool, timer: qtdraw_profile.StageTimer):
+    """Read and remap chunk_lines at a time, carrying the modal xyz from one
+    chunk to the next. Yields the remapped text, points and line count."""
+    last_xyz = (None, None, None)
+    with open(input_gcode_filename, 'r') as input:
+        while True:
+            with timer.stage('parse'):
+                if chunk_lines > 0:
+                    gcode_in = ''.join(itertools.islice(input, chunk_lines))
+                else:
+                    gcode_in = input.read()
+                if gcode_in == '':
+                    break
+                gcode_out, remap_pts, last_xyz, n_chunk = remap_chunk(gcode_in, remap_func, mesh_axes, \
+                        remap_x_offset, remap_y_offset, last_xyz, \
+                        subdivide, subdivide_tolerance, arc_tolerance, fast_path, timer)
+            yield gcode_out, remap_pts, n_chunk
+            if chunk_lines <= 0:
+                break
+
+
+def modal_head(gcode_in: str, remap_x_offset: float, remap_y_offset: float) -> (int, (float, float, float)):
+    """Find how much of a chunk depends on the modal xyz carried in from the
+    chunks before it: the text up to the line where X, Y and Z have all been
+    set, by other moves than arcs as those leave the xyz at the end of their
+    last chord. Returns the length of that head and the xyz after it, the xyz
+    is None if the whole chunk is head."""
+    import gcodeparser
+    last_X, last_Y, last_Z = None, None, None
+    head = 0
+    for text_line in io.StringIO(gcode_in):
+        head += len(text_line)
+        for line in gcodeparser.parse_gcode_lines(text_line, include_comments=True):
+            if line.command in (('G', 2), ('G', 3)):
+                last_X, last_Y, last_Z = None, None, None
+                continue
+            X = line.get_param('X')
+            if X is not None:
+                last_X = X+remap_x_offset
+            Y = line.get_param('Y')
+            if Y is not None:
+                last_Y = Y+remap_y_offset
+            Z = line.get_param('Z')
+            if Z is not None:
+                last_Z = float(Z)
+        if last_X is not None and last_Y is not None and last_Z is not None:
+            return head, (last_X, last_Y, last_Z)
+    return head, None
+
+
+def remap_chunk_worker(input_gcode_filename: str, start: int, end: int, remap_options: dict) \
+        -> (str, str, np.ndarray, (float, float, float), int, qtdraw_profile.StageTimer):
+    """Remap the bytes start to end of a gcode file past its modal head, in a
+    worker process set up by remap_worker_init. Returns the head text left
+    for the caller to remap, the remapped rest with its points, xyz and line
+    count, and the stage times."""
+    mesh_axes, remap_func = worker_mesh
+    timer = qtdraw_profile.StageTimer()
+    remap_func = timer.timed('interpolate', remap_func)
+    with timer.stage('parse'):
+        with open(input_gcode_filename, 'rb') as input, \
+                mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as gcode_map:
+            # decoded like open(..., 'r') would, newlines included
+            gcode_in = io.TextIOWrapper(io.BytesIO(gcode_map[start:end])).read()
+        head, last_xyz = modal_head(gcode_in, remap_options['remap_x_offset'], remap_options['remap_y_offset'])
+        if last_xyz is None:
+            gcode_out, remap_pts, n_chunk = '', np.empty((0, 3)), 0
+        else:
+            gcode_out, remap_pts, last_xyz, n_chunk = remap_chunk(gcode_in[head:], remap_func, mesh_axes, \
+                    last_xyz=last_xyz, timer=timer, **remap_options)
+    return gcode_in[:head], gcode_out, remap_pts, last_xyz, n_chunk, timer
+
+
+# bytes of gcode per chunk handed to a worker when remapping a file in parallel
+PARALLEL_CHUNK_BYTES = 1 << 20
+
+def remap_chunks_parallel(input_gcode_filename: str, remap_func, mesh_axes: (np.ndarray, np.ndarray), \
+        remap_x_offset: float, remap_y_offset: float, \
+        subdivide: bool, subdivide_tolerance: float, arc_tolerance: float, \
+        fast_path: bool, timer: qtdraw_profile.StageTimer, executor: concurrent.futures.Executor, jobs: int):
+    """remap_chunks with the file memory mapped and cut at newlines into
+    chunks that the executor workers remap past their modal head. The heads
+    are remapped here in file order with the xyz carried from the chunk
+    before, so the output is the same as remapping the file in one go.
+    At most two chunks per job are in flight to keep memory flat."""
+    remap_options = { \
+        'remap_x_offset': remap_x_offset, \
+        'remap_y_offset': remap_y_offset, \
+        'subdivide': subdivide, \
+        'subdivide_tolerance': subdivide_tolerance, \
+        'arc_tolerance': arc_tolerance, \
+        'fast_path': fast_path, \
+    }
+    with open(input_gcode_filename, 'rb') as input:
+        size = os.fstat(input.fileno()).st_size
+        bounds = [0]
+        if size > 0:
+            with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as gcode_map:
+                while bounds[-1] < size:
+                    end = gcode_map.find(b'\n', bounds[-1] + PARALLEL_CHUNK_BYTES - 1)
+                    bounds.append(size if end < 0 else end + 1)
+    print(f"remapping '{input_gcode_filename}' in {len(bounds) - 1} chunks with {jobs} processes")
+
+    last_xyz = (None, None, None)
+    ranges = iter(zip(bounds[:-1], bounds[1:]))
+    futures = collections.deque()
+    while True:
+        for start, end in itertools.islice(ranges, 2 * jobs - len(futures)):
+            futures.append(executor.submit(remap_chunk_worker, input_gcode_filename, start, end, remap_options))
+        if len(futures) == 0:
+            break
+        with timer.stage('wait'):
+            head, gcode_out, remap_pts, body_xyz, n_chunk, worker_timer = futures.popleft().result()
+        timer.merge(worker_timer)
+        with timer.stage('parse'):
+            head_out, head_pts, last_xyz, n_head = remap_chunk(head, remap_func, mesh_axes, \
+                    last_xyz=last_xyz, timer=timer, **remap_options)
+        if body_xyz is not None:
+            last_xyz = body_xyz
+        yield head_out + gcode_out, np.concatenate((head_pts, remap_pts)), n_head + n_chunk
+
+
+def remap_gcode_file(input_gcode_filename: str, output_gcode_filename: str, remap_out_filename: str, \
+        remap_func, mesh_axes: (np.ndarray, np.ndarray), \
+        remap_x_offset: float, remap_y_offset: float, \
+        subdivide: bool, subdivide_tolerance: float, arc_tolerance: float, chunk_lines: int, \
+        fast_path: bool = True, minimize: bool = False, steps_per_mm: dict = None, \
+        timer: qtdraw_profile.StageTimer = None, executor: concurrent.futures.Executor = None, jobs: int = 1) -> int:
+    """Remap one gcode file onto the mesh and save the remapped points.
+    Chunks in the vpype gwrite dialect skip gcodeparser when fast_path is
+    set, and the output goes through a GcodeMinimizer when minimize is set,
+    which also rounds to the steps_per_mm of each axis if given. Without
+    minimize, steps_per_mm only rounds the coordinates. The time spent in
+    the parse, interpolate, serialize, minimize and write stages and the
+    count of lines and points are added to timer if given.
+    With an executor whose workers ran remap_worker_init, the chunks are
+    remapped by jobs workers at a time, see remap_chunks_parallel.
+    Returns the number of gcode lines read."""
+    # stream the gcode through in chunks so memory stays flat for large files,
+    # the modal xy is carried from one chunk to the next
+    print(f"saving modified lines of '{input_gcode_filename}' to '{output_gcode_filename}")
     print(f"saving points of modified gcode to '{remap_out_filename}'")
-    for xi in xv:
-        for yj in yv:
-            zpt = int(remap_func(([xi, yj]))[0] * 100000)/100000.
-            #print(zpt)
-            remap_pts.append([xi, yj, zpt])
-    remap_df = pd.DataFrame(remap_pts, columns=['x', 'y', 'z'])
-    remap_df.to_csv(remap_out_filename, sep='\t', header=True, index=False)
+    if timer is None:
+        timer = qtdraw_profile.StageTimer()
+    # parse is timed around the whole chunk remap, the interpolation and
+    # serialization inside it are taken out again at the end
+    interpolate = timer.times['interpolate']
+    serialize = timer.times['serialize']
+    remap_func = timer.timed('interpolate', remap_func)
+    n_lines = 0
+    minimizer = None
+    if minimize or steps_per_mm is not None:
+        minimizer = GcodeMinimizer(steps_per_mm, quantize_only=not minimize)
+    if executor is None:
+        chunks = remap_chunks(input_gcode_filename, remap_func, mesh_axes, remap_x_offset, remap_y_offset, \
+                subdivide, subdivide_tolerance, arc_tolerance, chunk_lines, fast_path, timer)
+    else:
+        chunks = remap_chunks_parallel(input_gcode_filename, remap_func, mesh_axes, remap_x_offset, remap_y_offset, \
+                subdivide, subdivide_tolerance, arc_tolerance, fast_path, timer, executor, jobs)
+    with open(output_gcode_filename, 'w') as output, \
+            point_writer(remap_out_filename) as remap_out:
+        for gcode_out, remap_pts, n_chunk in chunks:
+            if minimizer is not None:
+                with timer.stage('minimize'):
+                    gcode_out = minimizer.minimize(gcode_out)
+            with timer.stage('write'):
+                output.write(gcode_out)
+                remap_out.write(remap_pts)
+            n_lines += n_chunk
+            timer.counts['points'] += len(remap_pts)
+        timer.times['parse'] -= timer.times['interpolate'] - interpolate + timer.times['serialize'] - serialize
+        print(f"read {n_lines} lines of gcode from '{input_gcode_filename}'")
+        if minimize:
+            saved = minimizer.bytes_in - minimizer.bytes_out
+            print(f"minimized '{output_gcode_filename}' from {minimizer.bytes_in} to {minimizer.bytes_out} bytes, " \
+                    f"saving {saved} bytes ({100 * saved / max(minimizer.bytes_in, 1):.1f}%)")
+
+        grid_x, grid_y = np.meshgrid(*mesh_axes, indexing='ij')
+        grid_pts = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+        grid_z = np.trunc(remap_func(grid_pts) * 100000) / 100000.
+        with timer.stage('write'):
+            remap_out.write(np.column_stack((grid_pts, grid_z)))
+        timer.counts['points'] += len(grid_pts)
+    timer.counts['lines'] += n_lines
+    timer.counts['files'] += 1
+    return n_lines
+
+
+# the interpolator of each worker process, built once per process
+worker_mesh = None
+
+def remap_worker_init(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, surface_options: dict = {}):
+    global worker_mesh
+    worker_mesh = ((xv, yv), qtdraw_surface.surface_func(xv, yv, z, **surface_options))
+
+
+def remap_worker(filenames: (str, str, str), remap_options: dict) -> qtdraw_profile.StageTimer:
+    mesh_axes, remap_func = worker_mesh
+    timer = qtdraw_profile.StageTimer()
+    remap_gcode_file(*filenames, remap_func, mesh_axes, timer=timer, **remap_options)
+    return timer
+
+
+def output_filenames(input_gcode_filenames: list, output_gcode_pattern: str, \
+        remap_out_filename: str) -> list:
+    """Name the remapped gcode and point files of each input from the
+    patterns, {dir}, {name} and {stem} are replaced with the parts of the
+    input filename. Without fields the point file is put next to the gcode."""
+    filenames = []
+    for input_gcode_filename in input_gcode_filenames:
+        name = os.path.basename(input_gcode_filename)
+        fields = { \
+            'dir': os.path.dirname(input_gcode_filename) or '.', \
+            'name': name, \
+            'stem': os.path.splitext(name)[0], \
+        }
+        output_gcode_filename = output_gcode_pattern.format(**fields)
+        if '{' in remap_out_filename:
+            remap_out = remap_out_filename.format(**fields)
+        else:
+            remap_out = os.path.splitext(output_gcode_filename)[0] + '.remap' + \
+                    os.path.splitext(remap_out_filename)[1]
+        filenames.append((input_gcode_filename, output_gcode_filename, remap_out))
+    outputs = [f for _, output, remap_out in filenames for f in (output, remap_out)]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError(f"output pattern '{output_gcode_pattern}' gives the same filename for several inputs")
+    return filenames
+
+
+def is_output(filename: str, output_gcode_pattern: str) -> bool:
+    """Whether a gcode file is named like an output of the pattern, {stem}
+    and {name} matching anything, so earlier outputs aren't remapped again."""
+    pattern = output_gcode_pattern.format(dir=os.path.dirname(filename) or '.', name='*', stem='*')
+    return fnmatch.fnmatch(os.path.normpath(filename), os.path.normpath(pattern))
+
+
+def input_filenames(input_gcode_filename: (str, ...), output_gcode_pattern: str) -> (list, bool):
+    """Expand the input gcode globs, leaving out the outputs of earlier runs.
+    Returns the filenames and whether their outputs are named by the pattern,
+    which is when there is a glob or more than one input."""
+    filenames = []
+    for pattern in input_gcode_filename:
+        if not glob.has_magic(pattern):
+            filenames.append(pattern)
+            continue
+        matches = [f for f in sorted(glob.glob(pattern)) if not is_output(f, output_gcode_pattern)]
+        if len(matches) == 0:
+            raise click.ClickException(f"no gcode files to remap match '{pattern}'")
+        filenames.extend(matches)
+    named = len(input_gcode_filename) > 1 or any(glob.has_magic(pattern) for pattern in input_gcode_filename)
+    return filenames, named
+
+
+# the options shared by the remap tools, in the order they are listed
+REMAP_CLICK_OPTIONS = [
+    click.option('--input_mesh_filename', type=str, default='qtdraw_mesh.npz', help='probed mesh, .npz or .tsv'),
+    click.option('--remap_x_offset', type=float, default=30, help='an offset applied to the x coords'),
+    click.option('--remap_y_offset', type=float, default=30, help='an offset applied to the y coords'),
+    click.option('--machine_x_offset', type=float, default=0, help='an offset applied to the mesh x coords'),
+    click.option('--machine_y_offset', type=float, default=0, help='an offset applied to the mesh y coords'),
+    click.option('--remap_out_filename', type=str, default='qtdraw_mesh.remap.npy', help='remapped points in gcode as .npy, .npz, .parquet or .tsv'),
+    click.option('--remap_reference_xi_yj', nargs=2, type=int, default=(0, 0), help='index of probe measure point to use as tool touch off reference'),
+    click.option('--subdivide/--no-subdivide', default=False, help='split G1 moves where they cross the mesh grid lines so Z follows the mesh'),
+    click.option('--subdivide_tolerance', type=float, default=0, help='max deviation in mm from the mesh surface of a subdivided move, 0 splits at every grid line'),
+    click.option('--arc_tolerance', type=float, default=0.01, help='max chord error in mm when linearizing G2/G3 arcs'),
+    click.option('--fast_path/--no-fast_path', default=True, help='remap chunks in the vpype gwrite dialect without gcodeparser'),
+    click.option('--minimize/--no-minimize', default=False, help='drop repeated modal words and no-op moves and shorten numbers in the output'),
+    click.option('--machine_config', type=str, default=None, help='FluidNC config.yaml, the output coordinates are rounded to whole motor steps of its axes, the lines are otherwise kept unless --minimize'),
+    click.option('--chunk_lines', type=int, default=10000, help='lines of gcode read, remapped and written per chunk, 0 reads the whole file at once'),
+    click.option('--surface_model', type=click.Choice(qtdraw_surface.MODELS), default='grid', help='interpolate linearly on the probed grid or fit a poly, bicubic or thin plate spline surface to the probes'),
+    click.option('--surface_degree', type=int, default=3, help='total degree of the poly surface model'),
+    click.option('--surface_smoothing', type=float, default=0, help='smoothing of the bicubic and tps surface models, 0 goes through every probe'),
+]
+
+
+def remap_option_dicts(options: dict) -> (dict, dict, dict):
+    """Take the values of the remap options out of the options of a command
+    into the mesh_load, surface_func and remap_gcode_file options."""
+    mesh_options = {name: options.pop(name) for name in \
+            ('machine_x_offset', 'machine_y_offset', 'remap_reference_xi_yj')}
+    surface_options = { \
+        'model': options.pop('surface_model'), \
+        'degree': options.pop('surface_degree'), \
+        'smoothing': options.pop('surface_smoothing'), \
+    }
+    remap_options = {name: options.pop(name) for name in \
+            ('remap_x_offset', 'remap_y_offset', 'subdivide', 'subdivide_tolerance', \
+            'arc_tolerance', 'chunk_lines', 'fast_path', 'minimize')}
+    remap_options['steps_per_mm'] = None
+    machine_config = options.pop('machine_config')
+    if machine_config is not None:
+        remap_options['steps_per_mm'] = qtdraw_config.steps_per_mm(qtdraw_config.machine_config_read(machine_config))
+        print(f"rounding coordinates to whole steps of {remap_options['steps_per_mm']} steps per mm")
+    return mesh_options, surface_options, remap_options
+
+
+def remap_click_options(command):
+    """Decorate a click command, under its own options, with the remap
+    options. The command is passed input_mesh_filename, remap_out_filename
+    and the mesh_options, surface_options and remap_options dicts of
+    remap_option_dicts."""
+    @functools.wraps(command)
+    def remap_command(**kwargs):
+        mesh_options, surface_options, remap_options = remap_option_dicts(kwargs)
+        return command(mesh_options=mesh_options, surface_options=surface_options, \
+                remap_options=remap_options, **kwargs)
+    for option in reversed(REMAP_CLICK_OPTIONS):
+        remap_command = option(remap_command)
+    return remap_command
+
+
+@click.command()
+@click.option('--output_gcode_filename', type=str, default='input.qtdraw_remapped.gcode', help='output filename when remapping a single input filename, not a glob')
+@click.option('--input_gcode_filename', type=str, multiple=True, default=['input.gcode'], help='gcode file or glob to remap, can be given several times')
+@click.option('--output_gcode_pattern', type=str, default='{dir}/{stem}.remapped.gcode', help='output filename for each input when remapping a glob or several files, from {dir}, {name} and {stem} of the input')
+@click.option('--jobs', type=int, default=0, help='worker processes when remapping several files or one large file, 0 uses all cores')
+@click.option('--mesh_cache/--no-mesh_cache', default=True, help='reuse the compiled mesh saved next to the mesh tsv while it is unchanged')
+@click.option('--swap_mesh_axis', type=bool, default=True, help='swap the x and y axis for the mesh loading')
+@remap_click_options
+@qtdraw_profile.profiled('qtdraw_remap_gcode')
+def qtdraw_remap_gcode(output_gcode_filename: str, input_gcode_filename: (str, ...), \
+        output_gcode_pattern: str, jobs: int, mesh_cache: bool, swap_mesh_axis: bool, \
+        input_mesh_filename: str, remap_out_filename: str, \
+        mesh_options: dict, surface_options: dict, remap_options: dict, \
+        profiler: qtdraw_profile.Profile):
+    """Remap the Z of one or more gcode files onto a probed bed mesh."""
+    input_gcode_filenames, named = input_filenames(input_gcode_filename, output_gcode_pattern)
+    if named:
+        filenames = output_filenames(input_gcode_filenames, output_gcode_pattern, remap_out_filename)
+    else:
+        filenames = [(input_gcode_filenames[0], output_gcode_filename, remap_out_filename)]
+
+    with profiler.stage('mesh load'):
+        if mesh_cache:
+            xv, yv, z = mesh_load_cached(input_mesh_filename, **mesh_options)
+        else:
+            xv, yv, z = mesh_load(input_mesh_filename, **mesh_options)
+    surface_options['reference'] = qtdraw_surface.reference_xy(xv, yv, mesh_options['remap_reference_xi_yj'])
+    surface_model = surface_options['model']
+    if surface_model != 'grid':
+        with profiler.stage('surface fit'):
+            qtdraw_surface.print_residuals(surface_model, qtdraw_surface.surface_residuals(xv, yv, z, **surface_options))
+
+    if len(filenames) == 1:
+        with profiler.stage('surface fit'):
+            remap_func = qtdraw_surface.surface_func(xv, yv, z, **surface_options)
+        jobs = jobs if jobs > 0 else os.cpu_count()
+        if jobs == 1 or not os.path.exists(filenames[0][0]) or \
+                os.path.getsize(filenames[0][0]) < 2 * PARALLEL_CHUNK_BYTES:
+            with profiler.hot():
+                remap_gcode_file(*filenames[0], remap_func, (xv, yv), timer=profiler, **remap_options)
+            return
+        # a large file is cut into chunks that the workers remap in parallel
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, \
+                initializer=remap_worker_init, initargs=(xv, yv, z, surface_options)) as executor, profiler.hot():
+            remap_gcode_file(*filenames[0], remap_func, (xv, yv), timer=profiler, executor=executor, jobs=jobs, **remap_options)
+        return
+
+    if profiler.cprofile_filename is not None:
+        # cProfile only sees this process, so the files are remapped here one after another
+        print(f"remapping {len(filenames)} gcode files in this process for --cprofile_output")
+        with profiler.stage('surface fit'):
+            remap_func = qtdraw_surface.surface_func(xv, yv, z, **surface_options)
+        with profiler.hot():
+            for f in filenames:
+                remap_gcode_file(*f, remap_func, (xv, yv), timer=profiler, **remap_options)
+        print(f"remapped {profiler.counts['lines']} lines of gcode in {len(filenames)} files")
+        return
+
+    # the mesh is loaded once and handed to every worker, which build their
+    # interpolator once and then remap whole files
+    jobs = min(jobs if jobs > 0 else os.cpu_count(), len(filenames))
+    print(f"remapping {len(filenames)} gcode files with {jobs} processes")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, \
+            initializer=remap_worker_init, initargs=(xv, yv, z, surface_options)) as executor, profiler.hot():
+        futures = [executor.submit(remap_worker, f, remap_options) for f in filenames]
+        # the stage times of the workers add up to more than the wall time
+        for future in futures:
+            profiler.merge(future.result())
+    print(f"remapped {profiler.counts['lines']} lines of gcode in {len(filenames)} files")
 
 if __name__ == '__main__':
     qtdraw_remap_gcode()
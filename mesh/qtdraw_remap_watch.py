@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+import click
+
+import qtdraw_remap_gcode
+import qtdraw_surface
+
+
+def file_stat(filename: str) -> (int, int):
+    """The modification time and size, or None if the file is gone."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class RemapWatcher:
+    """Keep a mesh and its interpolator loaded and remap the gcode files of a
+    directory as they appear or change, once they have settled. The mesh is
+    reloaded when its file changes and every file is remapped again with it."""
+
+    def __init__(self, watch_dir: str, input_mesh_filename: str, mesh_options: dict, surface_options: dict, \
+            remap_options: dict, output_gcode_pattern: str, remap_out_filename: str, settle_seconds: float):
+        self.watch_dir = watch_dir
+        self.input_mesh_filename = input_mesh_filename
+        self.mesh_options = mesh_options
+        self.surface_options = surface_options
+        self.remap_options = remap_options
+        self.output_gcode_pattern = output_gcode_pattern
+        self.remap_out_filename = remap_out_filename
+        self.settle_seconds = settle_seconds
+        self.mesh_stat = None
+        self.mesh = None
+        # filename: (stat, time the stat was first seen) of files not remapped yet
+        self.pending = {}
+        # filename: stat of files remapped
+        self.done = {}
+        self.outputs = set()
+
+    def load_mesh(self) -> bool:
+        """Load the mesh if its file changed since the last load, a mesh that
+        fails to load keeps the previous one until the next change."""
+        stat = file_stat(self.input_mesh_filename)
+        if stat is None or stat == self.mesh_stat:
+            return False
+        try:
+            xv, yv, z = qtdraw_remap_gcode.mesh_load_cached(self.input_mesh_filename, **self.mesh_options)
+            reference = qtdraw_surface.reference_xy(xv, yv, self.mesh_options['remap_reference_xi_yj'])
+            remap_func = qtdraw_surface.surface_func(xv, yv, z, reference=reference, **self.surface_options)
+        except Exception as e:
+            print(f"could not load mesh '{self.input_mesh_filename}', keeping the previous one: {e}")
+            return False
+        self.mesh_stat = stat
+        self.mesh = ((xv, yv), remap_func)
+        return True
+
+    def is_output(self, filename: str) -> bool:
+        # outputs from before this run are recognised by the pattern
+        return filename in self.outputs or qtdraw_remap_gcode.is_output(filename, self.output_gcode_pattern)
+
+    def scan(self, now: float):
+        for entry in os.scandir(self.watch_dir):
+            filename = os.path.normpath(entry.path)
+            if not entry.is_file() or not entry.name.endswith('.gcode') or self.is_output(filename):
+                continue
+            stat = file_stat(filename)
+            if stat is None or self.done.get(filename) == stat:
+                continue
+            if filename not in self.done and filename not in self.pending:
+                # already remapped by an earlier run if the output is newer
+                output = qtdraw_remap_gcode.output_filenames([filename], \
+                        self.output_gcode_pattern, self.remap_out_filename)[0][1]
+                output_stat = file_stat(output)
+                if output_stat is not None and output_stat[0] >= stat[0]:
+                    self.done[filename] = stat
+                    continue
+            if filename not in self.pending or self.pending[filename][0] != stat:
+                self.pending[filename] = (stat, now)
+
+    def remap(self, filename: str):
+        filenames = qtdraw_remap_gcode.output_filenames([filename], \
+                self.output_gcode_pattern, self.remap_out_filename)[0]
+        output_gcode_filename = filenames[1]
+        # write then rename so an uploader never picks up half a file
+        temporary_filename = output_gcode_filename + '.tmp'
+        mesh_axes, remap_func = self.mesh
+        start = time.perf_counter()
+        try:
+            qtdraw_remap_gcode.remap_gcode_file(filenames[0], temporary_filename, filenames[2], \
+                    remap_func, mesh_axes, **self.remap_options)
+            os.replace(temporary_filename, output_gcode_filename)
+        except Exception as e:
+            print(f"could not remap '{filename}': {e}")
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+        else:
+            print(f"remapped '{filename}' to '{output_gcode_filename}' in {time.perf_counter() - start:.2f}s")
+        self.outputs.add(os.path.normpath(output_gcode_filename))
+
+    def poll(self, settle: bool = True) -> int:
+        """Remap the files that haven't changed for settle_seconds, or all
+        pending files if not settle. Returns the number of files remapped."""
+        now = time.monotonic()
+        if self.load_mesh() and len(self.done) > 0:
+            print(f"mesh '{self.input_mesh_filename}' changed, remapping {len(self.done)} files again")
+            for filename in self.done:
+                self.pending[filename] = (None, now)
+            self.done = {}
+        self.scan(now)
+        if self.mesh is None:
+            return 0
+        remapped = 0
+        for filename, (stat, seen) in list(self.pending.items()):
+            if settle and now - seen < self.settle_seconds:
+                continue
+            del self.pending[filename]
+            stat = file_stat(filename)
+            if stat is None:
+                continue
+            self.remap(filename)
+            self.done[filename] = stat
+            remapped += 1
+        return remapped
+
+
+@click.command()
+@click.option('--watch_dir', type=str, default='.', help='directory to watch for new or changed .gcode files')
+@click.option('--poll_interval', type=float, default=0.1, help='seconds between looks at the directory')
+@click.option('--settle_seconds', type=float, default=0.3, help='seconds a file has to stay unchanged before it is remapped')
+@click.option('--once/--no-once', default=False, help='remap what is there now and exit instead of watching')
+@click.option('--output_gcode_pattern', type=str, default='{dir}/{stem}.remapped.gcode', help='output filename for each input, from {dir}, {name} and {stem} of the input')
+@qtdraw_remap_gcode.remap_click_options
+def qtdraw_remap_watch(watch_dir: str, poll_interval: float, settle_seconds: float, once: bool, \
+        output_gcode_pattern: str, input_mesh_filename: str, remap_out_filename: str, \
+        mesh_options: dict, surface_options: dict, remap_options: dict):
+    """Remap gcode files as they show up in a directory, keeping the mesh loaded."""
+    watcher = RemapWatcher(watch_dir, input_mesh_filename, mesh_options, surface_options, remap_options, \
+            output_gcode_pattern, remap_out_filename, settle_seconds)
+    watcher.load_mesh()
+    if watcher.mesh is None:
+        raise click.ClickException(f"could not load mesh '{input_mesh_filename}'")
+    if once:
+        print(f"remapped {watcher.poll(settle=False)} files in '{watch_dir}'")
+        return
+
+    print(f"watching '{watch_dir}' for gcode to remap, ctrl-c to stop")
+    try:
+        while True:
+            watcher.poll()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        print(f"stopped watching '{watch_dir}'")
+
+
+if __name__ == '__main__':
+    qtdraw_remap_watch()
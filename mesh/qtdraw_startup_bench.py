@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+# modules a light subcommand shouldn't pull in
+HEAVY_MODULES = ('scipy', 'pandas', 'matplotlib', 'gcodeparser', 'asyncio')
+
+
+def startup_cases(work_dir: str) -> list:
+    """(name, qtdraw arguments, light) of each invocation to time, light ones
+    are held to --max_ms."""
+    log_filename = os.path.join(work_dir, 'probe.log')
+    with open(log_filename, 'w') as output:
+        for i in range(110):
+            output.write(f"[PRB:{i % 10 * 20.:.3f},{i // 10 * 20.:.3f},-0.500:1]\n")
+    return [ \
+        ('help', ['--help'], True), \
+        ('probe-gcode help', ['probe-gcode', '--help'], True), \
+        ('probe-gcode', ['probe-gcode', '--output_gcode_filename', os.path.join(work_dir, 'probe.gcode')], True), \
+        ('parse', ['parse', '--input_log_filename', log_filename, \
+                '--output_mesh_filename', os.path.join(work_dir, 'mesh.npz')], True), \
+        ('remap help', ['remap', '--help'], False), \
+        ('plot help', ['plot', '--help'], False), \
+    ]
+
+
+def heavy_imports(args: list) -> list:
+    """The HEAVY_MODULES one run of qtdraw with args imports."""
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qtdraw_cli.py')
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', cli, *args], \
+            capture_output=True, text=True, check=True).stderr
+    imported = {line.rsplit('|', 1)[-1].strip() for line in stderr.splitlines() if line.startswith('import time:')}
+    return [module for module in HEAVY_MODULES if module in imported]
+
+
+@click.command()
+@click.option('--repeat', type=int, default=10, help='runs of each invocation')
+@click.option('--max_ms', type=float, default=150, help='fastest start up a light invocation may take before failing')
+def qtdraw_startup_bench(repeat, max_ms):
+    """Benchmark the start up time of qtdraw subcommands in fresh interpreters."""
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qtdraw_cli.py')
+    slow = []
+    with tempfile.TemporaryDirectory(prefix='qtdraw_startup_bench_') as work_dir:
+        for name, args, light in startup_cases(work_dir):
+            ms = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, cli, *args], stdout=subprocess.DEVNULL, check=True)
+                ms.append((time.perf_counter() - start) * 1000)
+            heavy = heavy_imports(args)
+            print(f"{name:>16}: {min(ms):.0f} ms min {statistics.median(ms):.0f} ms median" \
+                    + (f", imports {', '.join(heavy)}" if len(heavy) > 0 else ''))
+            if light and (min(ms) > max_ms or len(heavy) > 0):
+                slow.append(name)
+    if len(slow) > 0:
+        raise click.ClickException(f"{', '.join(slow)} took more than {max_ms:.0f} ms or imported a heavy module")
+
+
+if __name__ == '__main__':
+    qtdraw_startup_bench()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Bed surface models for the remapper. grid interpolates linearly on the
+probed grid, the others fit a smooth surface to the probes, which averages
+out probe noise and needs fewer probe points."""
+
+import click
+import numpy as np
+
+MODELS = ('grid', 'poly', 'bicubic', 'tps')
+
+
+class PolySurface:
+    """Least squares 2D polynomial of a total degree, in coordinates scaled
+    to -1..1 over the probed area to keep the fit well conditioned."""
+
+    def __init__(self, pts: np.ndarray, z: np.ndarray, degree: int):
+        self.powers = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+        if len(pts) < len(self.powers):
+            raise ValueError(f"a degree {degree} polynomial needs {len(self.powers)} probe points, found {len(pts)}")
+        self.center = (pts.max(axis=0) + pts.min(axis=0)) / 2
+        self.scale = (pts.max(axis=0) - pts.min(axis=0)) / 2
+        self.scale[self.scale == 0] = 1
+        self.coef = np.linalg.lstsq(self.vander(pts), z, rcond=None)[0]
+
+    def vander(self, pts: np.ndarray) -> np.ndarray:
+        u = (pts - self.center) / self.scale
+        return np.column_stack([u[:, 0] ** i * u[:, 1] ** j for i, j in self.powers])
+
+    def __call__(self, pts: np.ndarray) -> np.ndarray:
+        return self.vander(np.asarray(pts, dtype=float)) @ self.coef
+
+
+class SplineSurface:
+    """Bicubic smoothing spline over the probed grid, lower order when there
+    are too few probes on an axis for cubic."""
+
+    def __init__(self, xv: np.ndarray, yv: np.ndarray, z: np.ndarray, smoothing: float):
+        import scipy.interpolate
+        k = min(3, len(xv) - 1, len(yv) - 1)
+        self.spline = scipy.interpolate.RectBivariateSpline(xv, yv, z, kx=k, ky=k, s=smoothing)
+
+    def __call__(self, pts: np.ndarray) -> np.ndarray:
+        pts = np.asarray(pts, dtype=float)
+        return self.spline.ev(pts[:, 0], pts[:, 1])
+
+
+class ZeroedSurface:
+    """A fitted surface shifted to be 0 at the reference point, where the
+    probes it was fitted to were zeroed, as the fit doesn't go through it."""
+
+    def __init__(self, surface, reference: (float, float)):
+        self.surface = surface
+        self.offset = surface(np.array([reference], dtype=float))[0]
+
+    def __call__(self, pts: np.ndarray) -> np.ndarray:
+        return self.surface(pts) - self.offset
+
+
+def surface_func(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, model: str = 'grid', \
+        degree: int = 3, smoothing: float = 0, reference: (float, float) = None):
+    """The surface of a model fitted to the Z grid over the xv, yv axes, as a
+    function of (n, 2) points like RegularGridInterpolator. smoothing is the
+    spline smoothing factor of bicubic and the regularisation of tps, 0
+    goes through every probe. A fitted model is shifted to be 0 at the
+    reference xy if given, the touch off probe the grid is zeroed at."""
+    # scipy is only needed once a surface is built
+    import scipy.interpolate
+    if model == 'grid':
+        return scipy.interpolate.RegularGridInterpolator((xv, yv), z)
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    pts = np.column_stack((x.ravel(), y.ravel()))
+    if model == 'poly':
+        surface = PolySurface(pts, z.ravel(), degree)
+    elif model == 'bicubic':
+        surface = SplineSurface(xv, yv, z, smoothing)
+    elif model == 'tps':
+        surface = scipy.interpolate.RBFInterpolator(pts, z.ravel(), kernel='thin_plate_spline', smoothing=smoothing)
+    else:
+        raise ValueError(f"unknown surface model '{model}', expected one of {', '.join(MODELS)}")
+    if reference is None:
+        return surface
+    return ZeroedSurface(surface, reference)
+
+
+def reference_xy(xv: np.ndarray, yv: np.ndarray, remap_reference_xi_yj: (int, int)) -> (float, float):
+    """The xy of the touch off probe at an index of the grid."""
+    return xv[remap_reference_xi_yj[0]].item(), yv[remap_reference_xi_yj[1]].item()
+
+
+def surface_residuals(xv: np.ndarray, yv: np.ndarray, z: np.ndarray, model: str, \
+        degree: int = 3, smoothing: float = 0, reference: (float, float) = None) -> dict:
+    """RMS and max of the model minus the probes, for the model fitted to all
+    the probes and for the model fitted to every other row and column of
+    probes, checked at the probes left out. The second tells how well the
+    model does on a mesh probed at half the density."""
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    pts = np.column_stack((x.ravel(), y.ravel()))
+    residual = surface_func(xv, yv, z, model, degree, smoothing, reference)(pts) - z.ravel()
+    residuals = { \
+        'fit_rms': np.sqrt(np.mean(residual ** 2)), \
+        'fit_max': np.abs(residual).max(), \
+        'holdout_rms': np.nan, \
+        'holdout_max': np.nan, \
+    }
+    # keep the edges so the left out probes are inside the sparse mesh
+    xi = np.unique(np.r_[0:len(xv):2, len(xv) - 1])
+    yi = np.unique(np.r_[0:len(yv):2, len(yv) - 1])
+    left_out = np.ones(z.shape, dtype=bool)
+    left_out[np.ix_(xi, yi)] = False
+    if not left_out.any():
+        return residuals
+    try:
+        sparse = surface_func(xv[xi], yv[yi], z[np.ix_(xi, yi)], model, degree, smoothing, reference)
+    except ValueError:
+        return residuals
+    residual = sparse(np.column_stack((x[left_out], y[left_out]))) - z[left_out]
+    residuals['holdout_rms'] = np.sqrt(np.mean(residual ** 2))
+    residuals['holdout_max'] = np.abs(residual).max()
+    return residuals
+
+
+def print_residuals(model: str, residuals: dict):
+    print(f"{model:>8} surface fit rms {residuals['fit_rms']:.4f} max {residuals['fit_max']:.4f} mm, " \
+            f"from every other probe rms {residuals['holdout_rms']:.4f} max {residuals['holdout_max']:.4f} mm")
+
+
+@click.command()
+@click.option('--input_mesh_filename', type=str, default='qtdraw_mesh.npz', help='probed mesh, .npz or .tsv')
+@click.option('--surface_model', type=click.Choice(MODELS), multiple=True, default=MODELS, help='models to report on, can be given several times')
+@click.option('--surface_degree', type=int, default=3, help='total degree of the poly model')
+@click.option('--surface_smoothing', type=float, default=0, help='smoothing of the bicubic and tps models, 0 goes through every probe')
+@click.option('--machine_x_offset', type=float, default=0, help='an offset applied to the mesh x coords')
+@click.option('--machine_y_offset', type=float, default=0, help='an offset applied to the mesh y coords')
+@click.option('--remap_reference_xi_yj', nargs=2, type=int, default=(0, 0), help='index of probe measure point to use as tool touch off reference')
+def qtdraw_surface(input_mesh_filename: str, surface_model: (str, ...), surface_degree: int, \
+        surface_smoothing: float, machine_x_offset: float, machine_y_offset: float, \
+        remap_reference_xi_yj: (int, int)):
+    """Report how well each surface model fits a probed mesh."""
+    import qtdraw_remap_gcode
+    xv, yv, z = qtdraw_remap_gcode.mesh_load(input_mesh_filename, machine_x_offset, machine_y_offset, remap_reference_xi_yj)
+    for model in surface_model:
+        print_residuals(model, surface_residuals(xv, yv, z, model, surface_degree, surface_smoothing, \
+                reference_xy(xv, yv, remap_reference_xi_yj)))
+
+
+if __name__ == '__main__':
+    qtdraw_surface()
@@ -0,0 +1,60 @@
+"""Synthetic bed meshes and G-code for exercising the mesh tools without a
+plotter attached."""
+
+import numpy as np
+
+
+def synthetic_surface(x: np.ndarray, y: np.ndarray, lim: (float, float) = (200, 240), \
+        amplitude: float = 1.0) -> np.ndarray:
+    """A bed that sags in the middle with a gentle twist and ripple, roughly
+    the shape and size of what the probe finds on the qtdraw, and a local
+    bump like a warped corner or a paper clip that only dense probing sees."""
+    u = np.asarray(x, dtype=float) / lim[0]
+    v = np.asarray(y, dtype=float) / lim[1]
+    bowl = -((u - 0.45) ** 2 + (v - 0.55) ** 2)
+    twist = 0.3 * (u - 0.5) * (v - 0.5)
+    ripple = 0.05 * np.sin(3 * np.pi * u) * np.cos(2 * np.pi * v)
+    bump = 0.4 * np.exp(-((u - 0.8) ** 2 + ((v - 0.25) * lim[1] / lim[0]) ** 2) / (2 * 0.06 ** 2))
+    return amplitude * (4 * bowl + twist + ripple + bump)
+
+
+def synthetic_mesh(div: (int, int), lim: (float, float) = (200, 240), \
+        offset: (float, float) = (22, 27), noise: float = 0.0, seed: int = 0) -> 'pd.DataFrame':
+    """A probed mesh table like qtdraw_mesh.py --work-mode parse writes, on a
+    div[0] x div[1] grid over lim, shifted by the probe offset."""
+    # only the benchmark wants a table, the simulated controller doesn't
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(0, lim[0], div[0]), np.linspace(0, lim[1], div[1]), indexing='ij')
+    z = synthetic_surface(x, y, lim) + rng.normal(0, noise, x.shape) if noise > 0 \
+            else synthetic_surface(x, y, lim)
+    return pd.DataFrame({'x': x.ravel() + offset[0], 'y': y.ravel() + offset[1], 'z': z.ravel().round(3)})
+
+
+def synthetic_gcode(output, n_lines: int, size: (float, float) = (150, 150), \
+        segments: (int, int) = (1, 40), step: float = 20, seed: int = 0):
+    """Write about n_lines of gcode in the [gwrite.qtdraw] vpype dialect, made
+    of random walk polylines inside size, to an open text file."""
+    rng = np.random.default_rng(seed)
+    output.write("G21\n(Start Layer)\nG0 G53 Z24 F100\nG0 G53 X22 Y27 F100\nM0\n")
+    written = 5
+    while written < n_lines:
+        # a batch of polylines formatted in one go
+        n_polylines = 1000
+        counts = rng.integers(segments[0], segments[1] + 1, n_polylines)
+        walk = rng.uniform(-step, step, (counts.sum() + n_polylines, 2))
+        starts = np.concatenate(([0], np.cumsum(counts + 1)[:-1]))
+        walk[starts] = rng.uniform((0, 0), size, (n_polylines, 2))
+        # restart the cumulative sum at each polyline
+        position = np.cumsum(walk, axis=0)
+        position -= np.repeat(position[starts] - walk[starts], counts + 1, axis=0)
+        position = np.clip(position, (0, 0), size)
+        for first, count in zip(starts.tolist(), counts.tolist()):
+            polyline = position[first:first + count + 1]
+            output.write("(Start Block)\nG00 Z2\nG00 X%.4f Y%.4f\nG01 Z0 F600\n" % tuple(polyline[0]))
+            output.write(("G01 X%.4f Y%.4f Z0\n" * count) % tuple(polyline[1:].ravel()))
+            output.write("G00 Z2\n")
+            written += count + 5
+            if written >= n_lines:
+                break
+    output.write("G01 Z5\nG00 X0.0000 Y0.0000\n")
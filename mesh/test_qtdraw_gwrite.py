@@ -0,0 +1,47 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+import qtdraw_gwrite
+
+# the layers vpype reads from testdata/gwrite/multi.svg, the .gcode next to
+# it were written by vpype 1.15 and vpype-gcode 0.13 with
+# vpype --config gwrite.toml read multi.svg gwrite -p <profile> <profile>.gcode
+GWRITE_DATA = os.path.join(os.path.dirname(__file__), 'testdata', 'gwrite')
+MULTI_SVG_LAYERS = { \
+    1: [[10+20j, 110.5+20j, 110.5+95.25j], [30+40j, 37.8+41.3j]], \
+    2: [[200+150j, 250+175j, 300+150j, 350+290.125j]], \
+    3: [[5+5j, 6+6j]], \
+}
+MULTI_SVG_PAGE_SIZE = (400., 300.)
+
+
+@pytest.mark.parametrize('profile_name, fast', [('qtdraw', True), ('fields', True), ('steps', False)])
+def test_gwrite_same_as_vpype(profile_name, fast):
+    profile = qtdraw_gwrite.gwrite_config_read(os.path.join(GWRITE_DATA, 'gwrite.toml'), profile_name)
+    output = io.StringIO()
+    assert qtdraw_gwrite.gwrite(output, MULTI_SVG_LAYERS, profile, f'{profile_name}.gcode', \
+            page_size=MULTI_SVG_PAGE_SIZE) == fast
+    with open(os.path.join(GWRITE_DATA, f'{profile_name}.gcode')) as expected:
+        assert output.getvalue() == expected.read()
+
+
+@pytest.mark.parametrize('profile_name', ['qtdraw', 'fields'])
+def test_bulk_same_as_vertices(profile_name):
+    profile = qtdraw_gwrite.gwrite_config_read(os.path.join(GWRITE_DATA, 'gwrite.toml'), profile_name)
+    rng = np.random.default_rng(0)
+    # lines of one vertex and an empty layer too
+    layers = {layer_id: [rng.uniform(0, 800, n) + 1j * rng.uniform(0, 600, n) for n in rng.integers(1, 9, n_lines)] \
+            for layer_id, n_lines in ((1, 40), (4, 0), (2, 1), (7, 25))}
+    formats = {name: qtdraw_gwrite.percent_format(profile.get(name)) \
+            for name in ('segment_first', 'segment', 'segment_last')}
+    vertices = io.StringIO()
+    qtdraw_gwrite.gwrite_vertices(qtdraw_gwrite.TemplateWriter(vertices, profile), \
+            qtdraw_gwrite.gwrite_transform(layers, profile), 'out.gcode')
+    for chunk_lines in (1, 3, qtdraw_gwrite.CHUNK_LINES):
+        bulk = io.StringIO()
+        qtdraw_gwrite.gwrite_bulk(qtdraw_gwrite.TemplateWriter(bulk, profile), \
+                qtdraw_gwrite.gwrite_transform(layers, profile), 'out.gcode', formats, chunk_lines)
+        assert bulk.getvalue() == vertices.getvalue()
@@ -0,0 +1,62 @@
+import click.testing
+import numpy as np
+import pytest
+
+import qtdraw_mesh
+import qtdraw_meshfile
+
+
+def probe_run(output_mesh_filename: str) -> click.testing.Result:
+    result = click.testing.CliRunner().invoke(qtdraw_mesh.qt_mesh, ['--work-mode', 'probe', '--simulate', \
+            '--lim', '20', '24', '--div', '3', '4', '--output_mesh_filename', output_mesh_filename])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def test_probe_resumes_from_partial_probing_tsv(tmp_path):
+    probe_run(str(tmp_path / 'full.tsv'))
+    full = (tmp_path / 'full.tsv').read_text().splitlines()
+    assert len(full) == 1 + 12
+    (tmp_path / 'mesh.probing.tsv').write_text('\n'.join(full[:1 + 5]) + '\n')
+    result = probe_run(str(tmp_path / 'mesh.npz'))
+    assert 'resuming, 5 of 12 points' in result.output
+    assert 'probed 7 points' in result.output
+    assert not (tmp_path / 'mesh.probing.tsv').exists()
+    expected = qtdraw_meshfile.mesh_grid(qtdraw_meshfile.tsv_read(str(tmp_path / 'full.tsv')))
+    for got, want in zip(qtdraw_meshfile.mesh_read(str(tmp_path / 'mesh.npz')), expected):
+        assert np.array_equal(got, want)
+
+
+def test_refine_plan_leaves_a_plane_alone():
+    xv, yv = np.linspace(0, 200, 6), np.linspace(0, 240, 7)
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    fxv, fyv, estimate, probe = qtdraw_mesh.refine_plan(xv, yv, 0.001 * x - 0.002 * y + 0.1, 2, 0.001)
+    assert (len(fxv), len(fyv)) == (11, 13)
+    assert estimate.shape == (5, 6) and np.abs(estimate).max() < 1e-9
+    assert not probe.any()
+
+
+def test_refine_plan_probes_the_bump_and_merge_puts_it_on_the_fine_grid():
+    xv, yv = np.linspace(0, 200, 6), np.linspace(0, 240, 7)
+    bump = lambda x, y: 0.5 * np.exp(-((x - 100) ** 2 + (y - 120) ** 2) / 800)
+    z = bump(*np.meshgrid(xv, yv, indexing='ij'))
+    fxv, fyv, estimate, probe = qtdraw_mesh.refine_plan(xv, yv, z, 3, 0.02)
+    refined_cells = estimate > 0.02
+    assert refined_cells.any() and not refined_cells.all()
+    # the probed nodes are those of the refined cells, less the coarse ones
+    assert not probe[::3, ::3].any()
+    i, j = np.nonzero(refined_cells)
+    assert probe[3 * i + 1, 3 * j + 1].all()
+
+    fx, fy = np.meshgrid(fxv, fyv, indexing='ij')
+    refined = np.column_stack((fx[probe], fy[probe], bump(fx[probe], fy[probe])))
+    # probes a little off the nodes snap to them
+    refined[:, :2] += 0.1
+    mxv, myv, mz = qtdraw_mesh.merge_refined(xv, yv, z, refined, 3)
+    assert np.array_equal(mxv, fxv) and np.array_equal(myv, fyv)
+    assert np.array_equal(mz[::3, ::3], z)
+    assert np.array_equal(mz[probe], refined[:, 2])
+
+    refined[0, :2] += 20
+    with pytest.raises(ValueError, match='off the fine grid'):
+        qtdraw_mesh.merge_refined(xv, yv, z, refined, 3)
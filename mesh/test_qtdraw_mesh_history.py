@@ -0,0 +1,60 @@
+import re
+
+import click.testing
+import numpy as np
+import pytest
+
+import qtdraw_mesh_history
+import qtdraw_meshfile
+
+
+def history_run(*args: str) -> str:
+    result = click.testing.CliRunner().invoke(qtdraw_mesh_history.qtdraw_mesh_history, list(args))
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_append_two_meshes_and_report_drift(tmp_path):
+    xv, yv = np.linspace(0, 200, 5), np.linspace(0, 240, 7)
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    z = 0.1 * np.sin(x / 40) * np.cos(y / 30)
+    # a day later the bed has tilted 0.02 mm over x and the probe touched off 0.5 mm higher
+    drift = 0.02 * x / 200
+    for name, z_run, timestamp in (('a', z, '2026-01-01T10:00:00'), ('b', z + drift + 0.5, '2026-01-02T10:00:00')):
+        qtdraw_meshfile.mesh_write(str(tmp_path / f'{name}.npz'), qtdraw_meshfile.grid_probes(xv, yv, z_run), \
+                {'timestamp': timestamp, 'probe_offset': [22, 27]})
+    history_dir = str(tmp_path / 'history')
+    output = history_run('--work-mode', 'append', '--history_dir', history_dir, \
+            '--input_mesh_filename', str(tmp_path / '*.npz'))
+    assert "as run 0" in output and "as run 1" in output
+    history = qtdraw_mesh_history.MeshHistory(history_dir)
+    assert len(history) == 2 and history.probe_offset == (22, 27)
+    assert np.array_equal(history.z()[1], z + drift + 0.5)
+
+    stats_filename = str(tmp_path / 'stats.npz')
+    history_run('--history_dir', history_dir, '--no-remove_offset', '--output_stats_filename', stats_filename)
+    with np.load(stats_filename) as stats:
+        assert stats['count'].tolist() == np.full(z.shape, 2).tolist()
+        assert stats['trend'] == pytest.approx(drift + 0.5)
+        assert stats['std'] == pytest.approx((drift + 0.5) / 2)
+    # taking off the mean of each run leaves the tilt less its mean
+    output = history_run('--history_dir', history_dir, '--output_stats_filename', stats_filename)
+    with np.load(stats_filename) as stats:
+        assert stats['trend'] == pytest.approx(drift - drift.mean())
+        assert stats['mean'] == pytest.approx(z - z.mean() + (drift - drift.mean()) / 2)
+    # the tilt is steepest at both edges of x, whichever of them is reported
+    assert re.search(r"^std: median 0\.0025 max 0\.0050 at x (0|200)\.0 y [0-9.]+ mm$", output, re.M)
+    assert re.search(r"^trend: median 0\.0000 max -?0\.0100 at x (0|200)\.0 y [0-9.]+ mm/day$", output, re.M)
+
+
+def test_interrupted_append_is_written_over(tmp_path):
+    xv, yv = np.linspace(0, 10, 3), np.linspace(0, 20, 4)
+    history = qtdraw_mesh_history.MeshHistory(str(tmp_path))
+    history.append(xv, yv, np.zeros((3, 4)), 0., 'a')
+    # half a grid with no time, as a run stopped while appending leaves
+    with open(history.path('z.f64'), 'ab') as output:
+        output.write(np.ones(6).tobytes())
+    assert len(history) == 1
+    assert history.append(xv, yv, np.full((3, 4), 2.), 1., 'b') == 1
+    assert np.array_equal(history.z(), [np.zeros((3, 4)), np.full((3, 4), 2.)])
+    assert history.t().tolist() == [0., 1.]
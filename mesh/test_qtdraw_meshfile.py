@@ -0,0 +1,55 @@
+import zipfile
+
+import numpy as np
+
+import qtdraw_meshfile
+
+
+def write_npz(filename: str, arrays: dict, force_zip64: bool, compression: int = zipfile.ZIP_STORED):
+    with zipfile.ZipFile(filename, 'w', compression) as npz:
+        for name, array in arrays.items():
+            with npz.open(name + '.npy', 'w', force_zip64=force_zip64) as member:
+                np.lib.format.write_array(member, array)
+
+
+def test_mesh_write_read_round_trip(tmp_path):
+    xv, yv = np.linspace(0, 200, 5), np.linspace(0, 240, 7)
+    z = np.random.default_rng(0).normal(0, 0.1, (5, 7))
+    filename = str(tmp_path / 'mesh.npz')
+    qtdraw_meshfile.mesh_write(filename, qtdraw_meshfile.grid_probes(xv, yv, z)[::-1], {'source': 'test'})
+    mesh = qtdraw_meshfile.mesh_read(filename)
+    with np.load(filename) as npz:
+        for got, want, name in zip(mesh, (xv, yv, z), ('xv', 'yv', 'z')):
+            assert isinstance(got, np.memmap)
+            assert np.array_equal(got, want) and np.array_equal(got, npz[name])
+    assert qtdraw_meshfile.probes_read(filename)[1]['source'] == 'test'
+    # a partial mesh is kept as x, y, z rows in order
+    qtdraw_meshfile.mesh_write(filename, qtdraw_meshfile.grid_probes(xv, yv, z)[:-3])
+    xyz, metadata = qtdraw_meshfile.probes_read(filename)
+    assert isinstance(xyz, np.memmap) and metadata == {}
+    assert np.array_equal(xyz, qtdraw_meshfile.grid_probes(xv, yv, z)[:-3])
+
+
+def test_npz_arrays_with_and_without_zip64_extras(tmp_path):
+    arrays = { \
+        'z': np.arange(12.).reshape((3, 4)), \
+        'f': np.asfortranarray(np.arange(6, dtype=np.int32).reshape((2, 3))), \
+        'empty': np.empty((0, 3)), \
+        'metadata': np.array('{}'), \
+    }
+    for force_zip64 in (True, False):
+        filename = str(tmp_path / f'{force_zip64}.npz')
+        write_npz(filename, arrays, force_zip64)
+        with zipfile.ZipFile(filename) as npz, open(filename, 'rb') as input:
+            input.seek(npz.getinfo('z.npy').header_offset + 28)
+            assert (input.read(2) != b'\0\0') == force_zip64
+        read = qtdraw_meshfile.npz_arrays(filename)
+        for name, array in arrays.items():
+            assert np.array_equal(read[name], array) and read[name].dtype == array.dtype
+        assert isinstance(read['z'], np.memmap) and isinstance(read['f'], np.memmap)
+        assert read['f'].flags.f_contiguous
+    # compressed members and mmap=False are read into memory
+    write_npz(str(tmp_path / 'deflated.npz'), arrays, True, zipfile.ZIP_DEFLATED)
+    for read in (qtdraw_meshfile.npz_arrays(str(tmp_path / 'deflated.npz')), \
+            qtdraw_meshfile.npz_arrays(str(tmp_path / 'True.npz'), mmap=False)):
+        assert not isinstance(read['z'], np.memmap) and np.array_equal(read['z'], arrays['z'])
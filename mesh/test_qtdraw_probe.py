@@ -0,0 +1,88 @@
+import asyncio
+import io
+
+import numpy as np
+import pytest
+
+import qtdraw_mesh
+import qtdraw_probe
+
+
+def test_prb_read_no_probes():
+    for log in (b'[PRB:1,2,3:0]\nok\n', b''):
+        xyz, skipped, failed = qtdraw_probe.prb_read(io.BytesIO(log))
+        assert xyz.shape == (0, 3)
+    assert (skipped, failed) == (0, 0)
+    assert qtdraw_probe.prb_read(io.BytesIO(b'[PRB:1,2,3:0]\nok\n'))[1:] == (1, 1)
+
+
+def test_prb_read_skips_status_reports_and_failed_probes():
+    log = b'<Idle|MPos:10.000,20.000,2.000|FS:0,0>\n[PRB:10.000,20.000,-0.125:1]\nok\n' \
+            b'[MSG:INFO: probe]\n[PRB:30.000,20.000,-1.000:0]\nALARM:5\n[PRB:50.000,-20.5,+.25:1]\nok'
+    xyz, skipped, failed = qtdraw_probe.prb_read(io.BytesIO(log))
+    assert xyz.tolist() == [[10., 20., -0.125], [50., -20.5, 0.25]]
+    assert (skipped, failed) == (5, 1)
+
+
+def test_prb_read_keeps_the_slow_probe():
+    # the fast then slow probe cycle reports twice at each x, y
+    log = b'[PRB:10.000,20.000,-0.100:1]\n[PRB:10.000,20.000,-0.125:1]\n' \
+            b'[PRB:30.000,20.000,-0.300:1]\n[PRB:30.000,20.000,-0.325:1]\n[PRB:10.000,20.000,-0.130:1]\n'
+    xyz, skipped, failed = qtdraw_probe.prb_read(io.BytesIO(log))
+    assert xyz.tolist() == [[10., 20., -0.125], [30., 20., -0.325], [10., 20., -0.13]]
+
+
+def test_prb_read_report_across_chunks():
+    log = b'<Idle|MPos:0.000,0.000,0.000|FS:0,0>\n' * 3 \
+            + b''.join(b'[PRB:%d.500,%d.250,-0.%03d:1]\nok\n' % (i, 2 * i, i) for i in range(50))
+    expected = qtdraw_probe.prb_read(io.BytesIO(log))
+    assert len(expected[0]) == 50
+    for chunk_bytes in (1, 7, 16, 100):
+        xyz, skipped, failed = qtdraw_probe.prb_read(io.BytesIO(log), chunk_bytes)
+        assert np.array_equal(xyz, expected[0])
+        assert (skipped, failed) == expected[1:]
+
+
+@pytest.mark.parametrize('report, scanned', [(b'[PRB:1,2:1]', True), (b'[PRB:-0,.5,3.:1]', True), \
+        (b'[PRB:1,2,3:2]', True), (b'[PRB:1,2,3:1', True), (b'[PRB:1,2,3,4:1]', False), \
+        (b'[PRB:1.5.5,2,3:1]', False), (b'[PRB:1,,3:1]', False), (b'[PRB:1234567890123456,2,3:1]', False)])
+def test_prb_scan_same_as_regex(report, scanned):
+    # what the array scan can't read it leaves to the regex
+    chunk = b'[PRB:10.000,20.000,-0.125:1]\n' + report + b'\n[PRB:10,20,-0.5:0]\n'
+    found = qtdraw_probe.prb_scan(chunk)
+    assert (found is not None) == scanned
+    if found is not None:
+        expected = qtdraw_probe.prb_findall(chunk)
+        assert np.array_equal(found[0], expected[0])
+        assert np.array_equal(np.signbit(found[0]), np.signbit(expected[0]))
+        assert np.array_equal(found[1], expected[1])
+
+
+def simulated_session(pts: np.ndarray, probe_depth: int, probe_cycle: dict = None) -> (qtdraw_probe.ProbeSession, list):
+    simulated = qtdraw_probe.SimulatedController((20, 24))
+    probed = []
+    lines = qtdraw_mesh.probe_gcode(pts, 1000, 100, probe_depth, 2, 15, probe_cycle, probed)
+    session = asyncio.run(qtdraw_probe.probe_session(None, lines, probed.append, timeout=10, simulated=simulated))
+    return session, probed
+
+
+@pytest.mark.parametrize('probe_cycle, stages', [(None, 1), ({'fast_feed': 200, 'retract': 0.5, 'clearance': 0.5}, 2)])
+def test_probe_session_on_simulated_controller(probe_cycle, stages):
+    xv, yv = qtdraw_mesh.probe_grid((20, 24), (3, 4))
+    pts = qtdraw_mesh.zig_zag(xv, yv)
+    session, probed = simulated_session(pts, -2, probe_cycle)
+    assert session.probes == len(pts) * stages and session.failed == 0
+    # with a fast probe every point but the first is approached over the probes made
+    approaches = len(pts) - 1 if stages == 2 else 0
+    assert session.lines == len(list(qtdraw_mesh.probe_gcode(pts, 1000, 100, -2, 2, 15, probe_cycle, []))) + approaches
+    xyz = np.array(probed[stages - 1::stages])
+    assert np.allclose(xyz[:, :2], pts)
+    bed = qtdraw_probe.SimulatedController((20, 24))
+    assert np.allclose(xyz[:, 2], [bed.bed(x, y) for x, y in pts], atol=5e-4)
+
+
+def test_probe_session_stops_on_alarm():
+    # the synthetic bed is below a probe depth of 0 so the first probe fails
+    pts = np.array([[10., 12.], [20., 24.]])
+    with pytest.raises(RuntimeError, match='ALARM:5'):
+        simulated_session(pts, 0)
@@ -0,0 +1,258 @@
+import concurrent.futures
+import io
+import re
+
+import gcodeparser
+import numpy as np
+import pytest
+
+import qtdraw_profile
+import qtdraw_remap_gcode
+import qtdraw_surface
+import qtdraw_synthetic
+
+
+def test_minimizer_commented_rapid_then_draw():
+    # the G1 after a kept G0 line must switch the motion mode back
+    minimizer = qtdraw_remap_gcode.GcodeMinimizer()
+    gcode = minimizer.minimize('G1 X10 Y10 Z-.3\nG0 X20 Y20 Z2 ; c\nG1 X30 Y30 Z-.3\n')
+    assert gcode == 'G1 X10 Y10 Z-.3\nG0 X20 Y20 Z2 ; c\nG1 X30 Y30 Z-.3\n'
+
+
+def test_minimizer_commented_line_sets_position():
+    minimizer = qtdraw_remap_gcode.GcodeMinimizer()
+    gcode = minimizer.minimize('G1 X20 (start) Y20 F1000\nG1 X20 Y20 F1000\nG1 X21 Y20\n')
+    assert gcode == 'G1 X20 (start) Y20 F1000\nX21\n'
+
+
+def test_minimizer_unreadable_line_forgets_state():
+    minimizer = qtdraw_remap_gcode.GcodeMinimizer()
+    gcode = minimizer.minimize('G1 X1 Y1\nG0 X ; odd\nG1 X1 Y1\n')
+    assert gcode == 'G1 X1 Y1\nG0 X ; odd\nG1 X1 Y1\n'
+
+
+def test_minimizer_quantize_only_keeps_lines():
+    # rounding to steps alone doesn't drop repeats or no-op moves
+    minimizer = qtdraw_remap_gcode.GcodeMinimizer({'X': 80, 'Y': 80, 'Z': 800}, quantize_only=True)
+    gcode = minimizer.minimize('G21\nG1 X10.0001 Y5 Z-0.30001 F600\nG1 X10.0001 Y5 Z-0.30001 F600\nG1 Z-.3 ; c\n')
+    assert gcode == 'G21\nG1 X10.0 Y5 Z-0.3 F600\nG1 X10.0 Y5 Z-0.3 F600\nG1 Z-.3 ; c\n'
+
+def test_input_glob_leaves_out_earlier_outputs(tmp_path):
+    for name in ('a.gcode', 'a.remapped.gcode', 'b.gcode'):
+        (tmp_path / name).write_text('G0 X0 Y0 Z1\n')
+    pattern = '{dir}/{stem}.remapped.gcode'
+    filenames, named = qtdraw_remap_gcode.input_filenames((str(tmp_path / '*.gcode'),), pattern)
+    assert filenames == [str(tmp_path / 'a.gcode'), str(tmp_path / 'b.gcode')]
+    assert named
+
+
+def test_input_glob_of_one_file_is_named_by_pattern(tmp_path):
+    (tmp_path / 'only.gcode').write_text('G0 X0 Y0 Z1\n')
+    pattern = '{dir}/{stem}.remapped.gcode'
+    filenames, named = qtdraw_remap_gcode.input_filenames((str(tmp_path / '*.gcode'),), pattern)
+    assert named
+    assert qtdraw_remap_gcode.output_filenames(filenames, pattern, 'qtdraw_mesh.remap.npy')[0][1] == \
+            str(tmp_path / 'only.remapped.gcode')
+    filenames, named = qtdraw_remap_gcode.input_filenames((str(tmp_path / 'only.gcode'),), pattern)
+    assert not named
+
+
+def test_mesh_cache_that_cant_be_written(tmp_path, capsys):
+    qtdraw_synthetic.synthetic_mesh((4, 5)).to_csv(tmp_path / 'mesh.tsv', sep='\t', index=False)
+    # root can write anywhere, a directory in the way of the cache fails for anyone
+    (tmp_path / 'mesh.compiled.npz.tmp').mkdir()
+    xv, yv, z = qtdraw_remap_gcode.mesh_load_cached(str(tmp_path / 'mesh.tsv'), 0, 0, (0, 0))
+    assert z.shape == (4, 5) and z[0, 0] == 0
+    assert not (tmp_path / 'mesh.compiled.npz').exists()
+    assert 'could not save compiled mesh' in capsys.readouterr().out
+
+
+EDGE_GCODE = """G21
+(Start Layer)
+G0 G53 Z24 F100
+G0 G53 X22 Y27 F100
+M0
+
+(Start Block)
+G00 Z2
+G01 Z0 F600
+G00 X10.0000 Y-0.0004
+G01 Z-0.5 F600
+G01 X10.0005 Y20 Z0
+G01 F300.50 Z1
+G01 Z2 X11 Y21.2500
+G1
+M0
+G00 X0.0000 Y0.0000
+"""
+
+
+def synthetic_grid() -> (np.ndarray, np.ndarray, np.ndarray):
+    mesh = qtdraw_synthetic.synthetic_mesh((10, 11))
+    xv = np.unique(mesh['x'].to_numpy())
+    yv = np.unique(mesh['y'].to_numpy())
+    z = mesh['z'].to_numpy().reshape(len(xv), len(yv))
+    return xv, yv, z - z[0, 0]
+
+
+def remap_both_paths(gcode: str) -> list:
+    xv, yv, z = synthetic_grid()
+    remap_func = qtdraw_surface.surface_func(xv, yv, z)
+    out = []
+    for fast_path in (True, False):
+        gcode_out, remap_pts, last_xyz, n_lines = qtdraw_remap_gcode.remap_chunk(gcode, remap_func, (xv, yv), \
+                30., 30., (None, None, None), False, 0, 0.01, fast_path)
+        out.append((gcode_out, remap_pts.tolist(), last_xyz, n_lines))
+    return out
+
+
+def test_fast_path_same_as_gcodeparser_on_gwrite_output():
+    gcode = io.StringIO()
+    qtdraw_synthetic.synthetic_gcode(gcode, 20000)
+    gcode = gcode.getvalue() + EDGE_GCODE
+    assert qtdraw_remap_gcode.remap_gwrite_text(gcode, lambda pts: np.zeros(len(pts)), 30., 30., \
+            (None, None, None)) is not None
+    fast, gcodeparser = remap_both_paths(gcode)
+    assert fast == gcodeparser
+
+
+def test_fast_path_same_as_gcodeparser_on_odd_commands():
+    # negative or padded command numbers the fast path leaves to gcodeparser
+    for gcode in ('G1 X1 Y1\nG-1 X1\nG1 X2 Y2\n', 'G1 X1 Y1\nG-0 X1\nG1 X2\n', \
+            'G1 X1\nG999 X3\nM-3\nG1 X2\n', 'G01 X1\nG0001 X2\nM3 S1000\nG1 X3\n', 'G1 X1\nM-0 S3\nG0 X2\n'):
+        fast, gcodeparser = remap_both_paths(gcode)
+        assert fast == gcodeparser
+
+def test_decimal_format_spells_like_repr():
+    rng = np.random.default_rng(0)
+    values = np.concatenate((rng.uniform(-300, 300, 1000), np.round(rng.uniform(-3, 3, 1000), 5), \
+            [0., -0., 5e-5, -5e-5, 1e-4, -0.05, 0.5, 12.3, 1e9, 123456789.12345]))
+    for decimals, spelled in ((3, qtdraw_remap_gcode.round3(values)), (5, values)):
+        formats, numbers, n_numbers = qtdraw_remap_gcode.decimal_format('Z', spelled, decimals)
+        text = ''.join(formats.tolist()) % tuple(numbers[np.arange(2) < n_numbers[:, None]].tolist())
+        assert text == ''.join(' Z' + repr(value) for value in spelled.tolist())
+
+
+def test_remap_chunk_times_serialize_on_both_paths():
+    for fast_path in (True, False):
+        timer = qtdraw_profile.StageTimer()
+        qtdraw_remap_gcode.remap_chunk(EDGE_GCODE, lambda pts: np.zeros(len(pts)), None, \
+                30., 30., (None, None, None), False, 0, 0.01, fast_path, timer)
+        assert list(timer.times) == ['serialize']
+
+
+def test_parallel_chunks_same_as_one_process(tmp_path, monkeypatch):
+    # arcs, modal arc lines and feed and unit changes land on chunk edges
+    gcode = ['G21', 'G90', 'G0 Z2 F1000', 'G0 X10 Y10']
+    for i in range(40):
+        x = 10 + i
+        gcode += [f"G1 Z-0.{i % 9 + 1} F{300 + 10 * i}", f"G2 X{x + 5} Y10 I2.5 J0 Z-0.{i % 7 + 2}7", f"X{x} Y10 I-2.5 J0 Z-0.2", \
+                f"G3 X{x + 1} Y12 R3", f"G1 X{x + 2} Y{12 + i % 3}", f"Y{14 + i % 5}", \
+                f"G2 X{x + 4} Y{14 + i % 5} I1 J0 Z-0.1", 'G0 Z2']
+        if i % 13 == 12:
+            gcode += ['G20', 'G1 X1 Y1 Z0.01 F10', 'G21', f"G0 X{x} Y10"]
+    (tmp_path / 'in.gcode').write_text('\n'.join(gcode) + '\n')
+    xv, yv, z = synthetic_grid()
+    remap_func = qtdraw_surface.surface_func(xv, yv, z)
+    remap_options = {'remap_x_offset': 30., 'remap_y_offset': 30., 'subdivide': False, \
+            'subdivide_tolerance': 0, 'arc_tolerance': 0.01, 'chunk_lines': 0}
+    qtdraw_remap_gcode.remap_gcode_file(str(tmp_path / 'in.gcode'), str(tmp_path / 'one.gcode'), \
+            str(tmp_path / 'one.npy'), remap_func, (xv, yv), **remap_options)
+    monkeypatch.setattr(qtdraw_remap_gcode, 'PARALLEL_CHUNK_BYTES', 300)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2, \
+            initializer=qtdraw_remap_gcode.remap_worker_init, initargs=(xv, yv, z)) as executor:
+        qtdraw_remap_gcode.remap_gcode_file(str(tmp_path / 'in.gcode'), str(tmp_path / 'two.gcode'), \
+                str(tmp_path / 'two.npy'), remap_func, (xv, yv), executor=executor, jobs=2, **remap_options)
+    assert (tmp_path / 'one.gcode').read_bytes() == (tmp_path / 'two.gcode').read_bytes()
+    assert (tmp_path / 'one.npy').read_bytes() == (tmp_path / 'two.npy').read_bytes()
+
+
+def chord_errors(chords: np.ndarray, start: (float, float), center: (float, float)) -> (np.ndarray, np.ndarray):
+    """The distance of every chord end from the center, and of every chord
+    middle, where a chord is furthest from the arc."""
+    ends = np.vstack((start, chords))
+    middles = (ends[1:] + ends[:-1]) / 2
+    return np.hypot(*(ends - center).T), np.hypot(*(middles - center).T)
+
+
+@pytest.mark.parametrize('start, end, center, clockwise, sweep', [ \
+        ((0, 0), (10, 0), (5, 0), True, -np.pi), ((0, 0), (10, 0), (5, 0), False, np.pi), \
+        ((0, 5), (5, 0), (0, 0), True, -np.pi / 2), ((0, 5), (5, 0), (0, 0), False, 3 * np.pi / 2), \
+        ((3, 0), (3, 0), (0, 0), True, -2 * np.pi), ((3, 0), (3, 0), (0, 0), False, 2 * np.pi)])
+def test_arc_chords_within_tolerance(start, end, center, clockwise, sweep):
+    tolerance = 0.01
+    chords = qtdraw_remap_gcode.arc_chords(start, end, center, clockwise, tolerance)
+    assert tuple(chords[-1]) == end
+    radius = np.hypot(start[0] - center[0], start[1] - center[1])
+    on_arc, middle = chord_errors(chords, start, center)
+    assert on_arc == pytest.approx(radius)
+    assert (radius - middle <= tolerance + 1e-12).all()
+    # the angle turned chord by chord goes the right way round and adds up
+    angle = np.unwrap(np.arctan2(*(np.vstack((start, chords)) - center)[:, ::-1].T))
+    assert (np.sign(np.diff(angle)) == np.sign(sweep)).all()
+    assert angle[-1] - angle[0] == pytest.approx(sweep)
+
+
+@pytest.mark.parametrize('arc, center, y_range', [ \
+        ('G2 X6 Y0 R5', (3, -4), (0, 1)), ('G3 X6 Y0 R5', (3, 4), (-1, 0)), \
+        ('G2 X6 Y0 R-5', (3, 4), (0, 9)), ('G3 X6 Y0 I3 J4', (3, 4), (-1, 0)), \
+        ('G2 X0 Y0 I5 J0 Z-1', (5, 0), (-5, 5))])
+def test_linearize_arcs_centers(arc, center, y_range):
+    lines = gcodeparser.GcodeParser(f"G0 X0 Y0 Z1\n{arc}\n").lines
+    chords = qtdraw_remap_gcode.linearize_arcs(lines, (None, None, None), 0.01)[1:]
+    assert all(line.command == ('G', 1) for line in chords)
+    xyz = np.array([[line.get_param(axis) for axis in 'XYZ'] for line in chords])
+    assert tuple(xyz[-1, :2]) == (lines[1].get_param('X'), lines[1].get_param('Y'))
+    assert np.hypot(*(xyz[:, :2] - center).T) == pytest.approx(5)
+    assert xyz[:, 1].min() == pytest.approx(y_range[0], abs=0.01)
+    assert xyz[:, 1].max() == pytest.approx(y_range[1], abs=0.01)
+    # a helical move spreads its Z over the chords
+    Z = lines[1].get_param('Z', default=1)
+    assert xyz[-1, 2] == pytest.approx(Z)
+    assert (np.diff(xyz[:, 2]) <= 0).all() and (xyz[:, 2] >= Z).all()
+
+
+def test_mesh_cell_splits_at_grid_lines():
+    xv, yv = np.array([0., 10., 20., 30.]), np.array([0., 10., 20.])
+    start = np.array([[5., 5.], [25., 25.], [5., 5.], [12., 3.]])
+    end = np.array([[25., 25.], [5., 5.], [25., 5.], [18., 7.]])
+    move_i, move_t = qtdraw_remap_gcode.mesh_cell_splits(start, end, xv, yv)
+    assert move_i.tolist() == [0, 0, 1, 1, 2, 2]
+    # through the corners at 10, 10 and 20, 20 only once, and ordered along the move backwards too
+    assert move_t.tolist() == pytest.approx([0.25, 0.75, 0.25, 0.75, 0.25, 0.75])
+
+
+def test_fewest_splits_within_tolerance():
+    rng = np.random.default_rng(0)
+    for tolerance in (0.001, 0.01, 0.05):
+        t = np.sort(rng.uniform(0, 1, 30)).tolist()
+        t = [0.] + t + [1.]
+        z = rng.normal(0, 0.02, len(t)).tolist()
+        keep = qtdraw_remap_gcode.fewest_splits(t, z, tolerance)
+        assert keep == sorted(set(keep)) and all(0 < k < len(t) - 1 for k in keep)
+        ends = [0] + keep + [len(t) - 1]
+        for i, j in zip(ends[:-1], ends[1:]):
+            chord = np.interp(t[i + 1:j], [t[i], t[j]], [z[i], z[j]])
+            assert (np.abs(chord - z[i + 1:j]) <= tolerance).all()
+    # a straight z needs no splits
+    assert qtdraw_remap_gcode.fewest_splits([0., 0.2, 0.5, 1.], [1., 1.2, 1.5, 2.], 0.001) == []
+
+
+def test_subdivided_moves_stay_in_one_mesh_cell():
+    xv, yv = np.linspace(0, 180, 10), np.linspace(0, 200, 11)
+    z = qtdraw_synthetic.synthetic_surface(*np.meshgrid(xv, yv, indexing='ij'), (180, 200), 0.5)
+    remap_func = qtdraw_surface.surface_func(xv, yv, z)
+    rng = np.random.default_rng(1)
+    gcode = 'G21\nG90\nG0 X3 Y4 Z1\nG1 Z0\n' + ''.join(f"G1 X{x:.3f} Y{y:.3f} Z0\n" \
+            for x, y in rng.uniform((0, 0), (180, 200), (30, 2))) + 'G2 X100 Y100 I30 J0 Z0\n'
+    for tolerance in (0, 0.01):
+        gcode_out, remap_pts, last_xyz, n_lines = qtdraw_remap_gcode.remap_chunk(gcode, remap_func, (xv, yv), \
+                0., 0., (None, None, None), True, tolerance, 0.01, True)
+        xy = np.array([(float(x), float(y)) for x, y in re.findall(r'^G1 X(\S+) Y(\S+)', gcode_out, re.M)])
+        start, end = xy[:-1], xy[1:]
+        for axis, grid in ((0, xv), (1, yv)):
+            lo, hi = np.minimum(start[:, axis], end[:, axis]), np.maximum(start[:, axis], end[:, axis])
+            inside = (grid[None, :] > lo[:, None] + 1e-3) & (grid[None, :] < hi[:, None] - 1e-3)
+            # every crossing is split when the tolerance is 0, some are dropped above it
+            assert inside.any() == (tolerance > 0)
+        assert len(remap_pts) == gcode_out.count('Z')
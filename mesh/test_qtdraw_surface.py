@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+import qtdraw_surface
+
+
+@pytest.mark.parametrize('model', qtdraw_surface.MODELS)
+def test_surface_zero_at_reference(model):
+    xv = np.linspace(0, 200, 7)
+    yv = np.linspace(0, 150, 6)
+    x, y = np.meshgrid(xv, yv, indexing='ij')
+    z = 0.1 * np.sin(x / 40) * np.cos(y / 30) + np.random.default_rng(0).normal(0, 0.01, x.shape)
+    z = z - z[2, 3]
+    reference = qtdraw_surface.reference_xy(xv, yv, (2, 3))
+    surface = qtdraw_surface.surface_func(xv, yv, z, model, smoothing=0.05, reference=reference)
+    assert surface(np.array([reference]))[0] == pytest.approx(0, abs=1e-12)
@@ -0,0 +1,30 @@
+%start fields.gcode
+(layer 1 of id 1)
+(line 1 at 0.000 0.000)
+G0 X5.09375 Y-1.79167 (first 0)
+G1 X4.04688 Y+1.7917 D-1.046875 0.000e+00 %2
+G1 X4.046875 Y-1.0078125 (last 3 -0)
+(end line)
+(join)
+(line 2 at 4.047 -1.008)
+G0 X4.88542 Y-1.58333 (first 0)
+G1 X4.804166666666666 Y-1.5697916666666667 (last 2 0.08125)
+(end line)
+(end layer 0 4.80)
+M0
+(layer 2 of id 2)
+(line 1 at 4.804 -1.570)
+G0 X3.11458 Y-0.43750 (first 0)
+G1 X2.59375 Y+0.1771 D-0.520833 2.604e-01 %2
+G1 X2.07292 Y+0.4375 D-0.520833 -2.604e-01 %3
+G1 X1.552083333333333 Y1.0221354166666665 (last 4 0.520833)
+(end line)
+(end layer 1 1.55)
+M0
+(layer 3 of id 3)
+(line 1 at 1.552 1.022)
+G0 X5.14583 Y-1.94792 (first 0)
+G1 X5.135416666666666 Y-1.9375 (last 2 0.0104167)
+(end line)
+(end layer 2 5.14)
+M2
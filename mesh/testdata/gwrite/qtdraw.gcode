@@ -0,0 +1,42 @@
+G21
+(Start Layer)
+G0 G53 Z24 F100
+G0 G53 X22 Y27 F100
+M0
+(Start Block)
+G00 Z2
+G00 X2.6458 Y72.7935
+G01 Z0 F600
+G01 X29.2365 Y72.7935 Z0
+G01 X29.2365 Y52.8836 Z0
+G00 Z2
+(Start Block)
+G00 Z2
+G00 X7.9375 Y67.5018
+G01 Z0 F600
+G01 X10.0012 Y67.1579 Z0
+G00 Z2
+(Start Layer)
+G0 G53 Z24 F100
+G0 G53 X22 Y27 F100
+M0
+(Start Block)
+G00 Z2
+G00 X52.9167 Y38.3977
+G01 Z0 F600
+G01 X66.1458 Y31.7831 Z0
+G01 X79.3750 Y38.3977 Z0
+G01 X92.6042 Y1.3229 Z0
+G00 Z2
+(Start Layer)
+G0 G53 Z24 F100
+G0 G53 X22 Y27 F100
+M0
+(Start Block)
+G00 Z2
+G00 X1.3229 Y76.7622
+G01 Z0 F600
+G01 X1.5875 Y76.4977 Z0
+G00 Z2
+G01 Z5
+G00 X0.0000 Y0.0000
\ No newline at end of file
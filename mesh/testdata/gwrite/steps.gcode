@@ -0,0 +1,18 @@
+(layer 1)
+G0 X26 Y26
+G1 X266 Y0 (292.365)
+G1 X0 Y-199 (292.365)
+(pen up)
+G0 X79 Y-26
+G1 X21 Y-4 (100.012)
+(pen up)
+(layer 2)
+G0 X529 Y-317
+G1 X132 Y-67 (661.458)
+G1 X133 Y67 (793.750)
+G1 X132 Y-371 (926.042)
+(pen up)
+(layer 3)
+G0 X13 Y66
+G1 X3 Y-3 (15.875)
+(pen up)
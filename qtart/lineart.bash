@@ -39,7 +39,7 @@ for file in ${outsvg}
 do
     outgcode=`echo $file | sed "s/.svg/.gcode/g"`
     echo $file $outgcode
-    vpype --config ../qtdraw.toml \
-        read $file \
-        gwrite -p qtdraw $outgcode
+    ../mesh/qtdraw_gwrite.py --config ../qtdraw.toml --gwrite_profile qtdraw \
+        --input_svg_filename $file \
+        --output_gcode_filename $outgcode
 done